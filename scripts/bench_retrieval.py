@@ -0,0 +1,145 @@
+"""
+Сравнение старого ORM-пути векторного поиска с проекционным запросом
+src.api.retrieval.vector_statement: число обращений к БД, объем
+переданных данных и время.
+
+Объем оценивается по текстовому представлению полученных значений
+(psycopg по умолчанию получает результаты в текстовом формате).
+
+Пример:
+    python scripts/bench_retrieval.py --top-k 30 --iterations 20
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import asc, event, select  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from src.api.retrieval import vector_statement  # noqa: E402
+from src.db.models import Chunk, Document  # noqa: E402
+from src.db.session import SessionLocal, engine  # noqa: E402
+
+
+def _value_size(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if hasattr(value, "tolist"):  # numpy-массив эмбеддинга
+        value = value.tolist()
+    return len(str(value).encode("utf-8"))
+
+
+def _orm_entity_size(entity: Any) -> int:
+    return sum(
+        _value_size(getattr(entity, column.key))
+        for column in entity.__mapper__.column_attrs
+    )
+
+
+def legacy_search(db: Session, embedding: List[float], top_k: int) -> int:
+    """Прежняя реализация: полные строки Chunk + ленивая загрузка Document."""
+    distance = Chunk.embedding.cosine_distance(embedding).label("distance")
+    results = (
+        db.query(Chunk, distance)
+        .join(Document)
+        .order_by(asc(distance))
+        .limit(top_k)
+        .all()
+    )
+    size = 0
+    loaded_documents = set()
+    for r in results:
+        size += _orm_entity_size(r.Chunk) + _value_size(r.distance)
+        document = r.Chunk.document  # Ленивая загрузка документа
+        if document.id not in loaded_documents:
+            loaded_documents.add(document.id)
+            size += _orm_entity_size(document)
+    return size
+
+
+def lean_search(db: Session, embedding: List[float], top_k: int) -> int:
+    """Проекционный запрос из src.api.retrieval."""
+    rows = db.execute(
+        vector_statement(False), {"embedding": embedding, "top_k": top_k}
+    ).all()
+    return sum(_value_size(value) for row in rows for value in row)
+
+
+def measure(
+    name: str,
+    search: Callable[[Session, List[float], int], int],
+    embedding: List[float],
+    top_k: int,
+    iterations: int,
+) -> Dict[str, float]:
+    statements = 0
+
+    def _count(*args, **kwargs):
+        nonlocal statements
+        statements += 1
+
+    event.listen(engine, "before_cursor_execute", _count)
+    total_bytes = 0
+    total_time = 0.0
+    try:
+        for _ in range(iterations):
+            # Новая сессия на итерацию: identity map не должен скрывать подгрузки
+            with SessionLocal() as db:
+                start = time.perf_counter()
+                total_bytes += search(db, embedding, top_k)
+                total_time += time.perf_counter() - start
+    finally:
+        event.remove(engine, "before_cursor_execute", _count)
+
+    return {
+        "name": name,
+        "round_trips": statements / iterations,
+        "kbytes": total_bytes / iterations / 1024,
+        "ms": total_time / iterations * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval queries.")
+    parser.add_argument("--top-k", type=int, default=30)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        # Эмбеддинг случайного чанка в роли эмбеддинга запроса (без загрузки модели)
+        embedding = db.scalar(select(Chunk.embedding).limit(1))
+    if embedding is None:
+        print("No chunks in the database. Run ingestion first.")
+        return
+    embedding = list(map(float, embedding))
+
+    # Прогрев пула соединений и кэшей
+    measure("warmup", lean_search, embedding, args.top_k, 1)
+
+    results = [
+        measure("legacy ORM", legacy_search, embedding, args.top_k, args.iterations),
+        measure("lean projection", lean_search, embedding, args.top_k, args.iterations),
+    ]
+
+    print(f"\ntop_k={args.top_k}, iterations={args.iterations}")
+    print(f"{'query':<18}{'round trips':>12}{'KiB/query':>12}{'ms/query':>12}")
+    for r in results:
+        print(
+            f"{r['name']:<18}{r['round_trips']:>12.1f}{r['kbytes']:>12.1f}{r['ms']:>12.2f}"
+        )
+    legacy, lean = results
+    print(
+        f"\nSaved per query: {legacy['round_trips'] - lean['round_trips']:.1f} round trips, "
+        f"{legacy['kbytes'] - lean['kbytes']:.1f} KiB."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Экспорт модели эмбеддингов и моделей ре-ранжирования в ONNX для CPU-инференса
+(INFERENCE_BACKEND=onnx). Опционально применяет динамическую int8-квантизацию
+и сверяет выходы ONNX с PyTorch на наборе примеров.
+
+Модели пишутся в ONNX_MODEL_DIR/<org>__<name>/: model.onnx, model.int8.onnx
+(с --quantize), файлы токенизатора и export.json.
+
+Пример:
+    python scripts/export_onnx.py --quantize
+    python scripts/export_onnx.py --only reranker --tolerance 1e-3
+"""
+
+import argparse
+import inspect
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+from sentence_transformers import CrossEncoder, SentenceTransformer  # noqa: E402
+from transformers import AutoModelForSequenceClassification, AutoTokenizer  # noqa: E402
+
+from src.api.reranker import RERANKER_QUERY_TOKENS  # noqa: E402
+from src.config import settings  # noqa: E402
+from src.onnx_backend import (  # noqa: E402
+    EXPORT_META_FILE,
+    OnnxCrossEncoder,
+    OnnxSentenceEncoder,
+    onnx_model_dir,
+    onnx_model_file,
+)
+
+OPSET = 17
+
+SAMPLE_QUERIES = [
+    "How do I use boost::bimap?",
+    "Как настроить пул соединений в SQLAlchemy?",
+    "std::vector reserve vs resize",
+]
+SAMPLE_TEXTS = [
+    "Boost.Bimap is a bidirectional map library. Include <boost/bimap.hpp> to use it.",
+    "create_engine принимает pool_size и max_overflow для настройки пула соединений.",
+    "reserve() changes capacity without constructing elements; resize() changes size.",
+    "# Installation\n\nRun `pip install -e .` to install the package in editable mode.",
+]
+
+
+class _EmbeddingGraph(torch.nn.Module):
+    """Трансформер и pooling SentenceTransformer как один граф."""
+
+    def __init__(self, model: SentenceTransformer, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        features = dict(zip(self.input_names, inputs, strict=True))
+        return self.model(features)["sentence_embedding"]
+
+
+class _RerankerGraph(torch.nn.Module):
+    """Логиты модели классификации пар (без активации)."""
+
+    def __init__(self, model, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs, strict=True))).logits
+
+
+def _export(module: torch.nn.Module, encoded: Dict[str, torch.Tensor], path: Path):
+    input_names = list(encoded)
+    kwargs: Dict[str, Any] = {}
+    # В новых версиях torch по умолчанию включен dynamo-экспортер
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        module,
+        tuple(encoded[name] for name in input_names),
+        str(path),
+        input_names=input_names,
+        output_names=["output"],
+        dynamic_axes={
+            **{name: {0: "batch", 1: "sequence"} for name in input_names},
+            "output": {0: "batch"},
+        },
+        opset_version=OPSET,
+        **kwargs,
+    )
+
+
+def _input_names(tokenizer, encoded) -> List[str]:
+    return [name for name in tokenizer.model_input_names if name in encoded]
+
+
+def export_embedding(model_name: str, out_dir: Path):
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+    tokenizer = model.tokenizer
+    encoded = tokenizer(SAMPLE_TEXTS[:2], padding=True, return_tensors="pt")
+    names = _input_names(tokenizer, encoded)
+
+    with torch.no_grad():
+        _export(
+            _EmbeddingGraph(model, names),
+            {n: encoded[n] for n in names},
+            out_dir / onnx_model_file(False),
+        )
+    tokenizer.save_pretrained(str(out_dir))
+    return {
+        "kind": "embedding",
+        "model_name": model_name,
+        "embedding_dim": model.get_sentence_embedding_dimension(),
+        "max_length": model.max_seq_length,
+    }
+
+
+def export_reranker(model_name: str, out_dir: Path):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        model_name, trust_remote_code=True
+    )
+    model.eval()
+    encoded = tokenizer(
+        SAMPLE_QUERIES[:2], SAMPLE_TEXTS[:2], padding=True, return_tensors="pt"
+    )
+    names = _input_names(tokenizer, encoded)
+
+    with torch.no_grad():
+        _export(
+            _RerankerGraph(model, names),
+            {n: encoded[n] for n in names},
+            out_dir / onnx_model_file(False),
+        )
+    tokenizer.save_pretrained(str(out_dir))
+    max_length = settings.RERANKER_MAX_LENGTH or settings.CHUNK_SIZE + RERANKER_QUERY_TOKENS
+    return {
+        "kind": "reranker",
+        "model_name": model_name,
+        "num_labels": model.config.num_labels,
+        "max_length": min(max_length, tokenizer.model_max_length),
+    }
+
+
+def quantize(out_dir: Path):
+    """Динамическая int8-квантизация весов (активации квантуются на лету)."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        str(out_dir / onnx_model_file(False)),
+        str(out_dir / onnx_model_file(True)),
+        weight_type=QuantType.QInt8,
+    )
+
+
+def verify(meta: Dict[str, Any], quantized: bool) -> float:
+    """Максимальное абсолютное расхождение ONNX и PyTorch на примерах."""
+    model_name = meta["model_name"]
+    if meta["kind"] == "embedding":
+        reference = SentenceTransformer(model_name, device="cpu").encode(
+            SAMPLE_TEXTS, normalize_embeddings=True
+        )
+        actual = OnnxSentenceEncoder(model_name, quantized=quantized).encode(
+            SAMPLE_TEXTS, normalize_embeddings=True
+        )
+    else:
+        pairs = [(q, t) for q in SAMPLE_QUERIES for t in SAMPLE_TEXTS]
+        reference = CrossEncoder(
+            model_name, device="cpu", max_length=meta["max_length"]
+        ).predict(pairs, show_progress_bar=False)
+        actual = OnnxCrossEncoder(model_name, quantized=quantized).predict(pairs)
+    return float(np.max(np.abs(np.asarray(reference) - np.asarray(actual))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export models to ONNX for CPU inference.")
+    parser.add_argument("--only", choices=["embedding", "reranker"])
+    parser.add_argument("--output-dir", default=settings.ONNX_MODEL_DIR)
+    parser.add_argument(
+        "--quantize", action="store_true", help="Also write a dynamic int8 model."
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=1e-3, help="Max abs diff for the fp32 model."
+    )
+    parser.add_argument(
+        "--int8-tolerance", type=float, default=0.05, help="Max abs diff for the int8 model."
+    )
+    parser.add_argument("--skip-verify", action="store_true")
+    args = parser.parse_args()
+
+    # Проверка читает модели из ONNX_MODEL_DIR
+    settings.ONNX_MODEL_DIR = args.output_dir
+
+    jobs = []
+    if args.only in (None, "embedding"):
+        jobs.append((export_embedding, settings.EMBEDDING_MODEL))
+    if args.only in (None, "reranker"):
+        jobs.append((export_reranker, settings.RERANKER_MODEL))
+        if settings.RERANKER_CASCADE:
+            jobs.append((export_reranker, settings.RERANKER_STAGE1_MODEL))
+
+    failed = False
+    for export, model_name in jobs:
+        out_dir = onnx_model_dir(model_name, args.output_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        print(f"Exporting {model_name} to {out_dir}...")
+        meta = export(model_name, out_dir)
+        (out_dir / EXPORT_META_FILE).write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+        variants = [(False, args.tolerance)]
+        if args.quantize:
+            print("Applying dynamic int8 quantization...")
+            quantize(out_dir)
+            variants.append((True, args.int8_tolerance))
+
+        for quantized, tolerance in variants:
+            file_name = onnx_model_file(quantized)
+            size_mb = (out_dir / file_name).stat().st_size / 2**20
+            if args.skip_verify:
+                print(f"  {file_name}: {size_mb:.1f} MiB")
+                continue
+            diff = verify(meta, quantized)
+            ok = diff <= tolerance
+            failed |= not ok
+            print(
+                f"  {file_name}: {size_mb:.1f} MiB, max abs diff vs PyTorch {diff:.2e} "
+                f"(tolerance {tolerance:.0e}) {'OK' if ok else 'FAILED'}"
+            )
+
+    if failed:
+        sys.exit(1)
+    print("\nDone. Set INFERENCE_BACKEND=onnx (and ONNX_QUANTIZED=True for int8) in .env.")
+
+
+if __name__ == "__main__":
+    main()
@@ -71,11 +71,48 @@ CREATE TABLE IF NOT EXISTS query_history (
   llm_provider      TEXT NOT NULL,
   llm_model         TEXT NOT NULL,
   confidence_score  REAL NOT NULL,
+  domain            TEXT, -- домен, которым был ограничен поиск
+  cache_source_id   BIGINT, -- ID исходной записи, если ответ взят из семантического кэша
+  is_fallback       BOOLEAN NOT NULL DEFAULT false, -- ответ-заглушка без уверенного ответа
   created_at        TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- Для баз, созданных до появления семантического кэша
+ALTER TABLE query_history ADD COLUMN IF NOT EXISTS domain TEXT;
+ALTER TABLE query_history ADD COLUMN IF NOT EXISTS cache_source_id BIGINT;
+ALTER TABLE query_history ADD COLUMN IF NOT EXISTS is_fallback BOOLEAN NOT NULL DEFAULT false;
+-- Заглушки, сохраненные до появления is_fallback
+UPDATE query_history SET is_fallback = true
+  WHERE NOT is_fallback AND response_md LIKE 'К сожалению, я не могу дать уверенный ответ%';
+
 CREATE INDEX IF NOT EXISTS idx_qh_user_time ON query_history(user_id, created_at DESC);
 
 CREATE INDEX IF NOT EXISTS idx_qh_embedding_hnsw
   ON query_history USING hnsw (query_embedding vector_cosine_ops)
-  WITH (m = 16, ef_construction = 64);
\ No newline at end of file
+  WITH (m = 16, ef_construction = 64);
+
+-- 4. Кэш оценок ре-ранкера (общий уровень для всех воркеров API)
+CREATE TABLE IF NOT EXISTS rerank_score_cache (
+  model_name  TEXT NOT NULL,
+  query_hash  BYTEA NOT NULL, -- blake2b-128 нормализованного запроса
+  chunk_id    BIGINT NOT NULL REFERENCES chunks(id) ON DELETE CASCADE,
+  score       REAL NOT NULL,
+  created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (model_name, query_hash, chunk_id)
+);
+
+-- Для каскадного удаления при переиндексации чанков
+CREATE INDEX IF NOT EXISTS idx_rerank_cache_chunk ON rerank_score_cache(chunk_id);
+CREATE INDEX IF NOT EXISTS idx_rerank_cache_created ON rerank_score_cache(created_at);
+
+-- 5. Кэш ответов LLM для детерминированных запросов (temperature = 0)
+CREATE TABLE IF NOT EXISTS llm_completion_cache (
+  cache_key     BYTEA PRIMARY KEY, -- blake2b-256 модели, сообщений и параметров
+  model         TEXT NOT NULL,
+  completion    TEXT NOT NULL,
+  created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+  last_used_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Для вытеснения давно не использованных записей
+CREATE INDEX IF NOT EXISTS idx_completion_cache_last_used ON llm_completion_cache(last_used_at);
@@ -0,0 +1,168 @@
+import datetime
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from src.config import settings
+from src.db.models import CompletionCacheEntry
+from src.db.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def completion_key(request_body: Dict[str, Any]) -> bytes:
+    """
+    blake2b-256 от модели, сообщений (системное и промпт), temperature и max_tokens.
+    """
+    material = json.dumps(
+        {
+            "model": request_body["model"],
+            "messages": request_body["messages"],
+            "temperature": request_body["temperature"],
+            "max_tokens": request_body.get("max_tokens"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.blake2b(material.encode("utf-8"), digest_size=32).digest()
+
+
+def is_deterministic(request_body: Dict[str, Any]) -> bool:
+    """Кэшируются только запросы с temperature=0 (жадное декодирование)."""
+    return float(request_body.get("temperature", 1.0)) == 0.0
+
+
+class CompletionCache:
+    """
+    Кэш ответов LLM. Первый уровень — LRU в памяти процесса, второй
+    (COMPLETION_CACHE_DB_ENABLED) — таблица llm_completion_cache, общая
+    для всех воркеров и ограниченная COMPLETION_CACHE_DB_MAX_ENTRIES записями
+    (вытесняются давно не использованные).
+
+    Промпт содержит полный текст контекста, поэтому изменение документов
+    меняет ключ; сброс после переиндексации только освобождает место.
+    """
+
+    # Как часто (в записях) проверять размер таблицы
+    EVICT_EVERY = 100
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or settings.COMPLETION_CACHE_MAX_ENTRIES
+        self.use_db = settings.COMPLETION_CACHE_DB_ENABLED
+        self.db_max_entries = settings.COMPLETION_CACHE_DB_MAX_ENTRIES
+
+        self._lru: "OrderedDict[bytes, str]" = OrderedDict()
+        self._writes_since_evict = 0
+
+        # Статистика
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    async def get(self, key: bytes) -> Optional[str]:
+        completion = self._lru.get(key)
+        if completion is not None:
+            self._lru.move_to_end(key)
+            self.memory_hits += 1
+            return completion
+
+        if self.use_db:
+            completion = await self._db_get(key)
+            if completion is not None:
+                self.db_hits += 1
+                self._remember(key, completion)
+                return completion
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: bytes, model: str, completion: str):
+        self._remember(key, completion)
+        if self.use_db:
+            await self._db_put(key, model, completion)
+
+    async def clear(self):
+        """Сбрасывает оба уровня кэша."""
+        self._lru.clear()
+        if self.use_db:
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(CompletionCacheEntry))
+                await db.commit()
+        logger.info("Completion cache flushed.")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, key: bytes, completion: str):
+        self._lru[key] = completion
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def _db_get(self, key: bytes) -> Optional[str]:
+        try:
+            async with AsyncSessionLocal() as db:
+                completion = await db.scalar(
+                    select(CompletionCacheEntry.completion).where(
+                        CompletionCacheEntry.cache_key == key
+                    )
+                )
+                if completion is not None:
+                    await db.execute(
+                        update(CompletionCacheEntry)
+                        .where(CompletionCacheEntry.cache_key == key)
+                        .values(last_used_at=datetime.datetime.now(datetime.timezone.utc))
+                    )
+                    await db.commit()
+                return completion
+        except Exception as e:
+            # Кэш не должен ломать запрос
+            logger.warning("Completion cache lookup failed: %s", e)
+            return None
+
+    async def _db_put(self, key: bytes, model: str, completion: str):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        stmt = insert(CompletionCacheEntry).values(
+            cache_key=key,
+            model=model,
+            completion=completion,
+            created_at=now,
+            last_used_at=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["cache_key"],
+            set_={"completion": stmt.excluded.completion, "last_used_at": now},
+        )
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(stmt)
+                self._writes_since_evict += 1
+                if self._writes_since_evict >= self.EVICT_EVERY:
+                    self._writes_since_evict = 0
+                    await db.execute(_evict_statement(self.db_max_entries))
+                await db.commit()
+        except Exception as e:
+            logger.warning("Completion cache write failed: %s", e)
+
+
+def _evict_statement(max_entries: int):
+    """Удаляет записи сверх max_entries, начиная с давно не использованных."""
+    stale = (
+        select(CompletionCacheEntry.cache_key)
+        .order_by(CompletionCacheEntry.last_used_at.desc())
+        .offset(max_entries)
+    )
+    return delete(CompletionCacheEntry).where(CompletionCacheEntry.cache_key.in_(stale))
+
@@ -0,0 +1,82 @@
+import logging
+from typing import Dict, List, Optional
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Оценка токенов на заголовок источника "[SOURCE n] (Title: ..., URL: ...)"
+# и разделитель между источниками
+SOURCE_OVERHEAD_TOKENS = 40
+
+
+def _truncate(text: str, token_count: int, max_tokens: int) -> str:
+    """
+    Обрезает текст примерно до max_tokens по доле символов, без токенизатора.
+    Обрезка идет по последнему пробелу, чтобы не рвать слова.
+    """
+    cut = int(len(text) * max_tokens / token_count)
+    truncated = text[:cut]
+    space = truncated.rfind(" ")
+    if space > cut // 2:
+        truncated = truncated[:space]
+    return truncated.rstrip() + " ..."
+
+
+def pack_context(
+    chunks: List[Dict],
+    token_budget: Optional[int] = None,
+    min_truncated_tokens: Optional[int] = None,
+) -> List[Dict]:
+    """
+    Жадно заполняет бюджет токенов контекста LLM чанками в порядке ре-ранжирования.
+    Используется token_count, сохраненный при индексации, поэтому токенизатор
+    на горячем пути не нужен. Последний не поместившийся чанк обрезается,
+    если в бюджете остается хотя бы min_truncated_tokens; остальные отбрасываются.
+
+    Args:
+        chunks: Чанки в порядке убывания релевантности
+        token_budget: Бюджет токенов на источники (0 — без ограничения)
+
+    Returns:
+        Чанки для промпта; у обрезанного чанка выставлен флаг truncated
+    """
+    if token_budget is None:
+        token_budget = settings.CONTEXT_TOKEN_BUDGET
+    if min_truncated_tokens is None:
+        min_truncated_tokens = settings.CONTEXT_MIN_TRUNCATED_TOKENS
+    if token_budget <= 0:
+        return chunks
+
+    packed: List[Dict] = []
+    used = 0
+    for chunk in chunks:
+        # Чанки без token_count (старые записи) оцениваем по ~4 символа на токен
+        tokens = chunk.get("token_count") or max(1, len(chunk["text"]) // 4)
+        remaining = token_budget - used - SOURCE_OVERHEAD_TOKENS
+        if tokens <= remaining:
+            packed.append(chunk)
+            used += tokens + SOURCE_OVERHEAD_TOKENS
+            continue
+        # Первый источник обрезаем в любом случае, чтобы контекст не был пустым
+        if remaining >= min_truncated_tokens or (not packed and remaining > 0):
+            packed.append(
+                {
+                    **chunk,
+                    "text": _truncate(chunk["text"], tokens, remaining),
+                    "token_count": remaining,
+                    "truncated": True,
+                }
+            )
+            used += remaining + SOURCE_OVERHEAD_TOKENS
+        break
+
+    if len(packed) < len(chunks) or any(c.get("truncated") for c in packed):
+        logger.info(
+            "Context packed: %d of %d chunks, ~%d of %d tokens",
+            len(packed),
+            len(chunks),
+            used,
+            token_budget,
+        )
+    return packed
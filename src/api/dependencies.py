@@ -3,7 +3,10 @@ from functools import lru_cache
 from src.ingestion.embedding import get_embedding_model
 
 from .llm import get_llm_client
+from .llm_scheduler import get_llm_scheduler
 from .rag import RAGEngine
+from .rerank_cascade import get_rerank_cascade
+from .rerank_scheduler import get_rerank_scheduler
 from .reranker import get_reranker_model
 
 
@@ -17,4 +20,7 @@ def get_rag_engine() -> RAGEngine:
         embedding_model=get_embedding_model(),
         reranker_model=get_reranker_model(),
         llm_client=get_llm_client(),
+        rerank_scheduler=get_rerank_scheduler(),
+        rerank_cascade=get_rerank_cascade(),
+        llm_scheduler=get_llm_scheduler(),
     )
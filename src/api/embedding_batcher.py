@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import settings
+from src.ingestion.embedding import EmbeddingModel, get_embedding_model
+
+logger = logging.getLogger(__name__)
+
+# (текст, future вызывающего, момент постановки в очередь)
+_QueueItem = Tuple[str, asyncio.Future, float]
+
+
+class EmbeddingBatcher:
+    """
+    Асинхронный micro-batcher поверх EmbeddingModel.
+    Собирает одиночные запросы от параллельных обращений в один вызов encode,
+    который выполняется в рабочем потоке и не блокирует event loop.
+    """
+
+    def __init__(
+        self,
+        model: EmbeddingModel,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size or settings.EMBEDDING_BATCH_SIZE
+        if max_wait_ms is None:
+            max_wait_ms = settings.EMBEDDING_BATCH_MAX_WAIT_MS
+        self.max_wait = max_wait_ms / 1000
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        # Статистика
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+        self._max_batch_size_seen = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        Возвращает эмбеддинг одного текста, вычисленный в общем батче.
+        """
+        queue = self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((text, future, time.perf_counter()))
+        return await future
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        Эмбеддинги пачки текстов одним вызовом get_embeddings, минуя очередь:
+        пакетный запрос уже является батчем.
+        """
+        return await asyncio.to_thread(self.model.get_embeddings, texts)
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущая глубина очереди, размеры батчей и время ожидания."""
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self._batches,
+            "items": self._items,
+            "last_batch_size": self._last_batch_size,
+            "max_batch_size": self._max_batch_size_seen,
+            "avg_batch_size": self._items / self._batches if self._batches else 0.0,
+            "avg_wait_ms": self._total_wait / self._items * 1000
+            if self._items
+            else 0.0,
+            "max_wait_ms": self._max_wait_seen * 1000,
+        }
+
+    async def close(self):
+        """Останавливает фоновый обработчик и отменяет ожидающие запросы."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                if not future.done():
+                    future.cancel()
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        # Очередь и обработчик привязаны к event loop, в котором они созданы
+        loop = asyncio.get_running_loop()
+        if (
+            self._queue is None
+            or self._worker is None
+            or self._worker.done()
+            or self._loop is not loop
+        ):
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    async def _run(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[_QueueItem] = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Добираем батч, пока он не заполнен и не истекло окно ожидания
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._process(batch)
+
+    async def _process(self, batch: List[_QueueItem]):
+        # Вызывающие могли отменить ожидание (например, при разрыве соединения)
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        for _, _, enqueued_at in batch:
+            wait = started - enqueued_at
+            self._total_wait += wait
+            self._max_wait_seen = max(self._max_wait_seen, wait)
+        self._batches += 1
+        self._items += len(batch)
+        self._last_batch_size = len(batch)
+        self._max_batch_size_seen = max(self._max_batch_size_seen, len(batch))
+
+        try:
+            embeddings = await asyncio.to_thread(
+                self.model.get_embeddings, [text for text, _, _ in batch]
+            )
+        except Exception as e:
+            logger.exception("Embedding batch of %d texts failed", len(batch))
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), embedding in zip(batch, embeddings, strict=True):
+            if not future.done():
+                future.set_result(embedding)
+
+
+_embedding_batcher = None
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Возвращает синглтон-экземпляр батчера эмбеддингов запросов."""
+    global _embedding_batcher
+    if _embedding_batcher is None:
+        _embedding_batcher = EmbeddingBatcher(get_embedding_model())
+    return _embedding_batcher
+
+
+async def close_embedding_batcher():
+    global _embedding_batcher
+    if _embedding_batcher:
+        await _embedding_batcher.close()
+        logger.info("Embedding batcher closed.")
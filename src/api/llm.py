@@ -1,25 +1,173 @@
 import asyncio
+import json
 import logging
-from typing import cast
+import random
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, cast
 
 import httpx
 
 from src.config import settings
 
-# Глобальный семафор для ограничения параллельных запросов к LLM
-llm_lock = asyncio.Semaphore(settings.LLM_MAX_CONCURRENT_REQUESTS)
+from .completion_cache import CompletionCache, completion_key, is_deterministic
 
 logger = logging.getLogger(__name__)
 
+# Ответы, после которых запрос можно повторить на другом сервере
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Сколько последних задержек хранить для перцентилей
+LATENCY_WINDOW = 200
+# Минимум замеров, после которого включается хеджирование
+HEDGE_MIN_SAMPLES = 20
+
+
+class LLMUnavailableError(RuntimeError):
+    """Нет доступных LLM-серверов: у всех разомкнут circuit breaker."""
+
+
+def _parse_base_urls() -> List[str]:
+    urls = [u.strip() for u in (settings.LLM_BASE_URLS or "").split(",") if u.strip()]
+    return urls or [settings.LLM_BASE_URL]
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    # Ошибки соединения, таймауты, обрыв ответа
+    return isinstance(error, httpx.TransportError)
+
+
+def _parse_sse_delta(line: str) -> Optional[str]:
+    """
+    Фрагмент текста из строки SSE вида "data: {...}": пустая строка — в строке
+    нет текста, None — конец потока ("data: [DONE]").
+    """
+    if not line.startswith("data:"):
+        return ""
+    payload = line[len("data:") :].strip()
+    if payload == "[DONE]":
+        return None
+    choices = json.loads(payload).get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+
+class _Backend:
+    """
+    Один OpenAI-совместимый сервер: пул соединений, circuit breaker
+    и статистика задержек.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        headers: Dict[str, str],
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=settings.LLM_TIMEOUT,
+            http2=settings.LLM_HTTP2,
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONCURRENT_REQUESTS * 2,
+                max_keepalive_connections=settings.LLM_MAX_CONCURRENT_REQUESTS,
+            ),
+            transport=transport,
+        )
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    @property
+    def state(self) -> str:
+        """closed — работает; open — исключен; half_open — допускается пробный запрос."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= settings.LLM_CIRCUIT_RESET_SECONDS:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probe_in_flight)
+
+    def begin(self):
+        if self.state == "half_open":
+            self.probe_in_flight = True
+        self.in_flight += 1
+        self.requests += 1
+
+    def end(self):
+        self.in_flight -= 1
+        self.probe_in_flight = False
+
+    def record_success(self, latency_ms: float):
+        self.latencies.append(latency_ms)
+        self.consecutive_failures = 0
+        if self.opened_at is not None:
+            logger.info("LLM backend %s recovered, closing circuit.", self.base_url)
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if (
+            self.state == "half_open"
+            or self.consecutive_failures >= settings.LLM_CIRCUIT_FAILURE_THRESHOLD
+        ):
+            if self.state != "open":
+                logger.warning(
+                    "LLM backend %s failed %d times in a row, opening circuit for %ss.",
+                    self.base_url,
+                    self.consecutive_failures,
+                    settings.LLM_CIRCUIT_RESET_SECONDS,
+                )
+            self.opened_at = time.monotonic()
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency_p50_ms": self.percentile(50),
+            "latency_p95_ms": self.percentile(95),
+        }
+
 
 class LLMClient:
     """
     Клиент для взаимодействия с OpenAI-совместимым API.
-    Обеспечивает последовательную обработку запросов к LLM.
+    Распределяет запросы между серверами LLM_BASE_URLS по наименьшему числу
+    выполняющихся запросов, повторяет запросы после сетевых ошибок и ответов
+    429/5xx с экспоненциальной задержкой со случайным разбросом и исключает
+    сбоящие серверы (circuit breaker). При LLM_HEDGE_ENABLED обычный запрос,
+    не завершившийся за p95 задержки сервера, дублируется на другой сервер.
     """
 
-    def __init__(self):
-        self.base_url = settings.LLM_BASE_URL
+    def __init__(
+        self,
+        base_urls: Optional[List[str]] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_urls = base_urls or _parse_base_urls()
+        self.base_url = self.base_urls[0]
         self.api_key = settings.LLM_API_KEY
         self.model = settings.LLM_MODEL
         self.timeout = settings.LLM_TIMEOUT
@@ -29,69 +177,341 @@ class LLMClient:
         else:
             self.provider = "lmstudio"
 
-        self.client = httpx.AsyncClient(
-            base_url=self.base_url,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            },
-            timeout=self.timeout,
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+        self.backends = [_Backend(url, headers, transport) for url in self.base_urls]
+        # Ограничение параллельных запросов: LLM_MAX_CONCURRENT_REQUESTS на сервер
+        self._slots = asyncio.Semaphore(
+            settings.LLM_MAX_CONCURRENT_REQUESTS * len(self.backends)
         )
+
+        self.completion_cache = (
+            CompletionCache() if settings.COMPLETION_CACHE_ENABLED else None
+        )
+
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
         logger.info(
-            "LLM Client initialized for model '%s' at '%s' provider %s",
+            "LLM Client initialized for model '%s' at %s provider %s",
             self.model,
-            self.base_url,
+            ", ".join(self.base_urls),
             self.provider,
         )
 
-    async def generate(self, prompt: str, temperature: float) -> str:
+    def _build_request_body(
+        self, prompt: str, temperature: float, stream: bool = False
+    ) -> Dict[str, Any]:
+        request_body: Dict[str, Any] = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a helpful technical assistant.",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": temperature,
+            "max_tokens": 2048,
+        }
+        if stream:
+            request_body["stream"] = True
+        return request_body
+
+    async def cached_completion(self, prompt: str, temperature: float) -> Optional[str]:
+        """Готовый ответ из кэша для детерминированного запроса или None."""
+        request_body = self._build_request_body(prompt, temperature)
+        if self.completion_cache is None or not is_deterministic(request_body):
+            return None
+        return await self.completion_cache.get(completion_key(request_body))
+
+    async def generate(
+        self, prompt: str, temperature: float, check_cache: bool = True
+    ) -> str:
         """
         Отправляет запрос к LLM для генерации текста.
+        Ответы на детерминированные запросы (temperature=0) кэшируются;
+        check_cache=False — вызывающий уже проверил кэш через cached_completion.
         """
-        async with llm_lock:
-            logger.debug("LLM lock acquired. Generating response...")
-            try:
-                request_body = {
-                    "model": self.model,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful technical assistant.",
-                        },
-                        {"role": "user", "content": prompt},
-                    ],
-                    "temperature": temperature,
-                    "max_tokens": 2048,
-                }
-                logger.debug(
-                    "LLM request: model=%s, temperature=%.2f", self.model, temperature
-                )
+        request_body = self._build_request_body(prompt, temperature)
+        cache_key = None
+        if self.completion_cache is not None and is_deterministic(request_body):
+            cache_key = completion_key(request_body)
+            if check_cache:
+                cached = await self.completion_cache.get(cache_key)
+                if cached is not None:
+                    return cached
 
-                response = await self.client.post(
-                    "/chat/completions",
-                    json=request_body,
-                )
-                response.raise_for_status()
+        content = await self._generate(request_body)
+        if cache_key is not None:
+            await self.completion_cache.put(cache_key, self.model, content)
+        return content
 
-                data = response.json()
+    async def _generate(self, request_body: Dict[str, Any]) -> str:
+        async with self._slots:
+            logger.debug(
+                "LLM request: model=%s, temperature=%.2f",
+                self.model,
+                request_body["temperature"],
+            )
+            attempt = 0
+            tried: Set[_Backend] = set()
+            last_error: Optional[BaseException] = None
+            while True:
+                try:
+                    content = await self._generate_hedged(request_body, tried)
+                    logger.debug("LLM response generated successfully.")
+                    return content
+                except Exception as e:
+                    # Если после сбоев не осталось серверов, важнее исходная ошибка
+                    error = last_error if isinstance(e, LLMUnavailableError) else e
+                    if error is None or not _is_retryable(error) or (
+                        attempt >= settings.LLM_MAX_RETRIES
+                    ):
+                        self._log_error(error or e)
+                        raise (error or e) from None
+                    last_error = error
+                    attempt += 1
+                    await self._backoff(attempt, error)
 
-                content = data["choices"][0]["message"]["content"]
-                logger.debug("LLM response generated successfully.")
-                return cast(str, content)
+    async def generate_stream(
+        self, prompt: str, temperature: float, check_cache: bool = True
+    ) -> AsyncIterator[str]:
+        """
+        Потоковая генерация: отдает фрагменты текста по мере их появления
+        (OpenAI-совместимый режим stream: true). Повтор на другом сервере
+        возможен только до первого фрагмента; хеджирование не применяется.
+        Ответ из кэша отдается одним фрагментом.
+        """
+        request_body = self._build_request_body(prompt, temperature, stream=True)
+        cache_key = None
+        if self.completion_cache is not None and is_deterministic(request_body):
+            cache_key = completion_key(request_body)
+            if check_cache:
+                cached = await self.completion_cache.get(cache_key)
+                if cached is not None:
+                    yield cached
+                    return
 
-            except httpx.HTTPStatusError as e:
-                logger.error(
-                    "Error communicating with LLM: %s - %s",
-                    e.response.status_code,
-                    e.response.text,
-                )
-                raise
-            except Exception:
-                logger.exception("An unexpected error occurred in LLMClient")
+        parts: List[str] = []
+        async for delta in self._generate_stream(request_body):
+            parts.append(delta)
+            yield delta
+        if cache_key is not None:
+            await self.completion_cache.put(cache_key, self.model, "".join(parts))
+
+    async def _generate_stream(
+        self, request_body: Dict[str, Any]
+    ) -> AsyncIterator[str]:
+        async with self._slots:
+            attempt = 0
+            tried: Set[_Backend] = set()
+            last_error: Optional[BaseException] = None
+            while True:
+                backend = self._pick_retry_backend(tried, last_error)
+                started = False
+                try:
+                    stream = self._stream_from(backend, request_body)
+                    async with aclosing(stream):
+                        async for delta in stream:
+                            started = True
+                            yield delta
+                    return
+                except Exception as e:
+                    # После первого фрагмента клиент уже получил часть ответа
+                    if (
+                        started
+                        or not _is_retryable(e)
+                        or attempt >= settings.LLM_MAX_RETRIES
+                    ):
+                        self._log_error(e)
+                        raise
+                    last_error = e
+                attempt += 1
+                await self._backoff(attempt, last_error)
+
+    def _pick_retry_backend(
+        self, tried: Set[_Backend], last_error: Optional[BaseException]
+    ) -> _Backend:
+        """
+        Сервер для очередной попытки. Если после сбоев доступных серверов
+        не осталось, выбрасывается исходная ошибка, а не LLMUnavailableError.
+        """
+        try:
+            backend = self._pick_backend(exclude=tried)
+        except LLMUnavailableError:
+            if last_error is None:
                 raise
+            self._log_error(last_error)
+            raise last_error from None
+        tried.add(backend)
+        return backend
+
+    async def _stream_from(
+        self, backend: _Backend, request_body: Dict[str, Any]
+    ) -> AsyncIterator[str]:
+        """Фрагменты потокового ответа одного сервера с учетом его статистики."""
+        start_time = time.monotonic()
+        backend.begin()
+        try:
+            async with backend.client.stream(
+                "POST", "/chat/completions", json=request_body
+            ) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    delta = _parse_sse_delta(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+        except Exception as e:
+            if _is_retryable(e):
+                backend.record_failure()
+            raise
+        finally:
+            backend.end()
+        backend.record_success((time.monotonic() - start_time) * 1000)
+        logger.debug("LLM stream completed successfully.")
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика по серверам, повторам и хеджированию."""
+        return {
+            "backends": [b.stats() for b in self.backends],
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "completion_cache": (
+                self.completion_cache.stats() if self.completion_cache else None
+            ),
+        }
 
     async def close(self):
-        await self.client.aclose()
+        for backend in self.backends:
+            await backend.client.aclose()
+
+    def _pick_backend(self, exclude: Optional[Set[_Backend]] = None) -> _Backend:
+        """
+        Доступный сервер с наименьшим числом выполняющихся запросов.
+        Серверы из exclude (уже пробовавшиеся для этого запроса) выбираются
+        только если других доступных нет.
+        """
+        exclude = exclude or set()
+        candidates = [b for b in self.backends if b.available() and b not in exclude]
+        if not candidates:
+            # Все доступные уже пробовали — допускаем повтор на них же
+            candidates = [b for b in self.backends if b.available()]
+        if not candidates:
+            raise LLMUnavailableError("All LLM backends are unavailable (circuit open).")
+        return min(candidates, key=lambda b: (b.in_flight, random.random()))
+
+    async def _post(self, backend: _Backend, request_body: Dict[str, Any]) -> str:
+        start_time = time.monotonic()
+        backend.begin()
+        try:
+            response = await backend.client.post("/chat/completions", json=request_body)
+            response.raise_for_status()
+            content = response.json()["choices"][0]["message"]["content"]
+        except asyncio.CancelledError:
+            # Проигравший хеджированный запрос — не сбой сервера
+            raise
+        except Exception as e:
+            if _is_retryable(e):
+                backend.record_failure()
+            raise
+        finally:
+            backend.end()
+        backend.record_success((time.monotonic() - start_time) * 1000)
+        return cast(str, content)
+
+    def _hedge_delay(self, backend: _Backend) -> Optional[float]:
+        """Задержка перед дублирующим запросом (сек) или None, если хеджировать нельзя."""
+        if not settings.LLM_HEDGE_ENABLED or len(self.backends) < 2:
+            return None
+        if len(backend.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        delay_ms = max(
+            backend.percentile(settings.LLM_HEDGE_PERCENTILE) or 0.0,
+            settings.LLM_HEDGE_MIN_DELAY_MS,
+        )
+        return delay_ms / 1000
+
+    async def _generate_hedged(
+        self, request_body: Dict[str, Any], tried: Set[_Backend]
+    ) -> str:
+        primary = self._pick_backend(exclude=tried)
+        tried.add(primary)
+        delay = self._hedge_delay(primary)
+        if delay is None:
+            return await self._post(primary, request_body)
+
+        tasks = {asyncio.create_task(self._post(primary, request_body))}
+        hedge: Optional[asyncio.Task] = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                candidates = [
+                    b for b in self.backends if b is not primary and b.available()
+                ]
+                if candidates:
+                    secondary = min(candidates, key=lambda b: b.in_flight)
+                    tried.add(secondary)
+                    self.hedges += 1
+                    logger.debug(
+                        "Hedging LLM request from %s to %s after %.0f ms",
+                        primary.base_url,
+                        secondary.base_url,
+                        delay * 1000,
+                    )
+                    hedge = asyncio.create_task(self._post(secondary, request_body))
+                    tasks.add(hedge)
+
+            pending = tasks
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise cast(BaseException, error)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _backoff(self, attempt: int, error: BaseException):
+        """Экспоненциальная задержка с полным случайным разбросом."""
+        self.retries += 1
+        delay_ms = random.uniform(
+            0, settings.LLM_RETRY_BACKOFF_MS * 2 ** (attempt - 1)
+        )
+        logger.warning(
+            "LLM request failed (%s), retry %d/%d in %.0f ms",
+            error,
+            attempt,
+            settings.LLM_MAX_RETRIES,
+            delay_ms,
+        )
+        await asyncio.sleep(delay_ms / 1000)
+
+    def _log_error(self, error: BaseException):
+        if isinstance(error, httpx.HTTPStatusError):
+            logger.error(
+                "Error communicating with LLM: %s - %s",
+                error.response.status_code,
+                error.response.text,
+            )
+        else:
+            logger.exception("An unexpected error occurred in LLMClient")
 
 
 _llm_client = None
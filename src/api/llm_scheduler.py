@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from src.config import settings
+
+from .llm import get_llm_client
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета в порядке обслуживания
+PRIORITIES = ("high", "normal", "low")
+# Вес нового замера в скользящей оценке длительности генерации
+SERVICE_TIME_ALPHA = 0.2
+
+
+class LLMOverloadedError(Exception):
+    """
+    Запрос не может начать генерацию вовремя. status_code — 429 (превышен
+    лимит очереди пользователя) или 503 (перегрузка), retry_after — секунды.
+    """
+
+    def __init__(self, status_code: int, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class _Waiter:
+    __slots__ = ("user_id", "priority", "future")
+
+    def __init__(self, user_id: str, priority: str, future: asyncio.Future):
+        self.user_id = user_id
+        self.priority = priority
+        self.future = future
+
+
+class LLMAdmissionScheduler:
+    """
+    Допуск запросов к LLM. Одновременно генерируется не больше capacity ответов,
+    остальные ждут в ограниченной очереди. Очередь обслуживается строго по
+    классам приоритета, а внутри класса — по кругу между пользователями,
+    поэтому пользователь с множеством запросов не задерживает остальных.
+
+    Запрос отклоняется сразу, если очередь заполнена, у пользователя слишком
+    много ожидающих запросов или оценка ожидания превышает LLM_QUEUE_TIMEOUT_SECONDS,
+    и после ожидания, если слот так и не освободился за это время.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        max_queue: Optional[int] = None,
+        max_per_user: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.capacity = capacity
+        self.max_queue = max_queue or settings.LLM_QUEUE_MAX_SIZE
+        self.max_per_user = max_per_user or settings.LLM_QUEUE_MAX_PER_USER
+        self.timeout = timeout if timeout is not None else settings.LLM_QUEUE_TIMEOUT_SECONDS
+
+        self.active = 0
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            p: OrderedDict() for p in PRIORITIES
+        }
+        self._queued = 0
+        self._queued_per_user: Dict[str, int] = defaultdict(int)
+        self._service_ms: Optional[float] = None
+
+        # Статистика
+        self.admitted = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, priority: str = "normal") -> AsyncIterator[float]:
+        """Занимает слот генерации на время блока; возвращает время ожидания в мс."""
+        wait_ms = await self.acquire(user_id, priority)
+        start = time.monotonic()
+        try:
+            yield wait_ms
+        finally:
+            self.release((time.monotonic() - start) * 1000)
+
+    async def acquire(self, user_id: str, priority: str = "normal") -> float:
+        if priority not in PRIORITIES:
+            priority = "normal"
+        start = time.monotonic()
+
+        if self.active < self.capacity and self._queued == 0:
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+
+        if self._queued >= self.max_queue:
+            self._reject("queue_full", 503, "LLM queue is full.")
+        if self._queued_per_user[user_id] >= self.max_per_user:
+            self._reject(
+                "user_limit", 429, "Too many pending requests for this user."
+            )
+        estimate = self._estimated_wait(priority)
+        if estimate is not None and estimate > self.timeout:
+            self._reject(
+                "deadline", 503, "LLM is overloaded, the request would not start in time."
+            )
+
+        waiter = _Waiter(user_id, priority, asyncio.get_running_loop().create_future())
+        self._enqueue(waiter)
+        try:
+            await asyncio.wait({waiter.future}, timeout=self.timeout)
+        except BaseException:
+            # Отмена вызывающим (например, клиент закрыл соединение)
+            self._abandon(waiter)
+            raise
+
+        if not waiter.future.done():
+            self._abandon(waiter)
+            self._reject(
+                "deadline", 503, "LLM is overloaded, the request did not start in time."
+            )
+        self.admitted += 1
+        return (time.monotonic() - start) * 1000
+
+    def release(self, service_ms: Optional[float] = None):
+        if service_ms is not None:
+            self._service_ms = (
+                service_ms
+                if self._service_ms is None
+                else SERVICE_TIME_ALPHA * service_ms
+                + (1 - SERVICE_TIME_ALPHA) * self._service_ms
+            )
+        self.active -= 1
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": {
+                p: sum(len(q) for q in users.values()) for p, users in self._queues.items()
+            },
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "avg_generation_ms": self._service_ms,
+        }
+
+    def _enqueue(self, waiter: _Waiter):
+        users = self._queues[waiter.priority]
+        users.setdefault(waiter.user_id, deque()).append(waiter)
+        self._queued += 1
+        self._queued_per_user[waiter.user_id] += 1
+
+    def _dequeue(self, users: "OrderedDict[str, Deque[_Waiter]]", user_id: str) -> _Waiter:
+        queue = users[user_id]
+        waiter = queue.popleft()
+        if queue:
+            # Следующий запрос этого пользователя — после запросов остальных
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        self._queued -= 1
+        self._queued_per_user[user_id] -= 1
+        if not self._queued_per_user[user_id]:
+            del self._queued_per_user[user_id]
+        return waiter
+
+    def _dispatch(self):
+        while self.active < self.capacity and self._queued:
+            users = next(u for u in (self._queues[p] for p in PRIORITIES) if u)
+            waiter = self._dequeue(users, next(iter(users)))
+            self.active += 1
+            waiter.future.set_result(None)
+
+    def _abandon(self, waiter: _Waiter):
+        """Убирает ожидающего из очереди; если слот уже выдан — возвращает его."""
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.release()
+            return
+        waiter.future.cancel()
+        queue = self._queues[waiter.priority].get(waiter.user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.priority][waiter.user_id]
+            self._queued -= 1
+            self._queued_per_user[waiter.user_id] -= 1
+            if not self._queued_per_user[waiter.user_id]:
+                del self._queued_per_user[waiter.user_id]
+
+    def _estimated_wait(self, priority: str) -> Optional[float]:
+        """Оценка ожидания (сек) по числу запросов впереди и средней длительности генерации."""
+        if self._service_ms is None:
+            return None
+        ahead = 0
+        for p in PRIORITIES:
+            ahead += sum(len(q) for q in self._queues[p].values())
+            if p == priority:
+                break
+        return (ahead + 1) / self.capacity * self._service_ms / 1000
+
+    def _retry_after(self) -> int:
+        if self._service_ms is None:
+            return 1
+        return max(1, math.ceil((self._queued + 1) / self.capacity * self._service_ms / 1000))
+
+    def _reject(self, reason: str, status_code: int, detail: str):
+        self.rejected[reason] += 1
+        retry_after = self._retry_after()
+        logger.warning(
+            "LLM request rejected (%s): active=%d, queued=%d, retry after %ds",
+            reason,
+            self.active,
+            self._queued,
+            retry_after,
+        )
+        raise LLMOverloadedError(status_code, retry_after, detail)
+
+
+_llm_scheduler = None
+
+
+def get_llm_scheduler() -> LLMAdmissionScheduler:
+    """Синглтон планировщика: LLM_MAX_CONCURRENT_REQUESTS слотов на каждый LLM-сервер."""
+    global _llm_scheduler
+    if _llm_scheduler is None:
+        _llm_scheduler = LLMAdmissionScheduler(
+            settings.LLM_MAX_CONCURRENT_REQUESTS * len(get_llm_client().backends)
+        )
+    return _llm_scheduler
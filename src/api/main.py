@@ -1,10 +1,16 @@
 import logging
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from src.api.embedding_batcher import close_embedding_batcher
 from src.api.llm import close_llm_client, get_llm_client
-from src.api.reranker import get_reranker_model
+from src.api.llm_scheduler import LLMOverloadedError
+from src.api.rerank_cascade import get_rerank_cascade
+from src.api.rerank_scheduler import close_rerank_scheduler, get_rerank_scheduler
 from src.api.routes import router as api_router
+from src.api.services.history_writer import close_history_writer
 from src.ingestion.embedding import get_embedding_model
 from src.logging_config import setup_logging
 
@@ -26,7 +32,8 @@ async def startup_event():
     logger.info("Application startup: Initializing models...")
     # Инициализация происходит через get_... функции, которые кэшируются
     get_embedding_model()
-    get_reranker_model()
+    get_rerank_scheduler()
+    get_rerank_cascade()
     get_llm_client()
     logger.info("Models initialized.")
 
@@ -37,13 +44,39 @@ async def shutdown_event():
     Корректно закрывает соединения при остановке.
     """
     logger.info("Application shutdown: Closing resources...")
+    await close_embedding_batcher()
+    close_rerank_scheduler()
     await close_llm_client()
+    # После остановки приема запросов: дописываем буфер истории
+    await close_history_writer()
     logger.info("Resources closed.")
 
 
 app.include_router(api_router)
 
 
+@app.exception_handler(LLMOverloadedError)
+async def llm_overloaded_handler(request: Request, exc: LLMOverloadedError):
+    """
+    Перегрузка LLM: клиент получает 429/503 с Retry-After сразу,
+    а не ждет LLM_TIMEOUT в очереди.
+    """
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Метрики в формате Prometheus: задержки этапов, исходы ответов,
+    занятость слотов LLM, пул соединений БД, размеры батчей моделей.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/", tags=["Health Check"])
 def health_check():
     """
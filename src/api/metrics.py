@@ -0,0 +1,240 @@
+"""
+Метрики Prometheus (GET /metrics).
+
+Задержки этапов берутся из timings_ms, которые RAG-движок уже собирает для
+ответа, поэтому на пути запроса добавляется только наблюдение гистограмм.
+Состояние очередей, пулов и батчей читается из stats() компонентов в момент
+сбора метрик (RuntimeCollector) и не стоит ничего между сборами.
+
+Метрики хранятся в памяти процесса: при нескольких воркерах uvicorn каждый
+отдает свои значения.
+"""
+
+from typing import Any, Dict, Iterator, Optional
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from src.db.session import async_engine
+
+from . import embedding_batcher, llm, llm_scheduler, rerank_scheduler
+from .services import history_writer
+
+# Этапы из timings_ms, для которых строятся гистограммы
+STAGES = ("embed", "retrieve", "rerank", "queue", "llm", "total")
+
+# От единиц миллисекунд (поиск, кэш) до минут (генерация LLM)
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_latency_seconds",
+    "Latency of RAG pipeline stages.",
+    ["endpoint", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+RESPONSES = Counter(
+    "rag_responses_total",
+    "RAG responses by outcome: answer, fallback_no_documents, fallback_low_confidence.",
+    ["endpoint", "outcome"],
+)
+SEMANTIC_CACHE_HITS = Counter(
+    "rag_semantic_cache_hits_total",
+    "Responses served from the semantic answer cache.",
+    ["endpoint"],
+)
+
+
+def observe_response(endpoint: str, result: Dict[str, Any]):
+    """Учитывает тайминги и исход ответа RAG-движка (формат query)."""
+    timings = result.get("timings_ms") or {}
+    for stage in STAGES:
+        value = timings.get(stage)
+        if value:
+            STAGE_LATENCY.labels(endpoint, stage).observe(value / 1000)
+
+    warnings = result.get("warnings") or []
+    if "fallback" not in warnings:
+        outcome = "answer"
+    elif any(w.startswith("Confidence score") for w in warnings):
+        outcome = "fallback_low_confidence"
+    else:
+        outcome = "fallback_no_documents"
+    RESPONSES.labels(endpoint, outcome).inc()
+
+    if result.get("cache_source_id") is not None:
+        SEMANTIC_CACHE_HITS.labels(endpoint).inc()
+
+
+def observe_timings(endpoint: str, timings: Dict[str, float]):
+    """Учитывает только тайминги (для /search, где нет ответа LLM)."""
+    for stage in STAGES:
+        value = timings.get(stage)
+        if value:
+            STAGE_LATENCY.labels(endpoint, stage).observe(value / 1000)
+
+
+def _gauge(name: str, documentation: str, value: Optional[float] = None, labels=None):
+    metric = GaugeMetricFamily(name, documentation, labels=labels)
+    if value is not None:
+        metric.add_metric([], value)
+    return metric
+
+
+def _counter(name: str, documentation: str, labels=None):
+    return CounterMetricFamily(name, documentation, labels=labels)
+
+
+class RuntimeCollector(Collector):
+    """
+    Состояние компонентов на момент сбора: занятость слотов LLM и очереди
+    допуска, пул соединений БД, батчи моделей, попадания в кэши. Компоненты,
+    которые еще не созданы, пропускаются (сбор метрик не загружает модели).
+    """
+
+    def collect(self) -> Iterator[Any]:
+        yield from self._db_pool()
+        yield from self._llm()
+        yield from self._embedding()
+        yield from self._rerank()
+        yield from self._history()
+
+    def _db_pool(self):
+        pool = async_engine.pool
+        if not hasattr(pool, "checkedout"):
+            return
+        yield _gauge(
+            "rag_db_pool_checked_out", "DB connections checked out.", pool.checkedout()
+        )
+        yield _gauge("rag_db_pool_size", "DB pool size.", pool.size())
+        # overflow() отрицателен, пока пул не заполнен
+        yield _gauge(
+            "rag_db_pool_overflow", "DB overflow connections.", max(0, pool.overflow())
+        )
+
+    def _llm(self):
+        client = llm._llm_client
+        if client is not None:
+            in_flight = _gauge(
+                "rag_llm_backend_in_flight",
+                "LLM requests in flight per backend.",
+                labels=["backend"],
+            )
+            up = _gauge(
+                "rag_llm_backend_available",
+                "1 if the backend circuit is not open.",
+                labels=["backend"],
+            )
+            for backend in client.backends:
+                in_flight.add_metric([backend.base_url], backend.in_flight)
+                up.add_metric([backend.base_url], float(backend.state != "open"))
+            yield in_flight
+            yield up
+
+            stats = client.stats()
+            cache = stats["completion_cache"]
+            if cache is not None:
+                hits = _counter(
+                    "rag_completion_cache_hits",
+                    "LLM completion cache lookups by result.",
+                    labels=["result"],
+                )
+                hits.add_metric(["memory_hit"], cache["memory_hits"])
+                hits.add_metric(["db_hit"], cache["db_hits"])
+                hits.add_metric(["miss"], cache["misses"])
+                yield hits
+
+        scheduler = llm_scheduler._llm_scheduler
+        if scheduler is not None:
+            stats = scheduler.stats()
+            yield _gauge(
+                "rag_llm_slots_in_use", "LLM generation slots in use.", stats["active"]
+            )
+            yield _gauge(
+                "rag_llm_slots_capacity", "LLM generation slots.", stats["capacity"]
+            )
+            queued = _gauge(
+                "rag_llm_queue_depth",
+                "Requests waiting for an LLM slot.",
+                labels=["priority"],
+            )
+            for priority, depth in stats["queued"].items():
+                queued.add_metric([priority], depth)
+            yield queued
+            rejected = _counter(
+                "rag_llm_rejected",
+                "Requests rejected by LLM admission control.",
+                labels=["reason"],
+            )
+            for reason, count in stats["rejected"].items():
+                rejected.add_metric([reason], count)
+            yield rejected
+
+    def _embedding(self):
+        batcher = embedding_batcher._embedding_batcher
+        if batcher is None:
+            return
+        stats = batcher.stats()
+        yield _gauge(
+            "rag_embedding_queue_depth", "Queries waiting for embedding.", stats["queue_depth"]
+        )
+        yield _gauge(
+            "rag_embedding_last_batch_size",
+            "Size of the last embedding batch.",
+            stats["last_batch_size"],
+        )
+        yield _gauge(
+            "rag_embedding_avg_batch_size",
+            "Average embedding batch size.",
+            stats["avg_batch_size"],
+        )
+
+    def _rerank(self):
+        schedulers = {
+            "stage1": rerank_scheduler._stage1_scheduler,
+            "final": rerank_scheduler._rerank_scheduler,
+        }
+        pending = _gauge(
+            "rag_rerank_pending_pairs", "Pairs waiting for reranking.", labels=["model"]
+        )
+        last_batch = _gauge(
+            "rag_rerank_last_batch_size", "Size of the last rerank batch.", labels=["model"]
+        )
+        avg_batch = _gauge(
+            "rag_rerank_avg_batch_size", "Average rerank batch size.", labels=["model"]
+        )
+        cache_hits = _counter(
+            "rag_rerank_cache_lookups",
+            "Rerank score cache lookups by result.",
+            labels=["model", "result"],
+        )
+        for label, scheduler in schedulers.items():
+            if scheduler is None:
+                continue
+            stats = scheduler.stats()
+            pending.add_metric([label], stats["pending_pairs"])
+            last_batch.add_metric([label], stats["last_batch_size"])
+            avg_batch.add_metric([label], stats["avg_batch_size"])
+            cache = stats["cache"]
+            if cache is not None:
+                cache_hits.add_metric([label, "memory_hit"], cache["memory_hits"])
+                cache_hits.add_metric([label, "db_hit"], cache["db_hits"])
+                cache_hits.add_metric([label, "miss"], cache["misses"])
+        yield from (pending, last_batch, avg_batch, cache_hits)
+
+    def _history(self):
+        writer = history_writer._history_writer
+        if writer is None:
+            return
+        stats = writer.stats()
+        yield _gauge(
+            "rag_history_buffered", "History entries waiting to be written.", stats["buffered"]
+        )
+        dropped = _counter("rag_history_dropped", "History entries dropped.")
+        dropped.add_metric([], stats["dropped"])
+        yield dropped
+
+
+REGISTRY.register(RuntimeCollector())
@@ -2,19 +2,24 @@ import asyncio
 import logging
 import re
 import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Dict, List, cast
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union, cast
 
-from sqlalchemy import asc
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from transformers import AutoTokenizer
 
 from src.config import settings
-from src.db.models import Chunk, Document
 from src.ingestion.embedding import EmbeddingModel
 
+from .context_packer import pack_context
 from .llm import LLMClient
+from .llm_scheduler import LLMAdmissionScheduler, LLMOverloadedError
+from .rerank_cascade import RerankCascade
+from .rerank_scheduler import RerankScheduler
 from .reranker import RerankerModel
+from .retrieval import hybrid_search, vector_search, vector_search_batch
+from .semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
@@ -85,13 +90,20 @@ class RAGEngine:
         embedding_model: EmbeddingModel,
         reranker_model: RerankerModel,
         llm_client: LLMClient,
+        rerank_scheduler: RerankScheduler,
+        rerank_cascade: Optional[RerankCascade] = None,
+        llm_scheduler: Optional[LLMAdmissionScheduler] = None,
     ):
         self.embedding_model = embedding_model
         self.reranker_model = reranker_model
+        self.rerank_scheduler = rerank_scheduler
+        self.rerank_cascade = rerank_cascade
         self.llm = llm_client
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            reranker_model.model_name
-        )  # Используем ту же модель, что и ре-ранкер/эмбеддер
+        self.llm_scheduler = llm_scheduler
+        self.semantic_cache = SemanticCache()
+        # Токенизатор нужен только для отладочного логирования промпта
+        # и загружается при первом обращении
+        self._tokenizer = None
 
         # Загрузка промпта из внешнего файла
         prompt_path = Path(__file__).parent / "prompts" / "rag_template.txt"
@@ -101,9 +113,18 @@ class RAGEngine:
             logger.warning("rag_template.txt not found, using built-in prompt template.")
             self.prompt_template = DEFAULT_PROMPT
 
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            # Используем ту же модель, что и ре-ранкер/эмбеддер
+            self._tokenizer = AutoTokenizer.from_pretrained(
+                self.reranker_model.model_name
+            )
+        return self._tokenizer
+
     async def query(
         self,
-        db: Session,
+        db: AsyncSession,
         query_text: str,
         query_embedding: List[float],
         embed_time_ms: float,
@@ -111,27 +132,473 @@ class RAGEngine:
         top_k_final: int,
         min_confidence: float,
         temperature: float,
+        domain: Optional[str] = None,
+        user_id: str = "anonymous",
+        priority: str = "normal",
     ) -> Dict[str, Any]:
         start_time = time.time()
+        timings = self._init_timings(embed_time_ms)
 
-        # Эмбеддинг уже вычислен, замеряем только поиск
-        candidates = self._vector_search(db, query_embedding, top_k_initial)
-        retrieve_time = time.time() - start_time
+        cached = await self._lookup_cache(
+            db, query_embedding, domain, min_confidence, timings
+        )
+        if cached is not None:
+            cached["timings_ms"] = {**timings, "total": (time.time() - start_time) * 1000}
+            return cached
 
-        if not candidates:
+        final_chunks = await self._retrieve_context(
+            db, query_text, query_embedding, top_k_initial, top_k_final, domain, timings
+        )
+        if final_chunks is None:
             return self._generate_fallback_response(
                 [], "No relevant documents found.", embed_time_ms=embed_time_ms
             )
 
+        prompt = self._build_prompt(query_text, final_chunks)
+
+        llm_start_time = time.time()
+        # Ответ из кэша не занимает слот генерации
+        llm_response_text = await self.llm.cached_completion(prompt, temperature)
+        if llm_response_text is None:
+            async with self._llm_slot(user_id, priority, timings):
+                llm_start_time = time.time()
+                llm_response_text = await self.llm.generate(
+                    prompt, temperature, check_cache=False
+                )
+        timings["llm"] = (time.time() - llm_start_time) * 1000
+
+        return self._finalize_response(
+            llm_response_text, final_chunks, min_confidence, timings, start_time
+        )
+
+    async def query_stream(
+        self,
+        db: AsyncSession,
+        query_text: str,
+        query_embedding: List[float],
+        embed_time_ms: float,
+        top_k_initial: int,
+        top_k_final: int,
+        min_confidence: float,
+        temperature: float,
+        domain: Optional[str] = None,
+        user_id: str = "anonymous",
+        priority: str = "normal",
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Потоковый вариант query. Отдает события в порядке:
+        sources — источники, переданные LLM (до начала генерации);
+        token — очередной фрагмент ответа;
+        summary — итоговый результат в формате query (проверенные цитаты,
+        уверенность, timings_ms).
+        """
+        start_time = time.time()
+        timings = self._init_timings(embed_time_ms)
+
+        cached = await self._lookup_cache(
+            db, query_embedding, domain, min_confidence, timings
+        )
+        if cached is not None:
+            yield {"event": "sources", "data": cached["sources"]}
+            yield {"event": "token", "data": cached["response_md"]}
+            cached["timings_ms"] = {**timings, "total": (time.time() - start_time) * 1000}
+            yield {"event": "summary", "data": cached}
+            return
+
+        final_chunks = await self._retrieve_context(
+            db, query_text, query_embedding, top_k_initial, top_k_final, domain, timings
+        )
+        if final_chunks is None:
+            yield {
+                "event": "summary",
+                "data": self._generate_fallback_response(
+                    [], "No relevant documents found.", embed_time_ms=embed_time_ms
+                ),
+            }
+            return
+
+        yield {"event": "sources", "data": self._annotate_sources(final_chunks)}
+
+        prompt = self._build_prompt(query_text, final_chunks)
+
+        llm_start_time = time.time()
+        parts: List[str] = []
+        # Ответ из кэша не занимает слот генерации
+        cached_text = await self.llm.cached_completion(prompt, temperature)
+        if cached_text is not None:
+            timings["first_token"] = (time.time() - llm_start_time) * 1000
+            parts.append(cached_text)
+            yield {"event": "token", "data": cached_text}
+        else:
+            async with self._llm_slot(user_id, priority, timings):
+                llm_start_time = time.time()
+                async for delta in self.llm.generate_stream(
+                    prompt, temperature, check_cache=False
+                ):
+                    if not parts:
+                        timings["first_token"] = (time.time() - llm_start_time) * 1000
+                    parts.append(delta)
+                    yield {"event": "token", "data": delta}
+        timings["llm"] = (time.time() - llm_start_time) * 1000
+
+        yield {
+            "event": "summary",
+            "data": self._finalize_response(
+                "".join(parts), final_chunks, min_confidence, timings, start_time
+            ),
+        }
+
+    async def search(
+        self,
+        db: AsyncSession,
+        query_text: str,
+        query_embedding: List[float],
+        embed_time_ms: float,
+        top_k_initial: int,
+        top_k: int,
+        domain: Optional[str] = None,
+        retrieval_mode: Optional[str] = None,
+        rerank: Optional[bool] = None,
+        latency_budget_ms: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Поиск без генерации ответа: кандидаты из индекса, по желанию
+        ре-ранжированные, без порога уверенности и упаковки контекста.
+        LLM и очередь допуска к ней не используются.
+
+        latency_budget_ms — бюджет на весь поиск, включая эмбеддинг. Ре-ранжирование
+        пропускается, если бюджет уже исчерпан, и прерывается, если не укладывается
+        в остаток; тогда результаты возвращаются в порядке поиска с предупреждением.
+        """
+        start_time = time.time()
+        timings = {"embed": embed_time_ms, "retrieve": 0.0, "rerank": 0.0}
+        warnings: List[str] = []
+        retrieval_mode = retrieval_mode or settings.RETRIEVAL_MODE
+        if rerank is None:
+            rerank = settings.ENABLE_RERANKER
+
+        candidates = await self._retrieve(
+            db, query_text, query_embedding, top_k_initial, domain, timings, retrieval_mode
+        )
+
+        reranked = False
+        if rerank and candidates:
+            remaining_ms = None
+            if latency_budget_ms is not None:
+                elapsed_ms = embed_time_ms + (time.time() - start_time) * 1000
+                remaining_ms = latency_budget_ms - elapsed_ms
+            if remaining_ms is not None and remaining_ms <= 0:
+                warnings.append("Rerank skipped: latency budget exhausted by retrieval.")
+            else:
+                rerank_start_time = time.time()
+                try:
+                    candidates = await asyncio.wait_for(
+                        # Копии: прерванное ре-ранжирование не оставляет частичных оценок
+                        self._rerank(db, query_text, [dict(c) for c in candidates], timings),
+                        remaining_ms / 1000 if remaining_ms is not None else None,
+                    )
+                    reranked = True
+                except asyncio.TimeoutError:
+                    await db.rollback()
+                    warnings.append("Rerank skipped: it did not fit into the latency budget.")
+                timings["rerank"] = (time.time() - rerank_start_time) * 1000
+
+        return {
+            "results": self._annotate_sources(candidates[:top_k]),
+            "retrieval_mode": retrieval_mode,
+            "reranked": reranked,
+            "timings_ms": {**timings, "total": (time.time() - start_time) * 1000},
+            "warnings": warnings,
+        }
+
+    async def query_batch(
+        self,
+        db: AsyncSession,
+        queries: List[Dict[str, Any]],
+        query_embeddings: List[List[float]],
+        embed_time_ms: float,
+        user_id: str = "anonymous",
+        priority: str = "low",
+    ) -> AsyncIterator[Tuple[int, Union[Dict[str, Any], Exception]]]:
+        """
+        Пакетный вариант query для офлайн-задач. queries — аргументы query
+        (query_text, top_k_initial, top_k_final, min_confidence, temperature,
+        domain) для каждого запроса, эмбеддинги вычислены заранее одним вызовом.
+
+        Поиск выполняется одним SQL-запросом на всю пачку (в режиме hybrid —
+        по запросу в той же сессии). Ре-ранжирование идет параллельно: RerankScheduler
+        сливает пары разных запросов в общие батчи. Генерация занимает не больше
+        слотов, чем отведено LLM, и проходит через очередь допуска; при перегрузке
+        запрос повторяется через Retry-After до QUERY_BATCH_OVERLOAD_RETRIES раз.
+
+        Отдает пары (индекс запроса, результат в формате query) в порядке
+        готовности; ошибка отдельного запроса отдается вместо результата.
+        """
+        start_time = time.time()
+        all_timings = [self._init_timings(embed_time_ms) for _ in queries]
+
+        pending: List[int] = []
+        for i, (params, embedding) in enumerate(
+            zip(queries, query_embeddings, strict=True)
+        ):
+            cached = await self._lookup_cache(
+                db, embedding, params.get("domain"), params["min_confidence"], all_timings[i]
+            )
+            if cached is not None:
+                cached["timings_ms"] = {
+                    **all_timings[i],
+                    "total": (time.time() - start_time) * 1000,
+                }
+                yield i, cached
+            else:
+                pending.append(i)
+        if not pending:
+            return
+
+        retrieve_start_time = time.time()
+        if settings.RETRIEVAL_MODE == "hybrid":
+            candidates = []
+            for i in pending:
+                found, leg_timings = await hybrid_search(
+                    db,
+                    queries[i]["query_text"],
+                    query_embeddings[i],
+                    queries[i]["top_k_initial"],
+                    queries[i].get("domain"),
+                )
+                all_timings[i].update(leg_timings)
+                candidates.append(found)
+        else:
+            candidates = await vector_search_batch(
+                db,
+                [query_embeddings[i] for i in pending],
+                [queries[i]["top_k_initial"] for i in pending],
+                [queries[i].get("domain") for i in pending],
+            )
+        # Дальше соединение не нужно: ре-ранжирование и генерация идут без БД
+        await db.commit()
+        # Поиск общий: каждому запросу записывается время всей пачки
+        retrieve_ms = (time.time() - retrieve_start_time) * 1000
+        for i in pending:
+            all_timings[i]["retrieve"] = retrieve_ms
+
+        llm_slots = asyncio.Semaphore(self._llm_capacity())
+        tasks = [
+            asyncio.ensure_future(
+                self._answer_batch_item(
+                    i, queries[i], found, all_timings[i], llm_slots, user_id, priority, start_time
+                )
+            )
+            for i, found in zip(pending, candidates, strict=True)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Клиент мог закрыть соединение: оставшиеся запросы больше не нужны
+            for task in tasks:
+                task.cancel()
+
+    async def _answer_batch_item(
+        self,
+        index: int,
+        params: Dict[str, Any],
+        candidates: List[Dict],
+        timings: Dict[str, float],
+        llm_slots: asyncio.Semaphore,
+        user_id: str,
+        priority: str,
+        start_time: float,
+    ) -> Tuple[int, Union[Dict[str, Any], Exception]]:
+        try:
+            if not candidates:
+                return index, self._generate_fallback_response(
+                    [], "No relevant documents found.", embed_time_ms=timings["embed"]
+                )
+            final_chunks = await self._rerank_and_pack(
+                None, params["query_text"], candidates, params["top_k_final"], timings
+            )
+            prompt = self._build_prompt(params["query_text"], final_chunks)
+
+            llm_start_time = time.time()
+            llm_response_text = await self.llm.cached_completion(
+                prompt, params["temperature"]
+            )
+            if llm_response_text is None:
+                async with llm_slots:
+                    llm_response_text = await self._generate_with_overload_retries(
+                        prompt, params["temperature"], user_id, priority, timings
+                    )
+            else:
+                timings["llm"] = (time.time() - llm_start_time) * 1000
+
+            return index, self._finalize_response(
+                llm_response_text, final_chunks, params["min_confidence"], timings, start_time
+            )
+        except Exception as e:
+            logger.warning("Batch query %d failed: %s", index, e)
+            return index, e
+
+    async def _generate_with_overload_retries(
+        self,
+        prompt: str,
+        temperature: float,
+        user_id: str,
+        priority: str,
+        timings: Dict[str, float],
+    ) -> str:
+        retries = 0
+        while True:
+            try:
+                async with self._llm_slot(user_id, priority, timings):
+                    llm_start_time = time.time()
+                    text = await self.llm.generate(prompt, temperature, check_cache=False)
+                    timings["llm"] = (time.time() - llm_start_time) * 1000
+                    return text
+            except LLMOverloadedError as e:
+                retries += 1
+                if retries > settings.QUERY_BATCH_OVERLOAD_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    def _llm_capacity(self) -> int:
+        """Сколько генераций пачка может вести одновременно."""
+        if self.llm_scheduler is not None:
+            return self.llm_scheduler.capacity
+        return settings.LLM_MAX_CONCURRENT_REQUESTS * len(self.llm.backends)
+
+    def _init_timings(self, embed_time_ms: float) -> Dict[str, float]:
+        return {
+            "embed": embed_time_ms,
+            "retrieve": 0,
+            "rerank": 0,
+            "queue": 0,
+            "llm": 0,
+            "cache": 0,
+        }
+
+    @asynccontextmanager
+    async def _llm_slot(
+        self, user_id: str, priority: str, timings: Dict[str, float]
+    ) -> AsyncIterator[None]:
+        """
+        Ожидание слота генерации в LLMAdmissionScheduler (если он задан).
+        При перегрузке выбрасывает LLMOverloadedError.
+        """
+        if self.llm_scheduler is None:
+            yield
+            return
+        async with self.llm_scheduler.admit(user_id, priority) as wait_ms:
+            timings["queue"] = wait_ms
+            yield
+
+    async def _lookup_cache(
+        self,
+        db: AsyncSession,
+        query_embedding: List[float],
+        domain: Optional[str],
+        min_confidence: float,
+        timings: Dict[str, float],
+    ) -> Optional[Dict[str, Any]]:
+        if not self.semantic_cache.enabled:
+            return None
+        cache_start_time = time.time()
+        cached = await self.semantic_cache.lookup(
+            db, query_embedding, domain, min_confidence
+        )
+        timings["cache"] = (time.time() - cache_start_time) * 1000
+        return cached
+
+    async def _retrieve_context(
+        self,
+        db: AsyncSession,
+        query_text: str,
+        query_embedding: List[float],
+        top_k_initial: int,
+        top_k_final: int,
+        domain: Optional[str],
+        timings: Dict[str, float],
+    ) -> Optional[List[Dict]]:
+        """
+        Поиск и ре-ранжирование. Возвращает чанки для контекста LLM
+        или None, если поиск ничего не нашел.
+        """
+        candidates = await self._retrieve(
+            db, query_text, query_embedding, top_k_initial, domain, timings
+        )
+        if not candidates:
+            return None
+
+        return await self._rerank_and_pack(
+            db, query_text, candidates, top_k_final, timings
+        )
+
+    async def _retrieve(
+        self,
+        db: AsyncSession,
+        query_text: str,
+        query_embedding: List[float],
+        top_k_initial: int,
+        domain: Optional[str],
+        timings: Dict[str, float],
+        retrieval_mode: Optional[str] = None,
+    ) -> List[Dict]:
+        """Поиск кандидатов (по умолчанию в режиме RETRIEVAL_MODE)."""
+        # Эмбеддинг уже вычислен, замеряем только поиск
+        retrieve_start_time = time.time()
+        if (retrieval_mode or settings.RETRIEVAL_MODE) == "hybrid":
+            candidates, leg_timings = await hybrid_search(
+                db, query_text, query_embedding, top_k_initial, domain
+            )
+            timings.update(leg_timings)
+        else:
+            candidates = await vector_search(db, query_embedding, top_k_initial, domain)
+        # Завершаем читающую транзакцию: соединение возвращается в пул
+        # и не удерживается на время ре-ранжирования и генерации LLM
+        await db.commit()
+        timings["retrieve"] = (time.time() - retrieve_start_time) * 1000
+        return candidates
+
+    async def _rerank(
+        self,
+        db: Optional[AsyncSession],
+        query_text: str,
+        candidates: List[Dict],
+        timings: Dict[str, float],
+    ) -> List[Dict]:
+        """Ре-ранжирование каскадом или одной моделью через общий планировщик."""
+        if self.rerank_cascade is not None:
+            reranked_chunks = await self.rerank_cascade.rerank(
+                query_text, candidates, db, timings
+            )
+        else:
+            reranked_chunks = await self.rerank_scheduler.rerank(
+                query_text, candidates, db
+            )
+        if db is not None:
+            # Кэш оценок мог открыть транзакцию — освобождаем соединение до LLM
+            await db.commit()
+        self._log_chunks(reranked_chunks, "After Reranking", "rerank_score")
+        return reranked_chunks
+
+    async def _rerank_and_pack(
+        self,
+        db: Optional[AsyncSession],
+        query_text: str,
+        candidates: List[Dict],
+        top_k_final: int,
+        timings: Dict[str, float],
+    ) -> List[Dict]:
+        """
+        Ре-ранжирование кандидатов, отсечение по порогу и упаковка в бюджет контекста.
+        Без db общий (PostgreSQL) уровень кэша оценок не используется.
+        """
         self._log_chunks(candidates, "Initial retrieval", "similarity")
 
         rerank_time_start = time.time()
 
         if settings.ENABLE_RERANKER:
-            reranked_chunks = await asyncio.to_thread(
-                self.reranker_model.rerank, query_text, candidates
-            )
-            self._log_chunks(reranked_chunks, "After Reranking", "rerank_score")
+            reranked_chunks = await self._rerank(db, query_text, candidates, timings)
         else:
             logger.info("Reranking is disabled. Using similarity scores.")
             # Для совместимости с остальным кодом, который ожидает 'rerank_score'
@@ -145,15 +612,17 @@ class RAGEngine:
         confident_chunks = [
             chunk for chunk in reranked_chunks if chunk.get("rerank_score", 0.0) > 0.5
         ]
-        final_chunks = confident_chunks[:top_k_final]
-        rerank_time = time.time() - rerank_time_start
-
-        prompt = self._build_prompt(query_text, final_chunks)
-
-        llm_start_time = time.time()
-        llm_response_text = await self.llm.generate(prompt, temperature)
-        llm_time = time.time() - llm_start_time
+        timings["rerank"] = (time.time() - rerank_time_start) * 1000
+        return pack_context(confident_chunks[:top_k_final])
 
+    def _finalize_response(
+        self,
+        llm_response_text: str,
+        final_chunks: List[Dict],
+        min_confidence: float,
+        timings: Dict[str, float],
+        start_time: float,
+    ) -> Dict[str, Any]:
         verified_sources = self._verify_citations(llm_response_text, final_chunks)
         confidence = self._calculate_confidence(verified_sources, llm_response_text)
 
@@ -165,7 +634,7 @@ class RAGEngine:
             return self._generate_fallback_response(
                 chunks=final_chunks,
                 warning=f"Confidence score {confidence:.2f} is below threshold {min_confidence}.",
-                embed_time_ms=embed_time_ms,
+                embed_time_ms=timings["embed"],
                 confidence=confidence,
                 total_time=total_time,
             )
@@ -174,40 +643,9 @@ class RAGEngine:
             "response_md": llm_response_text,
             "confidence_score": confidence,
             "sources": verified_sources,
-            "timings_ms": {
-                "embed": embed_time_ms,
-                "retrieve": retrieve_time * 1000,
-                "rerank": rerank_time * 1000,
-                "llm": llm_time * 1000,
-                "total": total_time * 1000,
-            },
+            "timings_ms": {**timings, "total": total_time * 1000},
         }
 
-    def _vector_search(
-        self, db: Session, query_embedding: List[float], top_k: int
-    ) -> List[Dict]:
-        # Используем косинусное расстояние, так как индекс создан с vector_cosine_ops
-        distance = (Chunk.embedding.cosine_distance(query_embedding)).label("distance")
-        results = (
-            db.query(Chunk, distance)
-            .join(Document)
-            .order_by(asc(distance))
-            .limit(top_k)
-            .all()
-        )
-
-        return [
-            {
-                "chunk_id": r.Chunk.id,
-                "document_id": r.Chunk.document_id,
-                "text": r.Chunk.chunk_text,
-                "title": r.Chunk.document.title,
-                "url": r.Chunk.document.source_url,
-                "similarity": max(0.0, 1.0 - float(r.distance)),
-            }
-            for r in results
-        ]
-
     def _build_prompt(self, query: str, chunks: List[Dict]) -> str:
         context = "\n\n---\n\n".join(
             [
@@ -218,20 +656,26 @@ class RAGEngine:
 
         prompt = self.prompt_template.format(query=query, context=context)
 
+        if logger.isEnabledFor(logging.DEBUG):
+            self._log_prompt(query, chunks, context)
+        return prompt
+
+    def _log_prompt(self, query: str, chunks: List[Dict], context: str):
         # --- Detailed Logging for Prompt ---
         logger.debug("LLM Prompt: user_query='%s', chunks_count=%d", query, len(chunks))
         for i, chunk in enumerate(chunks):
             token_count = len(self.tokenizer.encode(chunk["text"]))
             logger.debug(
-                "  - Chunk %d (rerank_score=%.4f, tokens=%d)",
+                "  - Chunk %d (rerank_score=%.4f, tokens=%d, stored_tokens=%s, truncated=%s)",
                 i + 1,
                 chunk.get("rerank_score", 0.0),
                 token_count,
+                chunk.get("token_count"),
+                chunk.get("truncated", False),
             )
         logger.debug(
             "Total tokens in context: %d", len(self.tokenizer.encode(context))
         )
-        return prompt
 
     def _verify_citations(self, response_text: str, chunks: List[Dict]) -> List[Dict]:
         cited_indices = set()
@@ -253,9 +697,14 @@ class RAGEngine:
 
         logger.debug("[DEBUG: Citations] Found indices: %s", cited_indices)
 
+        for chunk in self._annotate_sources(chunks):
+            chunk["cited"] = chunk["source_id"] in cited_indices
+        return chunks
+
+    def _annotate_sources(self, chunks: List[Dict]) -> List[Dict]:
+        """Проставляет номера источников (как в промпте) и краткие фрагменты."""
         for i, chunk in enumerate(chunks):
             chunk["source_id"] = i + 1
-            chunk["cited"] = (i + 1) in cited_indices
             chunk["excerpt"] = chunk["text"][:200] + "..."
         return chunks
 
@@ -0,0 +1,171 @@
+import datetime
+import hashlib
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.db.models import RerankScore
+
+logger = logging.getLogger(__name__)
+
+
+def query_hash(query: str) -> bytes:
+    """
+    128-битный blake2b от нормализованного запроса. Регистр сохраняется:
+    для cased-моделей ре-ранжирования он влияет на оценку.
+    """
+    normalized = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+class RerankScoreCache:
+    """
+    Кэш оценок cross-encoder по ключу (модель, нормализованный запрос, chunk_id).
+    Первый уровень — ограниченный LRU в памяти процесса, второй (опционально) —
+    таблица rerank_score_cache в PostgreSQL, общая для всех воркеров.
+
+    При переиндексации чанк получает новый id, поэтому старые записи LRU
+    становятся недостижимыми и вытесняются, а записи в БД удаляются каскадно.
+    """
+
+    # Как часто (в записях) удалять устаревшие строки из таблицы кэша
+    PRUNE_EVERY = 1000
+
+    def __init__(self, model_name: str, max_entries: Optional[int] = None):
+        self.model_name = model_name
+        self.max_entries = max_entries or settings.RERANK_CACHE_MAX_ENTRIES
+        self.use_db = settings.RERANK_CACHE_DB_ENABLED
+        self.db_ttl = datetime.timedelta(seconds=settings.RERANK_CACHE_DB_TTL_SECONDS)
+
+        self._lru: "OrderedDict[Tuple[bytes, int], float]" = OrderedDict()
+        self._writes_since_prune = 0
+
+        # Статистика
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    async def get_many(
+        self,
+        query: str,
+        chunk_ids: Iterable[int],
+        db: Optional[AsyncSession] = None,
+    ) -> Dict[int, float]:
+        """Возвращает найденные в кэше оценки {chunk_id: score}."""
+        qhash = query_hash(query)
+        found: Dict[int, float] = {}
+        missing = []
+        for chunk_id in chunk_ids:
+            key = (qhash, chunk_id)
+            score = self._lru.get(key)
+            if score is None:
+                missing.append(chunk_id)
+            else:
+                self._lru.move_to_end(key)
+                found[chunk_id] = score
+        self.memory_hits += len(found)
+
+        from_db: Dict[int, float] = {}
+        if missing and self.use_db and db is not None:
+            from_db = await self._db_get(db, qhash, missing)
+            self.db_hits += len(from_db)
+            for chunk_id, score in from_db.items():
+                self._remember((qhash, chunk_id), score)
+            found.update(from_db)
+
+        self.misses += len(missing) - len(from_db)
+        return found
+
+    async def put_many(
+        self,
+        query: str,
+        scores: Dict[int, float],
+        db: Optional[AsyncSession] = None,
+    ):
+        """Сохраняет вычисленные оценки {chunk_id: score}."""
+        if not scores:
+            return
+        qhash = query_hash(query)
+        for chunk_id, score in scores.items():
+            self._remember((qhash, chunk_id), score)
+
+        if self.use_db and db is not None:
+            await self._db_put(db, qhash, scores)
+
+    def clear(self):
+        self._lru.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, key: Tuple[bytes, int], score: float):
+        self._lru[key] = score
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def _db_get(
+        self, db: AsyncSession, qhash: bytes, chunk_ids: list
+    ) -> Dict[int, float]:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - self.db_ttl
+        try:
+            result = await db.execute(
+                select(RerankScore.chunk_id, RerankScore.score).where(
+                    RerankScore.model_name == self.model_name,
+                    RerankScore.query_hash == qhash,
+                    RerankScore.chunk_id.in_(chunk_ids),
+                    RerankScore.created_at >= cutoff,
+                )
+            )
+            return {row.chunk_id: float(row.score) for row in result.all()}
+        except Exception as e:
+            # Кэш не должен ломать запрос
+            logger.warning("Rerank cache lookup failed: %s", e)
+            await db.rollback()
+            return {}
+
+    async def _db_put(self, db: AsyncSession, qhash: bytes, scores: Dict[int, float]):
+        stmt = insert(RerankScore).values(
+            [
+                {
+                    "model_name": self.model_name,
+                    "query_hash": qhash,
+                    "chunk_id": chunk_id,
+                    "score": score,
+                    "created_at": datetime.datetime.now(datetime.timezone.utc),
+                }
+                for chunk_id, score in scores.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["model_name", "query_hash", "chunk_id"],
+            set_={"score": stmt.excluded.score, "created_at": stmt.excluded.created_at},
+        )
+        try:
+            await db.execute(stmt)
+            self._writes_since_prune += len(scores)
+            if self._writes_since_prune >= self.PRUNE_EVERY:
+                self._writes_since_prune = 0
+                cutoff = datetime.datetime.now(datetime.timezone.utc) - self.db_ttl
+                await db.execute(
+                    delete(RerankScore).where(RerankScore.created_at < cutoff)
+                )
+            await db.commit()
+        except Exception as e:
+            # Например, чанк удален переиндексацией между поиском и записью
+            logger.warning("Rerank cache write failed: %s", e)
+            await db.rollback()
@@ -0,0 +1,101 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+
+from .rerank_scheduler import (
+    RerankScheduler,
+    get_rerank_scheduler,
+    get_stage1_rerank_scheduler,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RerankCascade:
+    """
+    Двухступенчатое ре-ранжирование. Быстрый cross-encoder оценивает всех
+    кандидатов, дорогая модель — только top_n лучших (и, если задан margin,
+    лишь тех, кто отстает от лучшей оценки первой ступени не больше чем на margin).
+
+    Возвращаются только выжившие с оценкой второй ступени в rerank_score:
+    оценки разных моделей несравнимы, и отсеянные кандидаты с оценкой первой
+    ступени нельзя ни упорядочить вместе с ними, ни проверить общим порогом
+    уверенности. Оценка первой ступени доступна в rerank_stage1_score.
+    """
+
+    def __init__(
+        self,
+        stage1: RerankScheduler,
+        stage2: RerankScheduler,
+        top_n: Optional[int] = None,
+        margin: Optional[float] = None,
+    ):
+        self.stage1 = stage1
+        self.stage2 = stage2
+        self.top_n = top_n or settings.RERANKER_CASCADE_TOP_N
+        self.margin = margin if margin is not None else settings.RERANKER_CASCADE_MARGIN
+
+    async def rerank(
+        self,
+        query: str,
+        chunks: List[Dict],
+        db: Optional[AsyncSession] = None,
+        timings: Optional[Dict[str, float]] = None,
+    ) -> List[Dict]:
+        """
+        Ре-ранжирует чанки каскадом. Если передан timings, в него записываются
+        rerank_stage1 и rerank_stage2 (мс).
+        """
+        if not chunks:
+            return []
+
+        stage1_start = time.time()
+        ranked = await self.stage1.rerank(query, chunks, db)
+        for chunk in ranked:
+            chunk["rerank_stage1_score"] = chunk["rerank_score"]
+        stage1_ms = (time.time() - stage1_start) * 1000
+
+        survivors = self._select_survivors(ranked)
+
+        stage2_start = time.time()
+        survivors = await self.stage2.rerank(query, survivors, db)
+        stage2_ms = (time.time() - stage2_start) * 1000
+
+        logger.info(
+            "Rerank cascade: %d candidates, %d survivors (stage1 %.1f ms, stage2 %.1f ms)",
+            len(ranked),
+            len(survivors),
+            stage1_ms,
+            stage2_ms,
+        )
+        if timings is not None:
+            timings["rerank_stage1"] = stage1_ms
+            timings["rerank_stage2"] = stage2_ms
+        return survivors
+
+    def _select_survivors(self, ranked: List[Dict]) -> List[Dict]:
+        """Префикс отсортированного списка, который уходит на вторую ступень."""
+        survivors = ranked[: self.top_n]
+        if self.margin is not None and survivors:
+            threshold = survivors[0]["rerank_stage1_score"] - self.margin
+            survivors = [c for c in survivors if c["rerank_stage1_score"] >= threshold]
+        return survivors
+
+
+_rerank_cascade = None
+
+
+def get_rerank_cascade() -> Optional[RerankCascade]:
+    """Синглтон каскада или None, если RERANKER_CASCADE выключен."""
+    global _rerank_cascade
+    if not settings.RERANKER_CASCADE:
+        return None
+    if _rerank_cascade is None:
+        _rerank_cascade = RerankCascade(
+            get_stage1_rerank_scheduler(), get_rerank_scheduler()
+        )
+    return _rerank_cascade
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+
+from .rerank_cache import RerankScoreCache
+from .reranker import (
+    RerankerModel,
+    apply_rerank_scores,
+    build_pairs,
+    get_reranker_model,
+    get_stage1_reranker_model,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _RerankJob:
+    """Пары одного запроса, ожидающие оценки в общем планировщике."""
+
+    def __init__(
+        self,
+        pairs: List[Tuple[str, str]],
+        loop: asyncio.AbstractEventLoop,
+        future: asyncio.Future,
+    ):
+        self.pairs = pairs
+        self.loop = loop
+        self.future = future
+        self.scores: List[float] = [0.0] * len(pairs)
+        self.next_index = 0  # Следующая пара, ещё не отправленная в батч
+        self.scored = 0
+        self.failed = False
+        self.enqueued_at = time.monotonic()
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None):
+        def _set():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+
+        try:
+            self.loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            # Event loop вызывающего уже закрыт
+            pass
+
+
+class RerankScheduler:
+    """
+    Планировщик ре-ранжирования с динамическим батчингом между запросами.
+    Пары (запрос, чанк) от параллельных запросов сливаются в общие батчи
+    размера RERANKER_BATCH_SIZE и оцениваются в одном выделенном потоке.
+    Батч набирается по одной паре от каждого запроса по кругу, поэтому
+    большой запрос не задерживает маленький.
+    Если задан cache, в модель отправляются только пары без сохраненной оценки.
+    """
+
+    def __init__(
+        self,
+        model: RerankerModel,
+        batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        cache: Optional[RerankScoreCache] = None,
+        name: str = "rerank-inference",
+        bucket_window: Optional[int] = None,
+    ):
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size or model.batch_size
+        # За один проход потоку отдается до bucket_window батчей: модель
+        # сортирует их пары по длине, и короткие чанки не дополняются до длинных
+        self.window = self.batch_size * (bucket_window or settings.RERANKER_BUCKET_WINDOW)
+        if max_wait_ms is None:
+            max_wait_ms = settings.RERANKER_BATCH_MAX_WAIT_MS
+        self.max_wait = max_wait_ms / 1000
+
+        self._jobs: Deque[_RerankJob] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Статистика
+        self._batches = 0
+        self._pairs = 0
+        self._last_batch_size = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True
+        )
+        self._thread.start()
+
+    async def rerank(
+        self, query: str, chunks: List[Dict], db: Optional[AsyncSession] = None
+    ) -> List[Dict]:
+        """
+        Асинхронный аналог RerankerModel.rerank через общий планировщик.
+        db нужна только для общего кэша оценок в PostgreSQL.
+        """
+        if not chunks:
+            return []
+
+        pairs = build_pairs(query, chunks)
+        if not pairs:
+            logger.warning("No valid (query, text) pairs found to rerank.")
+            for chunk in chunks:
+                chunk["rerank_score"] = 0.0
+            return chunks
+
+        valid_chunks = [chunk for chunk in chunks if chunk.get("text")]
+        scores = await self.score_chunks(query, valid_chunks, db)
+        return apply_rerank_scores(chunks, scores)
+
+    async def score_chunks(
+        self, query: str, chunks: List[Dict], db: Optional[AsyncSession] = None
+    ) -> List[float]:
+        """
+        Оценки для чанков с непустым текстом: из кэша, а промахи — через модель.
+        Чанки без chunk_id кэш не используют.
+        """
+        if self.cache is None:
+            return await self.score_pairs(build_pairs(query, chunks))
+
+        chunk_ids = [c["chunk_id"] for c in chunks if c.get("chunk_id") is not None]
+        cached = await self.cache.get_many(query, chunk_ids, db) if chunk_ids else {}
+
+        misses = [
+            i for i, c in enumerate(chunks) if c.get("chunk_id") not in cached
+        ]
+        scores = [cached.get(c.get("chunk_id"), 0.0) for c in chunks]
+        if misses:
+            computed = await self.score_pairs(
+                [(query, chunks[i]["text"]) for i in misses]
+            )
+            for i, score in zip(misses, computed, strict=True):
+                scores[i] = score
+            await self.cache.put_many(
+                query,
+                {
+                    chunks[i]["chunk_id"]: scores[i]
+                    for i in misses
+                    if chunks[i].get("chunk_id") is not None
+                },
+                db,
+            )
+        logger.debug(
+            "Rerank cache: %d of %d scores reused", len(chunks) - len(misses), len(chunks)
+        )
+        return scores
+
+    async def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Ставит пары в очередь и ожидает их оценки."""
+        if not pairs:
+            return []
+        loop = asyncio.get_running_loop()
+        job = _RerankJob(pairs, loop, loop.create_future())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Rerank scheduler is closed.")
+            self._jobs.append(job)
+            self._cond.notify()
+        return await job.future
+
+    def stats(self) -> Dict[str, Any]:
+        """Число ожидающих пар и заполненность батчей."""
+        with self._cond:
+            pending = sum(len(j.pairs) - j.next_index for j in self._jobs)
+            waiting_requests = len(self._jobs)
+        return {
+            "pending_pairs": pending,
+            "pending_requests": waiting_requests,
+            "batches": self._batches,
+            "pairs": self._pairs,
+            "last_batch_size": self._last_batch_size,
+            "avg_batch_size": self._pairs / self._batches if self._batches else 0.0,
+            "cache": self.cache.stats() if self.cache else None,
+        }
+
+    def close(self):
+        """Останавливает поток инференса; ожидающие запросы получают ошибку."""
+        with self._cond:
+            self._closed = True
+            jobs = list(self._jobs)
+            self._jobs.clear()
+            self._cond.notify_all()
+        for job in jobs:
+            job.resolve(error=RuntimeError("Rerank scheduler is closed."))
+        self._thread.join(timeout=5)
+
+    def _pending_pairs(self) -> int:
+        return sum(len(j.pairs) - j.next_index for j in self._jobs)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+                # Ждём заполнения батча, но не дольше max_wait от самого старого запроса
+                deadline = self._jobs[0].enqueued_at + self.max_wait
+                while self._pending_pairs() < self.batch_size and not self._closed:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+
+                batch = self._take_batch()
+
+            if batch:
+                self._run_batch(batch)
+
+    def _take_batch(self) -> List[Tuple[_RerankJob, int]]:
+        """Набирает батч по одной паре от каждого активного запроса по кругу."""
+        batch: List[Tuple[_RerankJob, int]] = []
+        while len(batch) < self.window and self._jobs:
+            for job in list(self._jobs):
+                if len(batch) >= self.window:
+                    break
+                if job.future.done():
+                    # Запрос отменён вызывающим — оставшиеся пары не считаем
+                    self._jobs.remove(job)
+                    continue
+                batch.append((job, job.next_index))
+                job.next_index += 1
+                if job.next_index == len(job.pairs):
+                    self._jobs.remove(job)
+        return batch
+
+    def _run_batch(self, batch: List[Tuple[_RerankJob, int]]):
+        pairs = [job.pairs[index] for job, index in batch]
+        self._batches += 1
+        self._pairs += len(pairs)
+        self._last_batch_size = len(pairs)
+
+        try:
+            scores = self.model.score_pairs(pairs)
+        except Exception as e:
+            logger.exception("Rerank batch of %d pairs failed", len(pairs))
+            failed_jobs = {id(job): job for job, _ in batch}.values()
+            with self._cond:
+                for job in failed_jobs:
+                    job.failed = True
+                    if job in self._jobs:
+                        self._jobs.remove(job)
+            for job in failed_jobs:
+                job.resolve(error=e)
+            return
+
+        for (job, index), score in zip(batch, scores, strict=True):
+            if job.failed:
+                continue
+            job.scores[index] = score
+            job.scored += 1
+            if job.scored == len(job.pairs):
+                job.resolve(result=job.scores)
+
+
+_rerank_scheduler = None
+_stage1_scheduler = None
+
+
+def _build_scheduler(model: RerankerModel, name: str) -> RerankScheduler:
+    cache = (
+        RerankScoreCache(model.model_name) if settings.RERANK_CACHE_ENABLED else None
+    )
+    return RerankScheduler(model, cache=cache, name=name)
+
+
+def get_rerank_scheduler() -> RerankScheduler:
+    """Возвращает синглтон-экземпляр планировщика ре-ранжирования."""
+    global _rerank_scheduler
+    if _rerank_scheduler is None:
+        _rerank_scheduler = _build_scheduler(get_reranker_model(), "rerank-inference")
+    return _rerank_scheduler
+
+
+def get_stage1_rerank_scheduler() -> RerankScheduler:
+    """Планировщик первой ступени каскада со своей моделью, батчем и кэшем."""
+    global _stage1_scheduler
+    if _stage1_scheduler is None:
+        _stage1_scheduler = _build_scheduler(
+            get_stage1_reranker_model(), "rerank-stage1-inference"
+        )
+    return _stage1_scheduler
+
+
+def close_rerank_scheduler():
+    for scheduler in (_stage1_scheduler, _rerank_scheduler):
+        if scheduler:
+            scheduler.close()
+    logger.info("Rerank scheduler closed.")
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from sentence_transformers import CrossEncoder
@@ -8,6 +8,13 @@ from src.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Запас под запрос и служебные токены, если RERANKER_MAX_LENGTH не задан
+RERANKER_QUERY_TOKENS = 64
+# Грубая оценка длины без токенизатора: символов на токен
+CHARS_PER_TOKEN = 4
+# model_max_length выше этого — заглушка токенизатора (длина не задана)
+_UNSET_MODEL_MAX_LENGTH = 100_000
+
 try:
     import onnxruntime
 except Exception as e:
@@ -20,14 +27,15 @@ class RerankerModel:
     Поддерживает как стандартные модели PyTorch, так и оптимизированные ONNX-модели.
     """
 
-    def __init__(self):
+    def __init__(self, model_name: Optional[str] = None, batch_size: Optional[int] = None):
         from numpy import __version__ as numpy_version
         from packaging.version import parse
 
-        self.model_name = settings.RERANKER_MODEL
+        self.model_name = model_name or settings.RERANKER_MODEL
         # Принудительно используем 'bge-reranker-base' для старого окружения,
-        # так как 'bge-reranker-v2-m3' не имеет стандартных файлов pytorch_model.bin
-        if parse(numpy_version) < parse("2.0.0"):
+        # так как 'bge-reranker-v2-m3' не имеет стандартных файлов pytorch_model.bin.
+        # Явно заданную модель (например, первую ступень каскада) не подменяем.
+        if model_name is None and parse(numpy_version) < parse("2.0.0"):
             logger.info(
                 "Legacy environment detected (numpy < 2.0). Forcing reranker model to 'cross-encoder/ms-marco-MiniLM-L12-v2'."
             )
@@ -35,14 +43,52 @@ class RerankerModel:
             self.model_name = "cross-encoder/ms-marco-MiniLM-L12-v2"
 
         self.device = settings.RERANKER_DEVICE
-        self.batch_size = settings.RERANKER_BATCH_SIZE
-        self.use_onnx = settings.RERANKER_ONNX
+        self.batch_size = batch_size or settings.RERANKER_BATCH_SIZE
+        # Чанк до CHUNK_SIZE токенов плюс запрос и служебные токены
+        self.max_length = settings.RERANKER_MAX_LENGTH or (
+            settings.CHUNK_SIZE + RERANKER_QUERY_TOKENS
+        )
+        self.last_padding_waste = 0.0
+
+        if settings.INFERENCE_BACKEND == "onnx":
+            from src.onnx_backend import OnnxCrossEncoder
+
+            # Локально экспортированная модель (scripts/export_onnx.py) на CPU
+            logger.info(
+                "Initializing reranker model %s with onnxruntime (CPU)...",
+                self.model_name,
+            )
+            self.device = "cpu"
+            self.use_onnx = True
+            self.model = OnnxCrossEncoder(self.model_name, max_length=self.max_length)
+            # Длина уже ограничена при экспорте (export.json)
+            self.max_length = self.model.max_length
+        else:
+            self.use_onnx = settings.RERANKER_ONNX
+            self.model = self._load_cross_encoder()
 
+        logger.info("Reranker model loaded successfully.")
+
+    def _load_cross_encoder(self) -> CrossEncoder:
+        """
+        CrossEncoder на PyTorch; с RERANKER_ONNX=True — с model.onnx из кэша
+        Hugging Face (режим gpu-legacy).
+        """
         if self.device == "cuda" and not torch.cuda.is_available():
             logger.warning("CUDA is not available for reranker. Falling back to CPU.")
             self.device = "cpu"
 
         model_to_load = self.model_name
+        # Пара длиннее позиционных эмбеддингов модели падает с ошибкой индекса
+        limit = model_input_limit(self.model_name)
+        if limit is not None and self.max_length > limit:
+            logger.info(
+                "Reranker max_length %d exceeds %s limit, clamping to %d.",
+                self.max_length,
+                self.model_name,
+                limit,
+            )
+            self.max_length = limit
 
         if self.use_onnx:
             logger.info("ONNX runtime enabled for reranker.")
@@ -79,30 +125,69 @@ class RerankerModel:
         )
         # Если используем ONNX, device должен быть None, так как провайдер указывается при создании сессии
         device_for_encoder = self.device if not self.use_onnx else None
-        self.model = CrossEncoder(
+        model = CrossEncoder(
             model_to_load,
             device=device_for_encoder,
+            max_length=self.max_length,
             automodel_args={"trust_remote_code": True},
         )
 
         if self.use_onnx:
             try:
                 if (
-                    hasattr(self.model, "model")
-                    and hasattr(self.model.model, "session")
-                    and self.model.model.session is not None
+                    hasattr(model, "model")
+                    and hasattr(model.model, "session")
+                    and model.model.session is not None
                 ):
                     provider = (
                         "CUDAExecutionProvider"
                         if self.device == "cuda"
                         else "CPUExecutionProvider"
                     )
-                    self.model.model.session.set_providers([provider])
+                    model.model.session.set_providers([provider])
             except AttributeError as e:
                 logger.warning("ONNX session provider configuration failed: %s", e)
                 self.use_onnx = False
 
-        logger.info("Reranker model loaded successfully.")
+        return model
+
+    def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """
+        Вычисляет оценки релевантности для пар (запрос, текст чанка).
+        Пары сортируются по оценке длины и оцениваются батчами близкой длины,
+        чтобы каждый батч дополнялся паддингом только до своей самой длинной пары.
+        Оценки возвращаются в исходном порядке пар.
+        """
+        if not pairs:
+            return []
+
+        lengths = [estimate_pair_tokens(q, t, self.max_length) for q, t in pairs]
+        buckets = length_buckets(lengths, self.batch_size)
+
+        scores = [0.0] * len(pairs)
+        for bucket in buckets:
+            # Cross-encoder напрямую возвращает оценки
+            bucket_scores = self.model.predict(
+                [pairs[i] for i in bucket],
+                show_progress_bar=False,
+                batch_size=len(bucket),
+            )
+            for i, score in zip(bucket, bucket_scores, strict=True):
+                scores[i] = float(score)
+
+        waste = padding_waste(lengths, buckets)
+        self.last_padding_waste = waste
+        logger.debug(
+            "Reranker %s: %d pairs in %d buckets, padding waste %.1f%% "
+            "(%.1f%% without bucketing)",
+            self.model_name,
+            len(pairs),
+            len(buckets),
+            waste * 100,
+            padding_waste(lengths, _sequential_batches(len(lengths), self.batch_size))
+            * 100,
+        )
+        return scores
 
     def rerank(self, query: str, chunks: List[Dict]) -> List[Dict]:
         """
@@ -112,7 +197,7 @@ class RerankerModel:
             return []
 
         # sentence-transformers ожидает пары [запрос, текст_чанка]
-        pairs = [(query, chunk["text"]) for chunk in chunks if chunk.get("text")]
+        pairs = build_pairs(query, chunks)
 
         if not pairs:
             logger.warning("No valid (query, text) pairs found to rerank.")
@@ -121,27 +206,87 @@ class RerankerModel:
             return chunks
 
         logger.info("Reranking %d candidates with cross-encoder...", len(pairs))
+        reranked_chunks = apply_rerank_scores(chunks, self.score_pairs(pairs))
+        logger.info("Reranking complete.")
+        return reranked_chunks
 
-        # Вычисляем оценки релевантности. Cross-encoder напрямую возвращает оценки.
-        scores = self.model.predict(
-            pairs, show_progress_bar=False, batch_size=self.batch_size
-        )
 
-        # Сопоставляем оценки с чанками, которые были отправлены на обработку
-        valid_chunks = [chunk for chunk in chunks if chunk.get("text")]
-        for chunk, score in zip(valid_chunks, scores, strict=True):
-            chunk["rerank_score"] = float(score)
+def model_input_limit(model_name: str) -> Optional[int]:
+    """
+    Максимальная длина входа модели: model_max_length токенизатора, а если
+    он не задан — max_position_embeddings из конфигурации модели.
+    """
+    from transformers import AutoConfig, AutoTokenizer
 
-        # Для отфильтрованных (невалидных) чанков устанавливаем score в 0
-        for chunk in chunks:
-            if "rerank_score" not in chunk:
-                chunk["rerank_score"] = 0.0
+    try:
+        limit = AutoTokenizer.from_pretrained(model_name).model_max_length
+        if limit < _UNSET_MODEL_MAX_LENGTH:
+            return int(limit)
+    except Exception as e:
+        logger.warning("Could not load tokenizer for %s: %s", model_name, e)
 
-        # Сортируем чанки по убыванию rerank_score
-        reranked_chunks = sorted(chunks, key=lambda x: x["rerank_score"], reverse=True)
+    try:
+        config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+    except Exception as e:
+        logger.warning("Could not load config for %s: %s", model_name, e)
+        return None
+    positions = getattr(config, "max_position_embeddings", None)
+    if positions and config.model_type in ("roberta", "xlm-roberta"):
+        # Позиции RoBERTa начинаются после padding_idx
+        positions -= 2
+    return positions
 
-        logger.info("Reranking complete.")
-        return reranked_chunks
+
+def estimate_pair_tokens(query: str, text: str, max_length: int) -> int:
+    """Оценка длины пары в токенах с учетом обрезки до max_length."""
+    # [CLS] запрос [SEP] текст [SEP]
+    estimate = (len(query) + len(text)) // CHARS_PER_TOKEN + 3
+    return min(estimate, max_length)
+
+
+def length_buckets(lengths: List[int], batch_size: int) -> List[List[int]]:
+    """
+    Разбивает индексы пар на батчи близкой длины: индексы сортируются по
+    длине и режутся на последовательные группы по batch_size.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def _sequential_batches(count: int, batch_size: int) -> List[List[int]]:
+    return [list(range(i, min(i + batch_size, count))) for i in range(0, count, batch_size)]
+
+
+def padding_waste(lengths: List[int], batches: List[List[int]]) -> float:
+    """Доля паддинга среди всех токенов батчей (по оценкам длины)."""
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    if not padded:
+        return 0.0
+    return 1 - sum(lengths) / padded
+
+
+def build_pairs(query: str, chunks: List[Dict]) -> List[Tuple[str, str]]:
+    """Пары (запрос, текст) для чанков с непустым текстом."""
+    return [(query, chunk["text"]) for chunk in chunks if chunk.get("text")]
+
+
+def apply_rerank_scores(chunks: List[Dict], scores: List[float]) -> List[Dict]:
+    """
+    Записывает оценки в чанки с непустым текстом (в порядке build_pairs)
+    и возвращает чанки, отсортированные по убыванию rerank_score.
+    """
+    # Сопоставляем оценки с чанками, которые были отправлены на обработку
+    valid_chunks = [chunk for chunk in chunks if chunk.get("text")]
+    for chunk, score in zip(valid_chunks, scores, strict=True):
+        chunk["rerank_score"] = float(score)
+
+    # Для отфильтрованных (невалидных) чанков устанавливаем score в 0
+    for chunk in chunks:
+        if "rerank_score" not in chunk:
+            chunk["rerank_score"] = 0.0
+
+    # Сортируем чанки по убыванию rerank_score
+    return sorted(chunks, key=lambda x: x["rerank_score"], reverse=True)
 
 
 _reranker_model = None
@@ -153,3 +298,17 @@ def get_reranker_model() -> RerankerModel:
     if _reranker_model is None:
         _reranker_model = RerankerModel()
     return _reranker_model
+
+
+_stage1_reranker_model = None
+
+
+def get_stage1_reranker_model() -> RerankerModel:
+    """Возвращает синглтон быстрой модели первой ступени каскада ре-ранжирования."""
+    global _stage1_reranker_model
+    if _stage1_reranker_model is None:
+        _stage1_reranker_model = RerankerModel(
+            model_name=settings.RERANKER_STAGE1_MODEL,
+            batch_size=settings.RERANKER_STAGE1_BATCH_SIZE,
+        )
+    return _stage1_reranker_model
@@ -0,0 +1,307 @@
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import (
+    Float,
+    Integer,
+    Select,
+    String,
+    TextClause,
+    bindparam,
+    select,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.db.models import Chunk, Document
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def vector_statement(with_domain: bool) -> Select:
+    """
+    Запрос векторного поиска, возвращающий только поля, нужные RAG-конвейеру.
+    Эмбеддинги и полный текст документов не передаются, документ
+    присоединяется в том же запросе (без ленивых подгрузок на каждый чанк).
+    Запрос собирается один раз: SQLAlchemy берет его из кэша компиляции,
+    а psycopg после DB_PREPARE_THRESHOLD выполнений делает его prepared.
+    """
+    # Используем косинусное расстояние, так как индекс создан с vector_cosine_ops
+    distance = Chunk.embedding.cosine_distance(
+        bindparam("embedding", type_=Vector(settings.EMBEDDING_DIM))
+    ).label("distance")
+    stmt = select(
+        Chunk.id.label("chunk_id"),
+        Chunk.document_id,
+        Chunk.chunk_text.label("text"),
+        Chunk.token_count,
+        Document.title,
+        Document.source_url.label("url"),
+        Document.domain,
+        distance,
+    ).join(Document, Document.id == Chunk.document_id)
+    if with_domain:
+        stmt = stmt.where(Document.domain == bindparam("domain", type_=String))
+    return stmt.order_by(distance).limit(bindparam("top_k", type_=Integer))
+
+
+def _candidate(row) -> Dict:
+    return {
+        "chunk_id": row.chunk_id,
+        "document_id": row.document_id,
+        "text": row.text,
+        "token_count": row.token_count,
+        "title": row.title,
+        "url": row.url,
+        "domain": row.domain,
+        "similarity": max(0.0, 1.0 - float(row.distance)),
+    }
+
+
+async def vector_search(
+    db: AsyncSession,
+    query_embedding: List[float],
+    top_k: int,
+    domain: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Векторный поиск по HNSW-индексу за один запрос к БД.
+    """
+    params = {"embedding": query_embedding, "top_k": top_k}
+    if domain:
+        params["domain"] = domain
+    result = await db.execute(vector_statement(bool(domain)), params)
+    return [_candidate(r) for r in result.all()]
+
+
+# Векторный поиск для нескольких запросов сразу: массивы эмбеддингов, доменов
+# и лимитов разворачиваются в строки, и для каждой LATERAL-подзапрос
+# выполняет обычный поиск по HNSW-индексу
+_BATCH_VECTOR_SQL = text(
+    """
+SELECT
+    q.ord - 1 AS query_index,
+    n.chunk_id,
+    n.document_id,
+    n.text,
+    n.token_count,
+    n.title,
+    n.url,
+    n.domain,
+    n.distance
+FROM unnest(
+    CAST(:embeddings AS vector[]),
+    CAST(:domains AS text[]),
+    CAST(:top_ks AS integer[])
+) WITH ORDINALITY AS q(embedding, domain, top_k, ord)
+CROSS JOIN LATERAL (
+    SELECT
+        c.id AS chunk_id,
+        c.document_id,
+        c.chunk_text AS text,
+        c.token_count,
+        d.title,
+        d.source_url AS url,
+        d.domain,
+        c.embedding <=> q.embedding AS distance
+    FROM chunks c
+    JOIN documents d ON d.id = c.document_id
+    WHERE q.domain IS NULL OR d.domain = q.domain
+    ORDER BY c.embedding <=> q.embedding
+    LIMIT q.top_k
+) AS n
+ORDER BY q.ord, n.distance
+"""
+)
+
+
+async def vector_search_batch(
+    db: AsyncSession,
+    query_embeddings: List[List[float]],
+    top_ks: List[int],
+    domains: List[Optional[str]],
+) -> List[List[Dict]]:
+    """
+    Векторный поиск для пачки запросов одним SQL-запросом.
+
+    Returns:
+        Кандидаты для каждого запроса, в порядке query_embeddings
+    """
+    params = {
+        # Текстовое представление pgvector приводится к vector[] на сервере
+        "embeddings": ["[" + ",".join(map(str, e)) + "]" for e in query_embeddings],
+        "domains": [d or None for d in domains],
+        "top_ks": top_ks,
+    }
+    result = await db.execute(_BATCH_VECTOR_SQL, params)
+    candidates: List[List[Dict]] = [[] for _ in query_embeddings]
+    for row in result.all():
+        candidates[row.query_index].append(_candidate(row))
+    return candidates
+
+# Итоговая оценка кандидата для каждого способа слияния.
+# rrf — reciprocal rank fusion по рангам в каждой ветке;
+# weighted — взвешенная сумма косинусного сходства и нормированного ts_rank_cd.
+_FUSION_SCORES = {
+    "rrf": (
+        "COALESCE(:vector_weight / (:rrf_k + v.rnk), 0)"
+        " + COALESCE(:fts_weight / (:rrf_k + f.rnk), 0)"
+    ),
+    "weighted": (
+        "COALESCE(:vector_weight * (1 - v.distance), 0)"
+        " + COALESCE(:fts_weight * f.rank_norm, 0)"
+    ),
+}
+
+_HYBRID_SQL = """
+WITH
+vec AS MATERIALIZED (
+    SELECT id, distance, row_number() OVER (ORDER BY distance) AS rnk
+    FROM (
+        -- ORDER BY distance LIMIT n обслуживается HNSW-индексом idx_chunks_embedding_hnsw
+        SELECT c.id, c.embedding <=> CAST(:embedding AS vector) AS distance
+        FROM chunks c {domain_join}
+        ORDER BY distance
+        LIMIT :vector_limit
+    ) AS nearest
+),
+vec_mark AS MATERIALIZED (
+    SELECT clock_timestamp() AS done, count(*) AS hits FROM vec
+),
+fts AS MATERIALIZED (
+    SELECT
+        id,
+        rank / NULLIF(max(rank) OVER (), 0) AS rank_norm,
+        row_number() OVER (ORDER BY rank DESC) AS rnk
+    FROM (
+        -- Полнотекстовая ветка по GIN-индексу idx_chunks_fts
+        SELECT c.id, ts_rank_cd(c.chunk_text_tsv, q.query) AS rank
+        FROM chunks c {domain_join}
+        CROSS JOIN websearch_to_tsquery('english', :query_text) AS q(query)
+        WHERE c.chunk_text_tsv @@ q.query
+          -- Одноразовый фильтр: ветка стартует только после векторной,
+          -- поэтому отметки времени делят время выполнения между ветками
+          AND (SELECT done FROM vec_mark) IS NOT NULL
+        ORDER BY rank DESC
+        LIMIT :fts_limit
+    ) AS matched
+),
+fts_mark AS MATERIALIZED (
+    SELECT clock_timestamp() AS done, count(*) AS hits FROM fts
+),
+fused AS (
+    SELECT
+        COALESCE(v.id, f.id) AS id,
+        v.distance,
+        {fusion_score} AS score
+    FROM vec v
+    FULL OUTER JOIN fts f ON f.id = v.id
+    ORDER BY score DESC
+    LIMIT :top_k
+)
+SELECT
+    c.id AS chunk_id,
+    c.document_id,
+    c.chunk_text AS text,
+    c.token_count,
+    d.title,
+    d.source_url AS url,
+    d.domain,
+    COALESCE(fused.distance, c.embedding <=> CAST(:embedding AS vector)) AS distance,
+    fused.score AS fusion_score,
+    vm.hits AS vector_hits,
+    fm.hits AS fts_hits,
+    EXTRACT(EPOCH FROM vm.done - statement_timestamp()) * 1000 AS vector_ms,
+    EXTRACT(EPOCH FROM fm.done - vm.done) * 1000 AS fts_ms
+FROM fused
+JOIN chunks c ON c.id = fused.id
+JOIN documents d ON d.id = c.document_id
+CROSS JOIN vec_mark vm
+CROSS JOIN fts_mark fm
+ORDER BY fused.score DESC
+"""
+
+_DOMAIN_JOIN = "JOIN documents dd ON dd.id = c.document_id AND dd.domain = :domain"
+
+
+@lru_cache(maxsize=None)
+def _hybrid_statement(fusion: str, with_domain: bool) -> TextClause:
+    """
+    Собирает (и кэширует) текст гибридного запроса, чтобы SQLAlchemy и psycopg
+    переиспользовали скомпилированный запрос и его план.
+    """
+    if fusion not in _FUSION_SCORES:
+        raise ValueError(
+            f"Unknown HYBRID_FUSION '{fusion}'. Expected one of: {', '.join(_FUSION_SCORES)}."
+        )
+    sql = _HYBRID_SQL.format(
+        domain_join=_DOMAIN_JOIN if with_domain else "",
+        fusion_score=_FUSION_SCORES[fusion],
+    )
+    params = [
+        bindparam("embedding", type_=Vector(settings.EMBEDDING_DIM)),
+        bindparam("query_text", type_=String),
+        bindparam("vector_limit", type_=Integer),
+        bindparam("fts_limit", type_=Integer),
+        bindparam("top_k", type_=Integer),
+        bindparam("vector_weight", type_=Float),
+        bindparam("fts_weight", type_=Float),
+    ]
+    if fusion == "rrf":
+        params.append(bindparam("rrf_k", type_=Integer))
+    if with_domain:
+        params.append(bindparam("domain", type_=String))
+    return text(sql).bindparams(*params)
+
+
+async def hybrid_search(
+    db: AsyncSession,
+    query_text: str,
+    query_embedding: List[float],
+    top_k: int,
+    domain: Optional[str] = None,
+) -> Tuple[List[Dict], Dict[str, float]]:
+    """
+    Гибридный поиск: векторная (HNSW) и полнотекстовая (ts_rank_cd) ветки
+    выполняются как CTE одного запроса и сливаются на стороне сервера.
+
+    Returns:
+        Кортеж (кандидаты в порядке слияния, тайминги веток в мс)
+    """
+    fusion = settings.HYBRID_FUSION
+    params = {
+        "embedding": query_embedding,
+        "query_text": query_text,
+        "vector_limit": settings.HYBRID_VECTOR_LIMIT,
+        "fts_limit": settings.HYBRID_FTS_LIMIT,
+        "top_k": top_k,
+        "vector_weight": settings.HYBRID_VECTOR_WEIGHT,
+        "fts_weight": settings.HYBRID_FTS_WEIGHT,
+    }
+    if fusion == "rrf":
+        params["rrf_k"] = settings.HYBRID_RRF_K
+    if domain:
+        params["domain"] = domain
+
+    result = await db.execute(_hybrid_statement(fusion, bool(domain)), params)
+    rows = result.all()
+
+    timings = {"retrieve_vector": 0.0, "retrieve_fts": 0.0}
+    if rows:
+        timings["retrieve_vector"] = float(rows[0].vector_ms)
+        timings["retrieve_fts"] = float(rows[0].fts_ms)
+        logger.debug(
+            "Hybrid retrieval: vector_hits=%d, fts_hits=%d, fused=%d",
+            rows[0].vector_hits,
+            rows[0].fts_hits,
+            len(rows),
+        )
+
+    candidates = [
+        {**_candidate(r), "fusion_score": float(r.fusion_score)} for r in rows
+    ]
+    return candidates, timings
@@ -1,36 +1,83 @@
+import json
+import logging
 import time
-from typing import Annotated, Union
+from typing import Annotated, Any, AsyncIterator, Dict, Optional, Union
 
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi import Request as FastAPIRequest
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.db.session import get_db
-from src.ingestion.embedding import get_embedding_model
+from src.db.session import AsyncSessionLocal, get_async_db
 
 from .dependencies import get_rag_engine
-from .llm import get_llm_client
+from .embedding_batcher import EmbeddingBatcher, get_embedding_batcher
+from .llm import LLMClient, get_llm_client
+from .llm_scheduler import PRIORITIES, LLMOverloadedError, get_llm_scheduler
+from .metrics import observe_response, observe_timings
 from .rag import RAGEngine
 from .schemas import (
+    BatchQueryRequest,
     FallbackResponse,
     LLMInfo,
     PaginatedHistoryResponse,
     QueryHistoryItem,
+    QueryHistoryListItem,
     QueryRequest,
     QueryResponse,
+    SearchRequest,
+    SearchResponse,
+    Source,
 )
 from .services.history_service import QueryHistoryService
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/api/v1", tags=["RAG"])
 
 
+def _build_query_response(
+    query_id: int, result: Dict[str, Any], llm_client: LLMClient
+) -> Union[QueryResponse, FallbackResponse]:
+    if "fallback" in result.get("warnings", []):
+        return FallbackResponse(
+            query_id=query_id,
+            response_md=result["response_md"],
+            confidence_score=result.get("confidence_score", 0.0),
+            sources=result.get("sources", []),
+            warnings=result.get("warnings", []),
+        )
+
+    return QueryResponse(
+        query_id=query_id,
+        response_md=result["response_md"],
+        confidence_score=result["confidence_score"],
+        sources=result["sources"],
+        llm=LLMInfo(provider=llm_client.provider, model=llm_client.model),
+        timings_ms=result["timings_ms"],
+        warnings=result.get("warnings", []),
+        cache_hit=result.get("cache_hit", False),
+    )
+
+
+def _request_priority(fastapi_request: FastAPIRequest) -> str:
+    """Класс приоритета из заголовка X-Priority (high, normal, low)."""
+    priority = fastapi_request.headers.get("X-Priority", "normal").lower()
+    return priority if priority in PRIORITIES else "normal"
+
+
+def _format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @router.post("/query", response_model=Union[QueryResponse, FallbackResponse])
 async def query_endpoint(
     request: QueryRequest,
     # TODO: Заменить на реальную аутентификацию
     fastapi_request: FastAPIRequest,
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_async_db)],
     rag_engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    embedding_batcher: Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)],
 ):
     """
     Основной эндпоинт для выполнения RAG-запросов.
@@ -39,10 +86,8 @@ async def query_endpoint(
     # ЗАГЛУШКА: Получаем ID пользователя. В реальном приложении это будет из токена.
     user_id = fastapi_request.headers.get("X-User-Id", "1")
 
-    emb_model = get_embedding_model()
-
     embed_start_time = time.time()
-    query_embedding = emb_model.get_embeddings([request.query])[0]
+    query_embedding = await embedding_batcher.embed(request.query)
     embed_time = (time.time() - embed_start_time) * 1000
 
     result = await rag_engine.query(
@@ -54,31 +99,25 @@ async def query_endpoint(
         top_k_final=request.top_k_final,
         min_confidence=request.min_confidence,
         temperature=request.temperature,
+        domain=request.domain_filter,
+        user_id=user_id,
+        priority=_request_priority(fastapi_request),
     )
 
+    observe_response("query", result)
+
     llm_client = get_llm_client()
-    query_id = QueryHistoryService.save(
-        db, int(user_id), request.query, query_embedding, result, llm_client
+    query_id = await QueryHistoryService.save(
+        db,
+        int(user_id),
+        request.query,
+        query_embedding,
+        result,
+        llm_client,
+        domain=request.domain_filter,
     )
 
-    if "fallback" in result.get("warnings", []):
-        return FallbackResponse(
-            query_id=query_id,
-            response_md=result["response_md"],
-            confidence_score=result.get("confidence_score", 0.0),
-            sources=result.get("sources", []),
-            warnings=result.get("warnings", []),
-        )
-
-    return QueryResponse(
-        query_id=query_id,
-        response_md=result["response_md"],
-        confidence_score=result["confidence_score"],
-        sources=result["sources"],
-        llm=LLMInfo(provider=llm_client.provider, model=llm_client.model),
-        timings_ms=result["timings_ms"],
-        warnings=result.get("warnings", []),
-    )
+    return _build_query_response(query_id, result, llm_client)
 
     # except Exception as e:
     #     print(f"An error occurred during query processing: {e}")
@@ -89,19 +128,286 @@ async def query_endpoint(
     #     ) from e
 
 
+@router.post("/query/stream")
+async def query_stream_endpoint(
+    request: QueryRequest,
+    fastapi_request: FastAPIRequest,
+    rag_engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    embedding_batcher: Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)],
+):
+    """
+    Потоковый RAG-запрос (Server-Sent Events).
+    События: `sources` — источники до начала генерации, `token` — фрагменты
+    ответа, `summary` — итог в формате /query (с query_id), `error` — ошибка.
+    История сохраняется после завершения генерации.
+    """
+    # ЗАГЛУШКА: Получаем ID пользователя. В реальном приложении это будет из токена.
+    user_id = fastapi_request.headers.get("X-User-Id", "1")
+
+    priority = _request_priority(fastapi_request)
+
+    embed_start_time = time.time()
+    query_embedding = await embedding_batcher.embed(request.query)
+    embed_time = (time.time() - embed_start_time) * 1000
+
+    async def event_stream() -> AsyncIterator[str]:
+        # Сессия открывается внутри генератора: она должна жить, пока идет поток
+        async with AsyncSessionLocal() as db:
+            try:
+                async for event in rag_engine.query_stream(
+                    db=db,
+                    query_text=request.query,
+                    query_embedding=query_embedding,
+                    embed_time_ms=embed_time,
+                    top_k_initial=request.top_k_initial,
+                    top_k_final=request.top_k_final,
+                    min_confidence=request.min_confidence,
+                    temperature=request.temperature,
+                    domain=request.domain_filter,
+                    user_id=user_id,
+                    priority=priority,
+                ):
+                    if event["event"] == "sources":
+                        sources = [
+                            Source.model_validate(s).model_dump() for s in event["data"]
+                        ]
+                        yield _format_sse("sources", sources)
+                    elif event["event"] == "token":
+                        yield _format_sse("token", {"text": event["data"]})
+                    elif event["event"] == "summary":
+                        result = event["data"]
+                        observe_response("query_stream", result)
+                        llm_client = get_llm_client()
+                        query_id = await QueryHistoryService.save(
+                            db,
+                            int(user_id),
+                            request.query,
+                            query_embedding,
+                            result,
+                            llm_client,
+                            domain=request.domain_filter,
+                        )
+                        response = _build_query_response(query_id, result, llm_client)
+                        yield _format_sse("summary", response.model_dump(mode="json"))
+            except LLMOverloadedError as e:
+                # Заголовки уже отправлены: статус и Retry-After передаются в событии
+                await db.rollback()
+                yield _format_sse(
+                    "error",
+                    {
+                        "detail": e.detail,
+                        "status_code": e.status_code,
+                        "retry_after": e.retry_after,
+                    },
+                )
+            except Exception:
+                logger.exception("Error while streaming RAG response")
+                await db.rollback()
+                yield _format_sse(
+                    "error",
+                    {"detail": "An internal error occurred while processing the request."},
+                )
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/search", response_model=SearchResponse)
+async def search_endpoint(
+    request: SearchRequest,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    rag_engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    embedding_batcher: Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)],
+):
+    """
+    Поиск без генерации ответа: ранжированные источники с оценками и таймингами.
+    Не занимает слотов LLM и не сохраняется в историю.
+    """
+    embed_start_time = time.time()
+    query_embedding = await embedding_batcher.embed(request.query)
+    embed_time = (time.time() - embed_start_time) * 1000
+
+    result = await rag_engine.search(
+        db=db,
+        query_text=request.query,
+        query_embedding=query_embedding,
+        embed_time_ms=embed_time,
+        top_k_initial=request.top_k_initial,
+        top_k=request.top_k,
+        domain=request.domain_filter,
+        retrieval_mode=request.retrieval_mode,
+        rerank=request.rerank,
+        latency_budget_ms=request.latency_budget_ms,
+    )
+    observe_timings("search", result["timings_ms"])
+    return SearchResponse.model_validate(result)
+
+
+@router.post("/query/batch")
+async def query_batch_endpoint(
+    request: BatchQueryRequest,
+    fastapi_request: FastAPIRequest,
+    rag_engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    embedding_batcher: Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)],
+):
+    """
+    Пачка RAG-запросов для офлайн-задач (регрессионные прогоны, генерация FAQ).
+    Ответ — NDJSON: по строке на запрос в порядке готовности, `index` — позиция
+    запроса в пачке; остальные поля как у /query, либо `error` при ошибке.
+    По умолчанию запросы идут в очередь LLM с приоритетом low (X-Priority).
+    """
+    # ЗАГЛУШКА: Получаем ID пользователя. В реальном приложении это будет из токена.
+    user_id = fastapi_request.headers.get("X-User-Id", "1")
+    priority = (
+        _request_priority(fastapi_request)
+        if "X-Priority" in fastapi_request.headers
+        else "low"
+    )
+
+    texts = [q.query for q in request.queries]
+    embed_start_time = time.time()
+    query_embeddings = await embedding_batcher.embed_many(texts)
+    embed_time = (time.time() - embed_start_time) * 1000
+
+    queries = [
+        {
+            "query_text": q.query,
+            "top_k_initial": q.top_k_initial,
+            "top_k_final": q.top_k_final,
+            "min_confidence": q.min_confidence,
+            "temperature": q.temperature,
+            "domain": q.domain_filter,
+        }
+        for q in request.queries
+    ]
+
+    async def result_lines() -> AsyncIterator[str]:
+        llm_client = get_llm_client()
+        remaining = set(range(len(queries)))
+        async with AsyncSessionLocal() as db:
+            try:
+                async for index, result in rag_engine.query_batch(
+                    db, queries, query_embeddings, embed_time, user_id, priority
+                ):
+                    remaining.discard(index)
+                    if isinstance(result, Exception):
+                        line = {"index": index, "error": _batch_error(result)}
+                    else:
+                        try:
+                            line = await _save_batch_result(
+                                db, index, result, llm_client
+                            )
+                        except Exception as e:
+                            logger.exception("Error while saving batch query %d", index)
+                            await db.rollback()
+                            line = {"index": index, "error": _batch_error(e)}
+                    yield json.dumps(line, ensure_ascii=False) + "\n"
+            except Exception as e:
+                # Заголовки уже отправлены: ошибка передается в строках
+                # для всех запросов, по которым ответа еще не было
+                logger.exception("Error while processing RAG batch")
+                await db.rollback()
+                for index in sorted(remaining):
+                    line = {"index": index, "error": _batch_error(e)}
+                    yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    async def _save_batch_result(
+        db: AsyncSession, index: int, result: Dict[str, Any], llm_client: LLMClient
+    ) -> Dict[str, Any]:
+        observe_response("query_batch", result)
+        query_id = await QueryHistoryService.save(
+            db,
+            int(user_id),
+            texts[index],
+            query_embeddings[index],
+            result,
+            llm_client,
+            domain=queries[index]["domain"],
+        )
+        response = _build_query_response(query_id, result, llm_client)
+        return {"index": index, **response.model_dump(mode="json")}
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
+
+def _batch_error(error: Exception) -> Dict[str, Any]:
+    if isinstance(error, LLMOverloadedError):
+        return {
+            "detail": error.detail,
+            "status_code": error.status_code,
+            "retry_after": error.retry_after,
+        }
+    return {
+        "detail": "An internal error occurred while processing the request.",
+        "status_code": 500,
+    }
+
+
 @router.get("/history", response_model=PaginatedHistoryResponse)
 async def get_query_history(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_async_db)],
     user_id: int = Query(..., description="ID пользователя"),
-    page: int = Query(1, ge=1, description="Номер страницы (начиная с 1)"),
     limit: int = Query(
         10, ge=1, le=100, description="Количество записей на странице"
     ),
+    cursor: Optional[str] = Query(
+        None, description="next_cursor предыдущей страницы (без него — первая страница)"
+    ),
+    include_total: bool = Query(
+        False, description="Вернуть общее количество записей (дополнительный COUNT)"
+    ),
+):
+    """
+    Получает историю запросов пользователя (от новых к старым) с курсорной
+    пагинацией. Ответ и источники записи возвращает GET /history/{history_id}.
+    """
+    try:
+        items, next_cursor, total = await QueryHistoryService.get_user_history(
+            db, user_id, limit, cursor, with_total=include_total
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    items_models = [QueryHistoryListItem.model_validate(hist) for hist in items]
+    return PaginatedHistoryResponse(
+        limit=limit, next_cursor=next_cursor, total=total, items=items_models
+    )
+
+
+@router.get("/history/{history_id}", response_model=QueryHistoryItem)
+async def get_query_history_entry(
+    history_id: int,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    user_id: int = Query(..., description="ID пользователя"),
 ):
     """
-    Получает историю запросов пользователя с пагинацией.
+    Полная запись истории: ответ и источники.
+    """
+    entry = await QueryHistoryService.get_entry(db, user_id, history_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="History entry not found.")
+    return QueryHistoryItem.model_validate(entry)
+
+
+@router.get("/llm/backends")
+async def get_llm_backends():
+    """
+    Состояние LLM-серверов: circuit breaker, выполняющиеся запросы,
+    перцентили задержки, число повторов и хеджированных запросов.
+    """
+    return {**get_llm_client().stats(), "admission": get_llm_scheduler().stats()}
+
+
+@router.post("/cache/completions/flush")
+async def flush_completion_cache():
+    """
+    Сбрасывает кэш ответов LLM (память этого воркера и общую таблицу).
+    Вызывается после переиндексации корпуса.
     """
-    items, total = QueryHistoryService.get_user_history(db, user_id, page, limit)
-    # Преобразуем ORM-объекты в Pydantic модели с помощью from_orm (ORM mode)
-    items_models = [QueryHistoryItem.from_orm(hist) for hist in items]
-    return PaginatedHistoryResponse(total=total, page=page, limit=limit, items=items_models)
+    cache = get_llm_client().completion_cache
+    if cache is None:
+        return {"flushed": False}
+    await cache.clear()
+    return {"flushed": True}
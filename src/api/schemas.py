@@ -1,7 +1,7 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, Field
 
 from src.config import settings
 
@@ -34,6 +34,15 @@ class QueryRequest(BaseModel):
     )
 
 
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest] = Field(
+        ...,
+        min_length=1,
+        max_length=settings.QUERY_BATCH_MAX_SIZE,
+        description="Запросы пачки; результаты приходят в порядке готовности с полем index",
+    )
+
+
 class Source(BaseModel):
     source_id: int = Field(..., description="Порядковый номер источника в ответе")
     chunk_id: int
@@ -51,6 +60,50 @@ class Source(BaseModel):
     excerpt: str = Field(..., description="Краткий фрагмент текста чанка")
 
 
+class SearchRequest(BaseModel):
+    query: str = Field(..., min_length=3, description="Текст поискового запроса")
+    top_k: int = Field(
+        settings.TOP_K_FINAL, ge=1, le=100, description="Количество результатов"
+    )
+    top_k_initial: int = Field(
+        settings.TOP_K_INITIAL,
+        ge=1,
+        le=100,
+        description="Количество кандидатов из индекса (до ре-ранжирования)",
+    )
+    domain_filter: Optional[str] = Field(
+        None, description="Фильтр по домену источников"
+    )
+    retrieval_mode: Optional[Literal["vector", "hybrid"]] = Field(
+        None, description="Режим поиска (по умолчанию RETRIEVAL_MODE)"
+    )
+    rerank: Optional[bool] = Field(
+        None, description="Ре-ранжировать кандидатов (по умолчанию ENABLE_RERANKER)"
+    )
+    latency_budget_ms: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Бюджет времени; ре-ранжирование, не укладывающееся в него, пропускается",
+    )
+
+
+class SearchResult(Source):
+    fusion_score: Optional[float] = Field(
+        None, description="Оценка слияния веток гибридного поиска"
+    )
+    rerank_stage1_score: Optional[float] = Field(
+        None, description="Оценка первой ступени каскада ре-ранжирования"
+    )
+
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+    retrieval_mode: str
+    reranked: bool
+    timings_ms: Dict[str, float]
+    warnings: List[str]
+
+
 class LLMInfo(BaseModel):
     provider: str
     model: str
@@ -59,8 +112,25 @@ class LLMInfo(BaseModel):
 class Timings(BaseModel):
     embed: float
     retrieve: float
+    retrieve_vector: Optional[float] = Field(
+        None, description="Векторная ветка гибридного поиска"
+    )
+    retrieve_fts: Optional[float] = Field(
+        None, description="Полнотекстовая ветка гибридного поиска"
+    )
     rerank: float
+    rerank_stage1: Optional[float] = Field(
+        None, description="Первая (быстрая) ступень каскада ре-ранжирования"
+    )
+    rerank_stage2: Optional[float] = Field(
+        None, description="Вторая ступень каскада ре-ранжирования"
+    )
+    queue: float = Field(0.0, description="Ожидание слота генерации LLM")
     llm: float
+    cache: float = 0.0
+    first_token: Optional[float] = Field(
+        None, description="Время до первого фрагмента ответа LLM (только для потоковых ответов)"
+    )
     total: float
 
 
@@ -72,6 +142,9 @@ class QueryResponse(BaseModel):
     llm: LLMInfo
     timings_ms: Timings
     warnings: List[str] = []
+    cache_hit: bool = Field(
+        False, description="Ответ взят из семантического кэша"
+    )
 
 
 class FallbackResponse(BaseModel):
@@ -87,24 +160,35 @@ class FallbackResponse(BaseModel):
 
 # --- Schemas for Query History ---
 
-class QueryHistoryItem(BaseModel):
-    """Pydantic representation of a query history entry."""
+class QueryHistoryListItem(BaseModel):
+    """Query history entry in list mode (without the answer and sources)."""
     id: int
     user_id: int
     query_text: str
-    response_md: str
-    sources: List[Dict[str, Any]]
     llm_provider: Optional[str] = None
     llm_model: Optional[str] = None
     confidence_score: float
+    domain: Optional[str] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
 
+class QueryHistoryItem(QueryHistoryListItem):
+    """Pydantic representation of a query history entry."""
+    response_md: str
+    sources: List[Dict[str, Any]] = Field(
+        validation_alias=AliasChoices("sources", "sources_json")
+    )
+
+
 class PaginatedHistoryResponse(BaseModel):
-    total: int
-    page: int
     limit: int
-    items: List[QueryHistoryItem]
+    next_cursor: Optional[str] = Field(
+        None, description="Курсор следующей страницы (None — страница последняя)"
+    )
+    total: Optional[int] = Field(
+        None, description="Общее количество записей (только при include_total=true)"
+    )
+    items: List[QueryHistoryListItem]
@@ -0,0 +1,123 @@
+import datetime
+import logging
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.db.models import Chunk, QueryHistory
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    Семантический кэш ответов поверх таблицы query_history.
+    Находит ранее данные уверенные ответы на близкие по смыслу вопросы
+    через HNSW-индекс idx_qh_embedding_hnsw.
+    """
+
+    # Сколько ближайших записей проверяем на актуальность
+    CANDIDATES = 3
+
+    def __init__(self):
+        self.enabled = settings.SEMANTIC_CACHE_ENABLED
+        self.max_distance = settings.SEMANTIC_CACHE_MAX_DISTANCE
+        self.min_confidence = settings.SEMANTIC_CACHE_MIN_CONFIDENCE
+        self.ttl = datetime.timedelta(seconds=settings.SEMANTIC_CACHE_TTL_SECONDS)
+
+    async def lookup(
+        self,
+        db: AsyncSession,
+        query_embedding: List[float],
+        domain: Optional[str],
+        min_confidence: float,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает закэшированный ответ или None, если подходящего нет.
+        """
+        distance = QueryHistory.query_embedding.cosine_distance(
+            query_embedding
+        ).label("distance")
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - self.ttl
+        domain_clause = (
+            QueryHistory.domain.is_(None)
+            if domain is None
+            else QueryHistory.domain == domain
+        )
+
+        # ORDER BY distance LIMIT n — форма запроса, которую обслуживает HNSW-индекс
+        result = await db.execute(
+            select(
+                QueryHistory.id,
+                QueryHistory.response_md,
+                QueryHistory.sources_json,
+                QueryHistory.confidence_score,
+                QueryHistory.created_at,
+                distance,
+            )
+            .where(
+                QueryHistory.created_at >= cutoff,
+                QueryHistory.confidence_score
+                >= max(self.min_confidence, min_confidence),
+                # Ответы, которые сами были взяты из кэша, не продлевают TTL оригинала
+                QueryHistory.cache_source_id.is_(None),
+                # Заглушка «К сожалению...» — не ответ, ее не отдаем из кэша
+                QueryHistory.is_fallback.is_(False),
+                domain_clause,
+            )
+            .order_by(distance)
+            .limit(self.CANDIDATES)
+        )
+        rows = result.all()
+
+        for row in rows:
+            if float(row.distance) > self.max_distance:
+                break
+            if not await self._is_fresh(db, row.sources_json, row.created_at):
+                logger.debug(
+                    "Semantic cache entry %d is stale: cited documents changed.",
+                    row.id,
+                )
+                continue
+
+            logger.info(
+                "Semantic cache hit: history id=%d, distance=%.4f",
+                row.id,
+                float(row.distance),
+            )
+            return {
+                "response_md": row.response_md,
+                "confidence_score": float(row.confidence_score),
+                "sources": row.sources_json,
+                "warnings": [],
+                "cache_hit": True,
+                "cache_source_id": row.id,
+            }
+
+        return None
+
+    async def _is_fresh(
+        self, db: AsyncSession, sources: List[Dict], cached_at: datetime.datetime
+    ) -> bool:
+        """
+        Проверяет, что процитированные чанки ещё существуют, а их документы
+        не были переиндексированы после сохранения ответа.
+        """
+        cited = [s for s in sources if s.get("cited")]
+        if not cited:
+            return False
+
+        chunk_ids = {int(s["chunk_id"]) for s in cited}
+        document_ids = {int(s["document_id"]) for s in cited}
+
+        result = await db.execute(
+            select(
+                func.count(Chunk.id).filter(Chunk.id.in_(chunk_ids)),
+                func.count(Chunk.id).filter(Chunk.created_at > cached_at),
+            ).where(Chunk.document_id.in_(document_ids))
+        )
+        alive, changed = result.one()
+
+        return alive == len(chunk_ids) and changed == 0
@@ -1,9 +1,27 @@
+import datetime
 import json
-from typing import Any, Dict, List, Tuple, cast
+from typing import Any, Dict, List, Optional, Tuple, cast
 
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer, load_only
 
 from src.db.models import QueryHistory
+from src.db.pagination import decode_cursor, encode_cursor
+
+from .history_writer import get_history_writer
+
+# Колонки, нужные для списка истории (без ответа, источников и эмбеддинга)
+LIST_COLUMNS = (
+    QueryHistory.id,
+    QueryHistory.user_id,
+    QueryHistory.query_text,
+    QueryHistory.llm_provider,
+    QueryHistory.llm_model,
+    QueryHistory.confidence_score,
+    QueryHistory.domain,
+    QueryHistory.created_at,
+)
 
 
 class QueryHistoryService:
@@ -13,67 +31,129 @@ class QueryHistoryService:
     """
 
     @staticmethod
-    def save(
-        db: Session,
+    async def save(
+        db: AsyncSession,
         user_id: int,
         query_text: str,
         query_embedding: list,
         result: Dict[str, Any],
         llm_client,
+        domain: Optional[str] = None,
     ) -> int:
         """
-        Сохраняет результат запроса в базу данных.
+        Сохраняет результат запроса в историю.
+
+        При HISTORY_WRITE_BEHIND запись ставится в буфер фоновой записи
+        (см. HistoryWriter) и ID возвращается без ожидания INSERT, иначе
+        запись добавляется в сессии db и фиксируется сразу.
 
         Args:
-            db: Сессия SQLAlchemy
+            db: Асинхронная сессия SQLAlchemy
             user_id: ID пользователя
             query_text: Текст запроса
             query_embedding: Эмбеддинг запроса (list[float])
             result: Результат от RAG-движка (словарь с полями response_md, sources, confidence_score и т.д.)
             llm_client: Объект LLM-клиента (имеет атрибуты provider и model)
+            domain: Домен, которым был ограничен поиск
 
         Returns:
-            ID созданной записи в истории
+            ID записи в истории
         """
-        history_entry = QueryHistory(
-            user_id=user_id,
-            query_text=query_text,
-            query_embedding=query_embedding,
-            response_md=result["response_md"],
-            sources_json=json.loads(
-                json.dumps([s for s in result.get("sources", [])], default=str)
+        row = {
+            "user_id": user_id,
+            "query_text": query_text,
+            "query_embedding": query_embedding,
+            "response_md": result["response_md"],
+            # Приводим источники к JSON-совместимому виду (даты, Decimal и т.п.)
+            "sources_json": json.loads(
+                json.dumps(list(result.get("sources", [])), default=str)
             ),
-            llm_provider=llm_client.provider,
-            llm_model=llm_client.model,
-            confidence_score=result.get("confidence_score", 0.0),
-        )
+            "llm_provider": llm_client.provider,
+            "llm_model": llm_client.model,
+            "confidence_score": result.get("confidence_score", 0.0),
+            "domain": domain,
+            "cache_source_id": result.get("cache_source_id"),
+            "is_fallback": "fallback" in result.get("warnings", []),
+        }
+
+        writer = get_history_writer()
+        if writer is not None:
+            return await writer.submit(row)
+
+        history_entry = QueryHistory(**row)
         db.add(history_entry)
-        db.commit()
-        db.refresh(history_entry)
-        return cast(int, history_entry.id)
+        # id присваивается при flush (RETURNING), отдельный refresh не нужен
+        await db.flush()
+        history_id = cast(int, history_entry.id)
+        await db.commit()
+        return history_id
 
     @staticmethod
-    def get_user_history(
-        db: Session, user_id: int, page: int = 1, limit: int = 10
-    ) -> Tuple[List[QueryHistory], int]:
+    async def get_user_history(
+        db: AsyncSession,
+        user_id: int,
+        limit: int = 10,
+        cursor: Optional[str] = None,
+        with_total: bool = False,
+    ) -> Tuple[List[QueryHistory], Optional[str], Optional[int]]:
         """
-        Получает историю запросов пользователя с пагинацией.
+        Получает страницу истории пользователя (от новых к старым) keyset-пагинацией
+        по (created_at, id): страница читается по индексу idx_qh_user_time без OFFSET,
+        поэтому стоимость не растет с глубиной. Крупные колонки (response_md,
+        sources_json, query_embedding) не загружаются.
 
         Args:
-            db: Сессия SQLAlchemy
+            db: Асинхронная сессия SQLAlchemy
             user_id: ID пользователя
-            page: Номер страницы (начиная с 1)
             limit: Количество записей на странице
+            cursor: next_cursor предыдущей страницы (None — первая страница)
+            with_total: Посчитать общее количество записей (COUNT(*) по пользователю)
 
         Returns:
-            Кортеж (список записей, общее количество записей)
+            Кортеж (список записей, курсор следующей страницы или None, количество или None)
+
+        Raises:
+            ValueError: Курсор поврежден
         """
-        query = (
-            db.query(QueryHistory)
-            .filter(QueryHistory.user_id == user_id)
-            .order_by(QueryHistory.created_at.desc())
+        stmt = (
+            select(QueryHistory)
+            .options(load_only(*LIST_COLUMNS))
+            .where(QueryHistory.user_id == user_id)
+            .order_by(QueryHistory.created_at.desc(), QueryHistory.id.desc())
+            # Лишняя запись показывает, есть ли следующая страница
+            .limit(limit + 1)
+        )
+        if cursor is not None:
+            created_at, history_id = decode_cursor(cursor)
+            stmt = stmt.where(
+                tuple_(QueryHistory.created_at, QueryHistory.id) < (created_at, history_id)
+            )
+        items = list((await db.scalars(stmt)).all())
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            next_cursor = encode_cursor(
+                cast(datetime.datetime, last.created_at), cast(int, last.id)
+            )
+
+        total = None
+        if with_total:
+            total = await db.scalar(
+                select(func.count())
+                .select_from(QueryHistory)
+                .where(QueryHistory.user_id == user_id)
+            )
+        return items, next_cursor, total
+
+    @staticmethod
+    async def get_entry(
+        db: AsyncSession, user_id: int, history_id: int
+    ) -> Optional[QueryHistory]:
+        """Полная запись истории пользователя (с ответом и источниками) или None."""
+        return await db.scalar(
+            select(QueryHistory)
+            .options(defer(QueryHistory.query_embedding))
+            .where(QueryHistory.id == history_id, QueryHistory.user_id == user_id)
         )
-        total = query.count()
-        offset = (page - 1) * limit
-        items = query.offset(offset).limit(limit).all()
-        return items, total
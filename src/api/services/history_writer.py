@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import insert, text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from src.config import settings
+from src.db.models import QueryHistory
+from src.db.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """
+    Отложенная (write-behind) запись истории запросов.
+
+    ID записи берется заранее из последовательности query_history.id блоками
+    по HISTORY_ID_BLOCK_SIZE, поэтому query_id возвращается клиенту сразу,
+    а сама запись попадает в буфер. Фоновая задача сбрасывает буфер одним
+    многострочным INSERT, когда в нем набралось HISTORY_FLUSH_MAX_ENTRIES
+    записей или с первой записи прошло HISTORY_FLUSH_INTERVAL_MS.
+
+    Запись становится видна в /history (и семантическому кэшу) с задержкой
+    до одного интервала сброса. При остановке буфер дописывается (close).
+    Батч, не записанный из-за ошибки соединения, возвращается в буфер; при
+    переполнении буфера (HISTORY_BUFFER_MAX_ENTRIES, например при недоступной
+    БД) самые старые записи отбрасываются. При других ошибках батч делится
+    пополам, пока не останутся отдельные записи, и записи, которые не
+    удается сохранить поодиночке, отбрасываются.
+    """
+
+    def __init__(
+        self,
+        session_factory: Optional[async_sessionmaker] = None,
+        max_batch: Optional[int] = None,
+        flush_interval_ms: Optional[float] = None,
+        max_buffer: Optional[int] = None,
+        id_block_size: Optional[int] = None,
+    ):
+        self.session_factory = session_factory or AsyncSessionLocal
+        self.max_batch = max_batch or settings.HISTORY_FLUSH_MAX_ENTRIES
+        if flush_interval_ms is None:
+            flush_interval_ms = settings.HISTORY_FLUSH_INTERVAL_MS
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_buffer = max_buffer or settings.HISTORY_BUFFER_MAX_ENTRIES
+        self.id_block_size = id_block_size or settings.HISTORY_ID_BLOCK_SIZE
+
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._ids: Deque[int] = deque()
+        self._id_lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._not_empty: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._closing = False
+
+        # Статистика
+        self.flushes = 0
+        self.written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+
+    async def submit(self, row: Dict[str, Any]) -> int:
+        """
+        Ставит запись в буфер и возвращает ее ID, не дожидаясь записи в БД.
+        row — значения колонок QueryHistory без id.
+        """
+        self._ensure_worker()
+        history_id = await self._next_id()
+        row = {**row, "id": history_id}
+        row.setdefault("created_at", datetime.datetime.now(datetime.timezone.utc))
+
+        self._buffer.append(row)
+        self._trim_buffer()
+        assert self._not_empty is not None and self._full is not None
+        self._not_empty.set()
+        if len(self._buffer) >= self.max_batch:
+            self._full.set()
+        return history_id
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "reserved_ids": len(self._ids),
+            "flushes": self.flushes,
+            "written": self.written,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+        }
+
+    async def close(self):
+        """Дописывает буфер и останавливает фоновую задачу."""
+        if self._worker is None:
+            return
+        self._closing = True
+        assert self._not_empty is not None and self._full is not None
+        self._not_empty.set()
+        self._full.set()
+        await self._worker
+        self._worker = None
+        self._closing = False
+
+    async def _allocate_ids(self, count: int) -> List[int]:
+        """Резервирует count значений последовательности query_history.id."""
+        async with self.session_factory() as db:
+            result = await db.scalars(
+                text(
+                    "SELECT nextval(pg_get_serial_sequence('query_history', 'id')) "
+                    "FROM generate_series(1, :count)"
+                ),
+                {"count": count},
+            )
+            return list(result.all())
+
+    async def _next_id(self) -> int:
+        assert self._id_lock is not None
+        async with self._id_lock:
+            if not self._ids:
+                self._ids.extend(await self._allocate_ids(self.id_block_size))
+            return self._ids.popleft()
+
+    def _ensure_worker(self):
+        # Задача и примитивы синхронизации привязаны к event loop, в котором созданы
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._id_lock = asyncio.Lock()
+            self._not_empty = asyncio.Event()
+            self._full = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+    def _trim_buffer(self):
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            for _ in range(overflow):
+                self._buffer.popleft()
+            self.dropped += overflow
+            logger.error("History buffer overflow: dropped %d entries", overflow)
+
+    async def _run(self):
+        assert self._not_empty is not None and self._full is not None
+        while self._buffer or not self._closing:
+            if not self._buffer:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+                continue
+
+            # Окно отсчитывается от первой записи в буфере
+            if len(self._buffer) < self.max_batch and not self._closing:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = [
+                self._buffer.popleft()
+                for _ in range(min(self.max_batch, len(self._buffer)))
+            ]
+            retry = await self._flush(batch)
+            if not retry:
+                continue
+            if self._closing:
+                self.dropped += len(retry)
+                logger.error("Dropped %d history entries on shutdown", len(retry))
+                continue
+            # Возвращаем записи в начало буфера и даем БД время восстановиться
+            self._buffer.extendleft(reversed(retry))
+            self._trim_buffer()
+            await asyncio.sleep(self.flush_interval)
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Записывает батч; возвращает записи, которые нужно повторить позже."""
+        try:
+            async with self.session_factory() as db:
+                # executemany: SQLAlchemy собирает строки в многострочный INSERT
+                await db.execute(insert(QueryHistory), batch)
+                await db.commit()
+        except Exception as e:
+            self.failed_flushes += 1
+            if _is_transient(e):
+                logger.warning(
+                    "History database unavailable, %d entries requeued: %s",
+                    len(batch),
+                    e,
+                )
+                return batch
+            if len(batch) == 1:
+                # Повтор не поможет: данные записи отвергаются самой БД
+                self.dropped += 1
+                logger.error("Dropped history entry %s: %s", batch[0]["id"], e)
+                return []
+            logger.warning(
+                "Failed to write %d history entries, retrying in halves: %s",
+                len(batch),
+                e,
+            )
+            middle = len(batch) // 2
+            return await self._flush(batch[:middle]) + await self._flush(batch[middle:])
+        self.flushes += 1
+        self.written += len(batch)
+        return []
+
+
+def _is_transient(error: Exception) -> bool:
+    """Ошибка соединения с БД, после которой батч стоит повторить целиком."""
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(
+        error, (OperationalError, InterfaceError, ConnectionError, TimeoutError)
+    )
+
+
+_history_writer = None
+
+
+def get_history_writer() -> Optional[HistoryWriter]:
+    """Синглтон фоновой записи истории; None, если HISTORY_WRITE_BEHIND выключен."""
+    global _history_writer
+    if not settings.HISTORY_WRITE_BEHIND:
+        return None
+    if _history_writer is None:
+        _history_writer = HistoryWriter()
+    return _history_writer
+
+
+async def close_history_writer():
+    global _history_writer
+    if _history_writer:
+        await _history_writer.close()
+        logger.info(
+            "History writer drained: %d entries written, %d dropped.",
+            _history_writer.written,
+            _history_writer.dropped,
+        )
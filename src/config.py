@@ -1,3 +1,5 @@
+from typing import Literal, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # import os
@@ -15,6 +17,14 @@ class Settings(BaseSettings):
     POSTGRES_DB: str = "rag_docs"
     POSTGRES_USER: str = "rag_user"
     POSTGRES_PASSWORD: str = ""
+    # Пул асинхронного движка API. Соединение занято только на время запросов
+    # к БД (не на время генерации LLM), поэтому пул может быть небольшим.
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 5
+    DB_POOL_TIMEOUT: int = 30
+    # Через сколько выполнений psycopg готовит запрос на сервере (None — никогда,
+    # нужно при работе через pgbouncer в режиме transaction)
+    DB_PREPARE_THRESHOLD: Optional[int] = 5
 
     # LLM
     LLM_PROVIDER: str = "lmstudio"
@@ -22,30 +32,121 @@ class Settings(BaseSettings):
     LLM_API_KEY: str = "lm-studio"
     LLM_MODEL: str = "local-model"
     LLM_TIMEOUT: int = 90
-    LLM_MAX_CONCURRENT_REQUESTS: int = 5
+    LLM_MAX_CONCURRENT_REQUESTS: int = 5  # На каждый сервер
+    # Несколько OpenAI-совместимых серверов через запятую (по умолчанию LLM_BASE_URL)
+    LLM_BASE_URLS: Optional[str] = None
+    LLM_HTTP2: bool = False  # Требует extra http2: pip install -e ".[http2]"
+    LLM_MAX_RETRIES: int = 2
+    LLM_RETRY_BACKOFF_MS: float = 200.0  # Базовая задержка, удваивается с каждой попыткой
+    LLM_CIRCUIT_FAILURE_THRESHOLD: int = 3  # Ошибок подряд до исключения сервера
+    LLM_CIRCUIT_RESET_SECONDS: float = 30.0  # Через сколько пробовать сервер снова
+    # Хеджирование: дубль запроса на другой сервер, если ответа нет дольше
+    # LLM_HEDGE_PERCENTILE-перцентиля задержки сервера
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_PERCENTILE: float = 95.0
+    LLM_HEDGE_MIN_DELAY_MS: float = 500.0
+    # Кэш ответов LLM для детерминированных запросов (temperature=0)
+    COMPLETION_CACHE_ENABLED: bool = True
+    COMPLETION_CACHE_MAX_ENTRIES: int = 1000
+    COMPLETION_CACHE_DB_ENABLED: bool = False  # Общий кэш в таблице llm_completion_cache
+    COMPLETION_CACHE_DB_MAX_ENTRIES: int = 50000
+    # Очередь допуска к LLM: запросы сверх нее и те, что не успевают начать
+    # генерацию за LLM_QUEUE_TIMEOUT_SECONDS, отклоняются с 429/503 и Retry-After
+    LLM_QUEUE_MAX_SIZE: int = 100
+    LLM_QUEUE_MAX_PER_USER: int = 5
+    LLM_QUEUE_TIMEOUT_SECONDS: float = 20.0
+
+    # Бэкенд инференса моделей эмбеддингов и ре-ранжирования:
+    # torch — PyTorch (CPU/CUDA), onnx — onnxruntime на CPU
+    # (модели экспортируются заранее: python scripts/export_onnx.py)
+    INFERENCE_BACKEND: Literal["torch", "onnx"] = "torch"
+    ONNX_MODEL_DIR: str = "models/onnx"
+    ONNX_QUANTIZED: bool = False  # Использовать int8-модель (export_onnx.py --quantize)
+    ONNX_INTRA_OP_THREADS: Optional[int] = None  # None — по числу ядер
 
     # Embedding
     EMBEDDING_MODEL: str = "microsoft/codebert-base"
     EMBEDDING_DIM: int = 768
     EMBEDDING_DEVICE: str = "cpu"
     EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_BATCH_MAX_WAIT_MS: float = 5.0  # Окно сбора батча запросов в API
+    # Дисковый кэш эмбеддингов чанков для загрузки документов (memmap + SQLite)
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_DIR: str = ".cache/embeddings"
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 200000  # Сверх этого вытесняются LRU-записи
 
     # Reranker
     RERANKER_MODEL: str = "cross-encoder/ms-marco-MiniLM-L12-v2"  # BAAI/bge-reranker-v2-m3 для современного железа
     RERANKER_DEVICE: str = "cpu"
     RERANKER_BATCH_SIZE: int = 16
+    RERANKER_BATCH_MAX_WAIT_MS: float = 10.0  # Окно слияния пар от параллельных запросов
+    RERANKER_BUCKET_WINDOW: int = 4  # Батчей за проход для сортировки пар по длине
     RERANKER_ONNX: bool = False
+    # Максимальная длина пары (запрос, чанк) в токенах; по умолчанию CHUNK_SIZE + 64
+    RERANKER_MAX_LENGTH: Optional[int] = None
+    # Каскад: быстрая модель оценивает всех кандидатов, RERANKER_MODEL — только лучших
+    RERANKER_CASCADE: bool = False
+    RERANKER_STAGE1_MODEL: str = "cross-encoder/ms-marco-MiniLM-L6-v2"
+    RERANKER_STAGE1_BATCH_SIZE: int = 64
+    RERANKER_CASCADE_TOP_N: int = 10  # Не меньше TOP_K_FINAL
+    # Если задано, на вторую ступень идут только кандидаты, чья оценка первой
+    # ступени отстает от лучшей не больше чем на эту величину
+    RERANKER_CASCADE_MARGIN: Optional[float] = None
+    RERANK_CACHE_ENABLED: bool = True
+    RERANK_CACHE_MAX_ENTRIES: int = 50000  # Размер LRU в памяти процесса
+    RERANK_CACHE_DB_ENABLED: bool = False  # Общий кэш в таблице rerank_score_cache
+    RERANK_CACHE_DB_TTL_SECONDS: int = 604800
 
     # RAG
     TOP_K_INITIAL: int = 30
     TOP_K_FINAL: int = 7
     MIN_CONFIDENCE: float = 0.7
     ENABLE_RERANKER: bool = True
+    # Бюджет токенов на источники в промпте (0 — без ограничения). Оставляйте
+    # запас под шаблон промпта, вопрос и ответ в окне контекста LLM.
+    CONTEXT_TOKEN_BUDGET: int = 3000
+    CONTEXT_MIN_TRUNCATED_TOKENS: int = 64  # Меньший остаток не заполняется обрезком
+
+    # Пакетные запросы (POST /api/v1/query/batch)
+    QUERY_BATCH_MAX_SIZE: int = 500
+    QUERY_BATCH_OVERLOAD_RETRIES: int = 3  # Повторов генерации после 429/503 очереди LLM
+
+    # Retrieval: vector — только HNSW, hybrid — HNSW + полнотекстовый поиск
+    RETRIEVAL_MODE: Literal["vector", "hybrid"] = "vector"
+    HYBRID_FUSION: Literal["rrf", "weighted"] = "rrf"
+    HYBRID_VECTOR_LIMIT: int = 50  # Кандидатов из векторной ветки
+    HYBRID_FTS_LIMIT: int = 50  # Кандидатов из полнотекстовой ветки
+    HYBRID_VECTOR_WEIGHT: float = 1.0
+    HYBRID_FTS_WEIGHT: float = 1.0
+    HYBRID_RRF_K: int = 60
+
+    # Semantic cache (поиск готовых ответов в query_history)
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_MAX_DISTANCE: float = 0.05  # Максимальное косинусное расстояние
+    SEMANTIC_CACHE_MIN_CONFIDENCE: float = 0.8
+    SEMANTIC_CACHE_TTL_SECONDS: int = 86400
+
+    # История запросов: отложенная запись многострочными INSERT в фоне
+    # (query_id берется из последовательности заранее и возвращается сразу)
+    HISTORY_WRITE_BEHIND: bool = True
+    HISTORY_FLUSH_MAX_ENTRIES: int = 100
+    HISTORY_FLUSH_INTERVAL_MS: float = 200.0
+    HISTORY_BUFFER_MAX_ENTRIES: int = 10000  # Сверх этого старые записи отбрасываются
+    HISTORY_ID_BLOCK_SIZE: int = 100  # Сколько ID резервировать за одно обращение к БД
 
     # Chunking
     CHUNK_SIZE: int = 700
     CHUNK_OVERLAP: int = 100
 
+    # Загрузка документов (python -m src.ingestion.cli)
+    INGEST_WORKERS: Optional[int] = None  # Процессов чанкинга; None — число ядер минус одно
+    INGEST_QUEUE_SIZE: int = 64  # Документов в очереди между стадиями (backpressure)
+    # Чанки разных документов копятся на столько батчей EMBEDDING_BATCH_SIZE
+    INGEST_EMBED_POOL_BATCHES: int = 8
+    # copy — пачки через бинарный COPY в staging-таблицы, orm — построчно
+    INGEST_WRITE_MODE: Literal["copy", "orm"] = "copy"
+    INGEST_WRITE_BATCH_DOCS: int = 100  # Документов в одной транзакции записи
+
     # Django
     DJANGO_SECRET_KEY: str = ""
     DJANGO_DEBUG: bool = True
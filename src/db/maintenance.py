@@ -0,0 +1,30 @@
+"""
+Обслуживание таблиц кэшей, общее для API и загрузки документов.
+Модуль зависит только от моделей и синхронной сессии SQLAlchemy.
+"""
+
+import logging
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from src.config import settings
+from src.db.models import CompletionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+def flush_completion_cache_table(db: Session):
+    """
+    Очищает таблицу llm_completion_cache после изменения корпуса.
+
+    Промпт содержит полный текст контекста, поэтому ответы по прежним
+    документам и так не совпадут по ключу: очистка только освобождает место.
+    Уровни в памяти воркеров API сбрасываются через
+    POST /api/v1/cache/completions/flush.
+    """
+    if not settings.COMPLETION_CACHE_DB_ENABLED:
+        return
+    db.execute(delete(CompletionCacheEntry))
+    db.commit()
+    logger.info("Completion cache table flushed.")
@@ -4,6 +4,7 @@ from pgvector.sqlalchemy import Vector
 from sqlalchemy import (
     JSON,
     BigInteger,
+    Boolean,
     Column,
     DateTime,
     Float,
@@ -85,7 +86,51 @@ class QueryHistory(Base):
     llm_provider = Column(String, nullable=False)
     llm_model = Column(String, nullable=False)
     confidence_score = Column(Float, nullable=False)
+    # Домен, которым был ограничен поиск (область действия семантического кэша)
+    domain = Column(Text)
+    # Если ответ взят из семантического кэша — ID исходной записи
+    cache_source_id = Column(BigInteger)
+    # Ответ-заглушка («К сожалению...»): в семантический кэш не попадает
+    is_fallback = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
 
     def __repr__(self):
         return f"<QueryHistory(id={self.id}, user_id={self.user_id})>"
+
+
+class RerankScore(Base):
+    """
+    Общий (для всех воркеров API) уровень кэша оценок ре-ранкера.
+    Записи удаляются каскадно вместе с чанком при переиндексации.
+    """
+
+    __tablename__ = "rerank_score_cache"
+
+    model_name = Column(Text, primary_key=True)
+    query_hash = Column(LargeBinary(16), primary_key=True)  # blake2b-128
+    chunk_id = Column(
+        BigInteger, ForeignKey("chunks.id", ondelete="CASCADE"), primary_key=True
+    )
+    score = Column(Float, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<RerankScore(model='{self.model_name}', chunk_id={self.chunk_id})>"
+
+
+class CompletionCacheEntry(Base):
+    """
+    Общий уровень кэша ответов LLM для детерминированных запросов (temperature=0).
+    Ключ — blake2b-256 от модели, системного сообщения, промпта и параметров генерации.
+    """
+
+    __tablename__ = "llm_completion_cache"
+
+    cache_key = Column(LargeBinary(32), primary_key=True)
+    model = Column(Text, nullable=False)
+    completion = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
+    last_used_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<CompletionCacheEntry(model='{self.model}', key={self.cache_key.hex()[:12]})>"
@@ -0,0 +1,28 @@
+"""
+Курсоры keyset-пагинации истории запросов по (created_at, id).
+
+Курсор — непрозрачная для клиента строка (base64url от JSON), общая для
+API и Django-интерфейса. Модуль не зависит от SQLAlchemy и Django.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+from typing import Tuple
+
+
+def encode_cursor(created_at: datetime.datetime, history_id: int) -> str:
+    """Курсор на позицию записи (created_at, id)."""
+    payload = json.dumps([created_at.isoformat(), history_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """Разбирает курсор; ValueError, если он поврежден."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, history_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.datetime.fromisoformat(created_at), int(history_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from src.config import settings
@@ -11,6 +12,45 @@ engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True, pool_recycle=3
 # Создаем фабрику сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок для API (psycopg3 async). Синхронный движок выше
+# остается для ingestion CLI и других скриптов.
+async_engine = create_async_engine(
+    settings.DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    # Повторяющиеся запросы поиска становятся server-side prepared statements
+    connect_args={"prepare_threshold": settings.DB_PREPARE_THRESHOLD},
+)
+
+# expire_on_commit=False: RAG-движок завершает транзакцию до вызова LLM,
+# чтобы вернуть соединение в пул, и не должен перечитывать объекты после этого
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+
+def _validate_embedding_dim():
+    """
+    Валидация соответствия размерности эмбеддингов модели и колонки БД.
+    """
+    from src.db.models import QueryHistory
+    from src.ingestion.embedding import get_embedding_model
+
+    embedding_model = get_embedding_model()
+    # Получаем Column объект для query_embedding
+    query_embedding_column = QueryHistory.__table__.c.get("query_embedding")
+    if query_embedding_column is not None:
+        db_dim = getattr(query_embedding_column.type, "dim", None)
+        if db_dim is not None and embedding_model.embedding_dim != db_dim:
+            raise ValueError(
+                f"Embedding dimension mismatch: model has {embedding_model.embedding_dim}, "
+                f"but DB column expects {db_dim}. "
+                "Run migrations to update the vector column dimension or change the embedding model."
+            )
+
 
 def get_db():
     """
@@ -19,21 +59,17 @@ def get_db():
     """
     db = SessionLocal()
     try:
-        # Валидация соответствия размерности эмбеддингов модели и колонки БД
-        from src.db.models import QueryHistory
-        from src.ingestion.embedding import get_embedding_model
-
-        embedding_model = get_embedding_model()
-        # Получаем Column объект для query_embedding
-        query_embedding_column = QueryHistory.__table__.c.get("query_embedding")
-        if query_embedding_column is not None:
-            db_dim = getattr(query_embedding_column.type, "dim", None)
-            if db_dim is not None and embedding_model.embedding_dim != db_dim:
-                raise ValueError(
-                    f"Embedding dimension mismatch: model has {embedding_model.embedding_dim}, "
-                    f"but DB column expects {db_dim}. "
-                    "Run migrations to update the vector column dimension or change the embedding model."
-                )
+        _validate_embedding_dim()
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """
+    Зависимость FastAPI для получения асинхронной сессии БД.
+    Запросы к pgvector и запись истории не блокируют event loop.
+    """
+    _validate_embedding_dim()
+    async with AsyncSessionLocal() as db:
+        yield db
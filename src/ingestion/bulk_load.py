@@ -0,0 +1,172 @@
+"""
+Массовая загрузка документов и чанков через COPY ... FROM STDIN (FORMAT BINARY).
+
+Строки пачки документов сначала копируются во временные staging-таблицы
+(эмбеддинги — в бинарном формате pgvector, без текстового представления
+списка float), затем один INSERT ... SELECT переносит их в documents и chunks:
+ID новых документов сопоставляются чанкам на стороне сервера, а документы,
+путь или содержимое которых уже загружены, пропускаются (ON CONFLICT DO NOTHING)
+вместе со своими чанками.
+"""
+
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pgvector.psycopg import register_vector
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Строка documents и строки ее чанков (без document_id)
+DocumentRows = Tuple[Dict[str, Any], List[Dict[str, Any]]]
+
+DOCUMENT_COLUMNS = (
+    "file_path",
+    "source_url",
+    "title",
+    "domain",
+    "content_hash",
+    "full_text",
+    "meta_data",
+)
+CHUNK_COLUMNS = ("chunk_index", "chunk_text", "token_count", "embedding", "meta_data")
+
+# Типы колонок для бинарного COPY (первая колонка — номер документа в пачке)
+_DOCUMENT_TYPES = ["int4", "text", "text", "text", "text", "bytea", "text", "jsonb"]
+_CHUNK_TYPES = ["int4", "int4", "text", "int4", "vector", "jsonb"]
+
+# ON COMMIT DELETE ROWS: staging-таблицы пустеют после каждой пачки
+_CREATE_STAGING = (
+    """
+CREATE TEMP TABLE IF NOT EXISTS ingest_stage_documents (
+    stage_key     INT NOT NULL,
+    file_path     TEXT NOT NULL,
+    source_url    TEXT,
+    title         TEXT,
+    domain        TEXT,
+    content_hash  BYTEA NOT NULL,
+    full_text     TEXT NOT NULL,
+    meta_data     JSONB NOT NULL
+) ON COMMIT DELETE ROWS
+""",
+    """
+CREATE TEMP TABLE IF NOT EXISTS ingest_stage_chunks (
+    stage_key    INT NOT NULL,
+    chunk_index  INT NOT NULL,
+    chunk_text   TEXT NOT NULL,
+    token_count  INT NOT NULL,
+    embedding    vector NOT NULL,
+    meta_data    JSONB NOT NULL
+) ON COMMIT DELETE ROWS
+""",
+)
+
+_COPY_DOCUMENTS = (
+    f"COPY ingest_stage_documents (stage_key, {', '.join(DOCUMENT_COLUMNS)})"
+    " FROM STDIN (FORMAT BINARY)"
+)
+_COPY_CHUNKS = (
+    f"COPY ingest_stage_chunks (stage_key, {', '.join(CHUNK_COLUMNS)})"
+    " FROM STDIN (FORMAT BINARY)"
+)
+
+# Перенос из staging одним запросом. Вставка чанков видит ID документов
+# через RETURNING, внешние ключи проверяются в конце запроса.
+_MERGE_SQL = """
+WITH inserted AS (
+    INSERT INTO documents (file_path, source_url, title, domain, content_hash, full_text, meta_data)
+    SELECT file_path, source_url, title, domain, content_hash, full_text, meta_data
+    FROM ingest_stage_documents
+    ORDER BY stage_key
+    ON CONFLICT DO NOTHING
+    RETURNING id, file_path
+),
+mapped AS (
+    SELECT s.stage_key, i.id AS document_id
+    FROM inserted i
+    JOIN ingest_stage_documents s ON s.file_path = i.file_path
+),
+loaded AS (
+    INSERT INTO chunks (document_id, chunk_index, chunk_text, token_count, embedding, meta_data)
+    SELECT
+        m.document_id,
+        c.chunk_index,
+        c.chunk_text,
+        c.token_count,
+        c.embedding,
+        c.meta_data || jsonb_build_object('document_id', m.document_id)
+    FROM ingest_stage_chunks c
+    JOIN mapped m ON m.stage_key = c.stage_key
+)
+SELECT stage_key, document_id FROM mapped
+"""
+
+
+class CopyBulkLoader:
+    """
+    Загрузчик пачек документов через бинарный COPY в сессии SQLAlchemy
+    (драйвер psycopg 3). Каждая пачка — одна транзакция.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.rows = 0
+        self.seconds = 0.0
+
+    def load(self, documents: Sequence[DocumentRows]) -> List[Optional[int]]:
+        """
+        Загружает пачку документов с чанками и фиксирует транзакцию.
+
+        Returns:
+            ID документа для каждого элемента documents; None — документ
+            пропущен, потому что его путь или содержимое уже есть в БД
+        """
+        started = time.monotonic()
+        conn = self.db.connection().connection.driver_connection
+        if conn.adapters.types.get("vector") is None:
+            # Бинарный дампер pgvector для колонки vector в COPY
+            register_vector(conn)
+
+        with conn.cursor() as cur:
+            for statement in _CREATE_STAGING:
+                cur.execute(statement)
+
+            with cur.copy(_COPY_DOCUMENTS) as copy:
+                copy.set_types(_DOCUMENT_TYPES)
+                for key, (document, _) in enumerate(documents):
+                    copy.write_row((key, *(document[c] for c in DOCUMENT_COLUMNS)))
+
+            chunk_rows = 0
+            with cur.copy(_COPY_CHUNKS) as copy:
+                copy.set_types(_CHUNK_TYPES)
+                for key, (_, chunks) in enumerate(documents):
+                    for chunk in chunks:
+                        copy.write_row((key, *(chunk[c] for c in CHUNK_COLUMNS)))
+                    chunk_rows += len(chunks)
+
+            cur.execute(_MERGE_SQL)
+            document_ids: List[Optional[int]] = [None] * len(documents)
+            for stage_key, document_id in cur.fetchall():
+                document_ids[stage_key] = document_id
+
+        self.db.commit()
+
+        elapsed = time.monotonic() - started
+        loaded = [
+            chunks
+            for (_, chunks), document_id in zip(documents, document_ids, strict=True)
+            if document_id is not None
+        ]
+        self.rows += len(loaded) + sum(len(chunks) for chunks in loaded)
+        self.seconds += elapsed
+        logger.debug(
+            "COPY batch: %d documents, %d staged chunks in %.3fs",
+            len(documents),
+            chunk_rows,
+            elapsed,
+        )
+        return document_ids
+
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
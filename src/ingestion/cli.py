@@ -2,7 +2,7 @@ import argparse
 import logging
 from pathlib import Path
 
-from .pipeline import IngestionPipeline
+from .pipeline import IngestionPipeline, iter_markdown_files
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +20,26 @@ def main():
     parser.add_argument(
         "--recursive", action="store_true", help="Search for files recursively."
     )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help=(
+            "Incremental sync: update modified files re-embedding only changed "
+            "chunks, delete documents whose files were removed."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Chunking worker processes (0 to chunk in-process; default: INGEST_WORKERS).",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help="Documents buffered between pipeline stages (default: INGEST_QUEUE_SIZE).",
+    )
 
     args = parser.parse_args()
 
@@ -28,15 +48,29 @@ def main():
         logger.error("Input path '%s' is not a directory.", input_dir)
         return
 
-    glob_pattern = "**/*.md" if args.recursive else "*.md"
-    file_paths = list(input_dir.glob(glob_pattern))
+    if args.workers is not None and args.workers < 0:
+        parser.error("--workers must be >= 0")
+    if args.queue_size is not None and args.queue_size < 1:
+        parser.error("--queue-size must be >= 1")
 
-    if not file_paths:
-        logger.error("No markdown files found in '%s'.", input_dir)
-        return
+    pipeline = IngestionPipeline(workers=args.workers, queue_size=args.queue_size)
+    if args.sync:
+        pipeline.sync(input_dir, args.domain, args.recursive)
+    else:
+        # Файлы читаются по мере обхода каталога, без предварительного списка
+        pipeline.run(iter_markdown_files(input_dir, args.recursive), args.domain)
 
-    pipeline = IngestionPipeline()
-    pipeline.run(file_paths, args.domain)
+    processed = (
+        pipeline.new_docs_count
+        + pipeline.skipped_docs_count
+        + pipeline.failed_docs_count
+        + pipeline.updated_docs_count
+        + pipeline.unchanged_docs_count
+        + pipeline.renamed_docs_count
+        + pipeline.deleted_docs_count
+    )
+    if not processed:
+        logger.error("No markdown files found in '%s'.", input_dir)
 
 
 if __name__ == "__main__":
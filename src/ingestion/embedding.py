@@ -1,11 +1,13 @@
 import logging
-from typing import List, cast
+from typing import Any, Dict, List, Optional, cast
 
 import torch
 from sentence_transformers import SentenceTransformer
 
 from src.config import settings
 
+from .embedding_cache import EmbeddingCache, get_embedding_cache
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,16 +21,25 @@ class EmbeddingModel:
         self.device = settings.EMBEDDING_DEVICE
         self.batch_size = settings.EMBEDDING_BATCH_SIZE
 
-        if self.device == "cuda" and not torch.cuda.is_available():
+        if settings.INFERENCE_BACKEND == "onnx":
+            # Экспортированная модель на CPU-провайдере onnxruntime
+            self.device = "cpu"
+        elif self.device == "cuda" and not torch.cuda.is_available():
             logger.warning("CUDA is not available. Falling back to CPU.")
             self.device = "cpu"
 
         logger.info(
-            "Initializing embedding model %s on device '%s'...",
+            "Initializing embedding model %s on device '%s' (backend: %s)...",
             self.model_name,
             self.device,
+            settings.INFERENCE_BACKEND,
         )
-        self.model = SentenceTransformer(self.model_name, device=self.device)
+        if settings.INFERENCE_BACKEND == "onnx":
+            from src.onnx_backend import OnnxSentenceEncoder
+
+            self.model = OnnxSentenceEncoder(self.model_name)
+        else:
+            self.model = SentenceTransformer(self.model_name, device=self.device)
         logger.info("Embedding model loaded successfully.")
 
         # Определяем фактическую размерность эмбеддингов модели
@@ -41,13 +52,46 @@ class EmbeddingModel:
                 "Please update EMBEDDING_DIM in .env to match the model's dimension."
             )
 
-    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+    def get_embeddings(
+        self, texts: List[str], cache: bool = False
+    ) -> List[List[float]]:
         """
         Генерирует эмбеддинги для списка текстов батчами.
+        cache=True (загрузка документов) — векторы сначала ищутся в дисковом
+        кэше (см. embedding_cache), модель считает только промахи.
+        Запросы API кэш не используют: они почти не повторяются.
         """
         if not texts:
             return []
 
+        store = self._cache() if cache else None
+        if store is None:
+            return self._encode(texts)
+
+        vectors = store.get(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        logger.info(
+            "Embedding cache: %d of %d chunks found",
+            len(texts) - len(missing),
+            len(texts),
+        )
+        if missing:
+            computed = self._encode([texts[i] for i in missing])
+            store.put([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed, strict=True):
+                vectors[i] = vector
+        return cast(List[List[float]], vectors)
+
+    def cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Статистика кэша эмбеддингов, если он открыт в этом процессе."""
+        store = get_embedding_cache(self.model_name, self.embedding_dim, create=False)
+        return store.stats() if store is not None else None
+
+    def _cache(self) -> Optional[EmbeddingCache]:
+        # Файлы кэша открываются при первом обращении (только при загрузке)
+        return get_embedding_cache(self.model_name, self.embedding_dim)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
         logger.info("Generating embeddings for %d chunks...", len(texts))
 
         embeddings = self.model.encode(
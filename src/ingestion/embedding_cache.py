@@ -0,0 +1,272 @@
+"""
+Дисковый кэш эмбеддингов, адресуемый содержимым.
+
+Ключ — blake2b-256 от имени модели, размерности, варианта инференса (PyTorch,
+ONNX или квантованная int8-модель ONNX: их векторы немного различаются)
+и нормализованного текста, поэтому повторная загрузка того же текста (после
+изменения чанкинга, импорта домена заново или пересоздания БД) берет вектор
+с диска вместо модели. Кэш хранится локально и переживает пересоздание базы.
+
+Векторы лежат в memory-mapped файле float32 размером max_entries x dim,
+индекс (ключ -> слот и отметка последнего использования) — в SQLite рядом
+с ним. При заполнении слоты давно не использованных записей переиспользуются
+(LRU).
+
+Свободные слоты учитываются в памяти процесса, поэтому писать в кэш может
+только один процесс: на время работы берется эксклюзивная блокировка файла
+<stem>.lock, и второй процесс (например, параллельный ingest) работает
+без кэша.
+"""
+
+import fcntl
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Ограничение числа параметров в одном запросе к SQLite
+_SQLITE_BATCH = 500
+
+
+class EmbeddingCacheBusyError(RuntimeError):
+    """Кэш уже открыт другим процессом."""
+
+
+def inference_variant() -> str:
+    """Вариант инференса текущей конфигурации, от которого зависят векторы."""
+    if settings.INFERENCE_BACKEND != "onnx":
+        return settings.INFERENCE_BACKEND
+    return "onnx-int8" if settings.ONNX_QUANTIZED else "onnx"
+
+
+def normalize_chunk_text(text: str) -> str:
+    """
+    Нормализация текста для ключа кэша. В отличие от дедупликации документов
+    регистр и пробелы внутри текста сохраняются: от них зависит эмбеддинг.
+    """
+    return unicodedata.normalize("NFC", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Постоянный LRU-кэш эмбеддингов одной модели. Потокобезопасен; открыть
+    его одновременно может только один процесс (EmbeddingCacheBusyError).
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        model_name: str,
+        dim: int,
+        max_entries: int,
+        variant: str = "torch",
+    ):
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max_entries
+        self.variant = variant
+        self._lock = threading.Lock()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        stem = f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)}-{dim}"
+        # Блокировка держится, пока открыт файл (до close)
+        self._lock_file = open(directory / f"{stem}.lock", "ab")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise EmbeddingCacheBusyError(
+                f"Embedding cache {directory / stem} is in use by another process"
+            ) from None
+
+        self._index = sqlite3.connect(
+            directory / f"{stem}.sqlite", check_same_thread=False
+        )
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key BLOB PRIMARY KEY,"
+            " slot INTEGER NOT NULL UNIQUE,"
+            " last_used INTEGER NOT NULL)"
+        )
+        self._index.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)"
+        )
+        # Лимит уменьшили с прошлого запуска: записи за его пределами теряются
+        self._index.execute("DELETE FROM entries WHERE slot >= ?", (max_entries,))
+        self._index.commit()
+
+        vectors_path = directory / f"{stem}.f32"
+        size = max_entries * dim * 4
+        with open(vectors_path, "ab") as f:
+            # Разреженный файл: место на диске занимают только записанные слоты
+            f.truncate(size)
+        self._vectors = np.memmap(
+            vectors_path, dtype=np.float32, mode="r+", shape=(max_entries, dim)
+        )
+
+        self._size, self._clock = self._index.execute(
+            "SELECT count(*), COALESCE(max(last_used), 0) FROM entries"
+        ).fetchone()
+        # Свободные слоты: после уменьшения лимита нумерация может быть с пропусками
+        used = {row[0] for row in self._index.execute("SELECT slot FROM entries")}
+        self._free = [
+            slot for slot in range(max_entries - 1, -1, -1) if slot not in used
+        ]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text: str) -> bytes:
+        payload = "\0".join(
+            (self.model_name, str(self.dim), self.variant, normalize_chunk_text(text))
+        )
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=32).digest()
+
+    def get(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Векторы из кэша в порядке texts; None — промах."""
+        keys = [self.key(t) for t in texts]
+        with self._lock:
+            slots = self._lookup(set(keys))
+            self._clock += 1
+            self._index.executemany(
+                "UPDATE entries SET last_used = ? WHERE key = ?",
+                [(self._clock, key) for key in slots],
+            )
+            self._index.commit()
+
+            result: List[Optional[List[float]]] = []
+            for key in keys:
+                slot = slots.get(key)
+                result.append(None if slot is None else self._vectors[slot].tolist())
+            found = sum(v is not None for v in result)
+            self.hits += found
+            self.misses += len(result) - found
+            return result
+
+    def put(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """Сохраняет векторы; при заполнении вытесняет давно не использованные."""
+        entries: Dict[bytes, Sequence[float]] = {}
+        for text, vector in zip(texts, vectors, strict=True):
+            entries[self.key(text)] = vector
+        with self._lock:
+            for key in self._lookup(set(entries)):
+                del entries[key]
+            if not entries:
+                return
+            # Больше записей, чем вмещает кэш, сохранить нельзя
+            new = list(entries.items())[-self.max_entries :]
+            slots = self._allocate(len(new))
+            for (_, vector), slot in zip(new, slots, strict=True):
+                self._vectors[slot] = vector
+            self._clock += 1
+            self._index.executemany(
+                "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, slot, self._clock)
+                    for (key, _), slot in zip(new, slots, strict=True)
+                ],
+            )
+            self._index.commit()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._index.close()
+            self._lock_file.close()
+
+    def _lookup(self, keys) -> Dict[bytes, int]:
+        keys = list(keys)
+        slots: Dict[bytes, int] = {}
+        for i in range(0, len(keys), _SQLITE_BATCH):
+            part = keys[i : i + _SQLITE_BATCH]
+            placeholders = ",".join("?" * len(part))
+            slots.update(
+                self._index.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", part
+                ).fetchall()
+            )
+        return slots
+
+    def _allocate(self, count: int) -> List[int]:
+        """Свободные слоты, при нехватке — слоты давно не использованных записей."""
+        slots = [self._free.pop() for _ in range(min(count, len(self._free)))]
+        self._size += len(slots)
+        if len(slots) < count:
+            evicted = self._index.execute(
+                "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?",
+                (count - len(slots),),
+            ).fetchall()
+            self._index.executemany(
+                "DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted]
+            )
+            slots.extend(slot for _, slot in evicted)
+            self.evictions += len(evicted)
+        return slots
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+# Кэш занят другим процессом: в этом прогоне работаем без него
+_embedding_cache_busy = False
+
+
+def get_embedding_cache(
+    model_name: str, dim: int, create: bool = True
+) -> Optional[EmbeddingCache]:
+    """
+    Синглтон кэша; None, если кэш выключен (EMBEDDING_CACHE_ENABLED=False),
+    занят другим процессом или еще не открыт и create=False.
+    """
+    global _embedding_cache, _embedding_cache_busy
+    if not settings.EMBEDDING_CACHE_ENABLED or _embedding_cache_busy:
+        return None
+    if _embedding_cache is None and create:
+        try:
+            _embedding_cache = EmbeddingCache(
+                Path(settings.EMBEDDING_CACHE_DIR),
+                model_name,
+                dim,
+                settings.EMBEDDING_CACHE_MAX_ENTRIES,
+                variant=inference_variant(),
+            )
+        except EmbeddingCacheBusyError as e:
+            logger.warning("%s; continuing without the embedding cache.", e)
+            _embedding_cache_busy = True
+            return None
+        logger.info(
+            "Embedding cache opened: %d/%d entries in %s",
+            _embedding_cache.stats()["entries"],
+            settings.EMBEDDING_CACHE_MAX_ENTRIES,
+            settings.EMBEDDING_CACHE_DIR,
+        )
+    return _embedding_cache
+
+
+def close_embedding_cache():
+    global _embedding_cache, _embedding_cache_busy
+    _embedding_cache_busy = False
+    if _embedding_cache is not None:
+        _embedding_cache.close()
+        _embedding_cache = None
@@ -1,97 +1,708 @@
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
 from src.config import settings
+from src.db.maintenance import flush_completion_cache_table
 from src.db.models import Chunk, Document
 from src.db.session import SessionLocal
 
+from .bulk_load import CopyBulkLoader, DocumentRows
 from .chunking import MarkdownChunker
 from .dedup import Deduplicator, compute_content_hash
 from .embedding import get_embedding_model
+from .embedding_cache import close_embedding_cache
+from .sync import (
+    IndexedChunk,
+    apply_document_update,
+    delete_documents,
+    load_indexed_chunks,
+    load_indexed_documents,
+    plan_chunk_reuse,
+)
 
 logger = logging.getLogger(__name__)
 
+# Конец потока документов между стадиями
+_DONE = object()
+
+
+class _Aborted(Exception):
+    """Другая стадия конвейера завершилась с ошибкой."""
+
+
+def iter_markdown_files(
+    root: Path, recursive: bool = False, failed_dirs: Optional[List[Path]] = None
+) -> Iterator[Path]:
+    """
+    Потоковый обход каталога через os.scandir: файлы отдаются по мере
+    обнаружения, полный список путей в памяти не строится. Каталоги, которые
+    не удалось прочитать, добавляются в failed_dirs.
+    """
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append(Path(entry.path))
+                    elif entry.name.endswith(".md") and entry.is_file():
+                        yield Path(entry.path)
+        except OSError as e:
+            logger.error("Cannot read directory %s: %s", directory, e)
+            if failed_dirs is not None:
+                failed_dirs.append(directory)
+
+
+# --- Чанкинг в пуле процессов ---
+
+_worker_chunker: Optional[MarkdownChunker] = None
+
+
+def _init_chunker_worker(chunk_size: int, chunk_overlap: int):
+    """Инициализатор процесса пула: токенизатор загружается один раз на процесс."""
+    global _worker_chunker
+    _worker_chunker = MarkdownChunker(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+
+
+def _chunk_in_worker(
+    content: str, doc_metadata: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    assert _worker_chunker is not None
+    return _worker_chunker.chunk(content, doc_metadata)
+
+
+class _SourceDocument:
+    """
+    Документ, прошедший чтение и дедупликацию, на пути через стадии.
+    Для измененного документа (режим sync) задан document_id, а plan
+    указывает сохраненные чанки, эмбеддинги которых не пересчитываются.
+    """
+
+    __slots__ = (
+        "path",
+        "content",
+        "content_hash",
+        "chunks",
+        "embeddings",
+        "document_id",
+        "previous_chunks",
+        "plan",
+    )
+
+    def __init__(self, path: Path, content: str, content_hash: bytes):
+        self.path = path
+        self.content = content
+        self.content_hash = content_hash
+        self.chunks: List[Dict[str, Any]] = []
+        self.embeddings: List[List[float]] = []
+        self.document_id: Optional[int] = None
+        self.previous_chunks: List[IndexedChunk] = []
+        self.plan: List[Optional[IndexedChunk]] = []
+
+    def pending_chunks(self) -> List[int]:
+        """Номера чанков, которым нужен эмбеддинг."""
+        if self.document_id is None:
+            return list(range(len(self.chunks)))
+        return [i for i, previous in enumerate(self.plan) if previous is None]
+
 
 class IngestionPipeline:
-    def __init__(self):
-        self.chunker = MarkdownChunker(
-            chunk_size=settings.CHUNK_SIZE,
-            chunk_overlap=settings.CHUNK_OVERLAP,
+    """
+    Конвейер загрузки документов из стадий, связанных ограниченными очередями:
+
+    1. обход каталога, чтение, хэширование и дедупликация (основной поток);
+    2. чанкинг в пуле из workers процессов (токенизация занимает CPU);
+    3. эмбеддинги на единственном экземпляре модели (отдельный поток):
+       чанки нескольких документов считаются общими полными батчами;
+    4. запись в БД отдельным писателем со своей сессией (отдельный поток):
+       пачки документов загружаются через COPY (см. bulk_load).
+
+    Пока модель считает эмбеддинги одного документа, следующие уже режутся
+    на чанки, а предыдущие записываются. Каждая очередь вмещает не больше
+    queue_size документов: медленная стадия притормаживает предыдущие,
+    и память не растет с размером корпуса.
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None):
+        if workers is None:
+            workers = settings.INGEST_WORKERS
+        if workers is None:
+            # Одно ядро остается модели эмбеддингов и писателю
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.workers = workers
+        self.queue_size = queue_size or settings.INGEST_QUEUE_SIZE
+        # Сколько чанков копится из разных документов перед вызовом модели
+        self.embed_pool_chunks = (
+            settings.EMBEDDING_BATCH_SIZE * settings.INGEST_EMBED_POOL_BATCHES
         )
+        self.write_mode = settings.INGEST_WRITE_MODE
+        self.write_batch_docs = settings.INGEST_WRITE_BATCH_DOCS
+        self._write_rate: Optional[float] = None
+
         self.embedding_model = get_embedding_model()
         self.db: Session = SessionLocal()
         self.deduplicator = Deduplicator(self.db)
 
-    def run(self, file_paths: List[Path], domain: str):
+        self._embed_queue: "queue.Queue[Any]" = queue.Queue(self.queue_size)
+        self._write_queue: "queue.Queue[Any]" = queue.Queue(self.queue_size)
+        self._failed = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._progress: Optional[tqdm] = None
+        # Режим sync: еще не встреченные при обходе документы каталога
+        # (путь -> ID и хэш); оставшиеся после обхода удаляются
+        self._indexed: Optional[Dict[str, Tuple[int, bytes]]] = None
+        self._indexed_by_hash: Dict[bytes, str] = {}
+        # Каталоги, которые не удалось прочитать при обходе: их документы
+        # не удаляются
+        self._unlisted_dirs: List[Path] = []
+
+        # Статистика
+        self.new_docs_count = 0
+        self.skipped_docs_count = 0
+        self.failed_docs_count = 0
+        self.total_chunks_count = 0
+        self.updated_docs_count = 0
+        self.unchanged_docs_count = 0
+        self.renamed_docs_count = 0
+        self.deleted_docs_count = 0
+        self.reused_chunks_count = 0
+
+    def sync(self, root: Path, domain: str, recursive: bool = False):
+        """
+        Инкрементальная синхронизация каталога с БД: новые файлы загружаются,
+        измененные обновляются с пересчетом эмбеддингов только для измененных
+        чанков, документы удаленных файлов удаляются.
+        """
+        self._indexed = load_indexed_documents(self.db, root, recursive)
+        self._indexed_by_hash = {
+            content_hash: path for path, (_, content_hash) in self._indexed.items()
+        }
+        logger.info("Documents already indexed from '%s': %d", root, len(self._indexed))
+        self._unlisted_dirs = []
+        self.run(iter_markdown_files(root, recursive, self._unlisted_dirs), domain)
+
+    def run(self, file_paths: Iterable[Path], domain: str):
         """
         Запускает полный конвейер обработки и загрузки документов.
+        file_paths может быть генератором (см. iter_markdown_files).
         """
         logger.info(
-            "Starting ingestion for %d files from domain '%s'...", len(file_paths), domain
+            "Starting ingestion from domain '%s' (chunking workers: %d, queue size: %d)...",
+            domain,
+            self.workers,
+            self.queue_size,
         )
+        started = time.monotonic()
+        try:
+            self._run_stages(file_paths, domain)
 
-        new_docs_count = 0
-        skipped_docs_count = 0
-        total_chunks_count = 0
+            if self._indexed is not None:
+                self._keep_unlisted()
+            if self._indexed:
+                # Файлы этих документов не встретились при обходе
+                self.deleted_docs_count = delete_documents(
+                    self.db, [document_id for document_id, _ in self._indexed.values()]
+                )
 
-        for path in tqdm(file_paths, desc="Processing files"):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
+            if (
+                self.new_docs_count
+                or self.updated_docs_count
+                or self.renamed_docs_count
+                or self.deleted_docs_count
+            ):
+                # Ответы по прежнему контексту больше не совпадут по ключу:
+                # освобождаем место в общей таблице кэша ответов LLM
+                flush_completion_cache_table(self.db)
+
+            self._log_summary(time.monotonic() - started)
+        finally:
+            # И при сбое стадии: кэш эмбеддингов сбрасывается на диск
+            # и снимает блокировку для следующих прогонов
+            self.db.close()
+            close_embedding_cache()
+
+    def _run_stages(self, file_paths: Iterable[Path], domain: str):
+        """Чтение и чанкинг в текущем потоке, эмбеддинги и запись — в потоках стадий."""
+        self._progress = tqdm(desc="Ingesting files", unit="file")
+
+        stages = [
+            threading.Thread(
+                target=self._stage, args=(self._embed_stage,), name="ingest-embed"
+            ),
+            threading.Thread(
+                target=self._stage, args=(self._write_stage,), name="ingest-write"
+            ),
+        ]
+        for thread in stages:
+            thread.start()
+
+        try:
+            self._read_and_chunk(file_paths, domain)
+            self._put(self._embed_queue, _DONE)
+        except _Aborted:
+            pass
+        except BaseException:
+            self._failed.set()
+            raise
+        finally:
+            for thread in stages:
+                thread.join()
+            self._progress.close()
+
+        if self._failed.is_set():
+            raise RuntimeError(
+                "Ingestion aborted: a pipeline stage failed (see the log)."
+            )
+
+    def _keep_unlisted(self):
+        """
+        Убирает из кандидатов на удаление документы из каталогов, которые не
+        удалось прочитать: отсутствие их файлов при обходе ничего не значит.
+        """
+        assert self._indexed is not None
+        prefixes = tuple(
+            os.path.join(str(directory.resolve()), "")
+            for directory in self._unlisted_dirs
+        )
+        kept = [
+            path for path in self._indexed if prefixes and path.startswith(prefixes)
+        ]
+        for path in kept:
+            del self._indexed[path]
+        if kept:
+            logger.warning(
+                "Keeping %d documents under unreadable directories.", len(kept)
+            )
+
+    def _log_summary(self, elapsed: float):
+        logger.info("\n--- Ingestion Complete ---")
+        logger.info("New documents processed: %d", self.new_docs_count)
+        logger.info("Duplicate documents skipped: %d", self.skipped_docs_count)
+        logger.info("Failed documents: %d", self.failed_docs_count)
+        logger.info("Total chunks created: %d", self.total_chunks_count)
+        if self._indexed is not None:
+            logger.info("Updated documents: %d", self.updated_docs_count)
+            logger.info("Unchanged documents: %d", self.unchanged_docs_count)
+            logger.info("Renamed documents: %d", self.renamed_docs_count)
+            logger.info("Deleted documents: %d", self.deleted_docs_count)
+            logger.info(
+                "Chunks reused without re-embedding: %d", self.reused_chunks_count
+            )
+        if self._write_rate is not None:
+            logger.info("Bulk write rate: %.0f rows/s", self._write_rate)
+        cache_stats = self.embedding_model.cache_stats()
+        if cache_stats is not None:
+            logger.info(
+                "Embedding cache: %d hits, %d misses (hit rate %.1f%%), %d evictions",
+                cache_stats["hits"],
+                cache_stats["misses"],
+                cache_stats["hit_rate"] * 100,
+                cache_stats["evictions"],
+            )
+        logger.info("Elapsed: %.1fs", elapsed)
 
-                content_hash = compute_content_hash(content)
+    # --- Стадии ---
 
-                if self.deduplicator.is_duplicate(content_hash):
-                    skipped_docs_count += 1
+    def _read_and_chunk(self, file_paths: Iterable[Path], domain: str):
+        """
+        Читает файлы и отправляет их в пул чанкинга. В работе одновременно
+        не больше queue_size документов; готовые передаются дальше в порядке
+        отправки.
+        """
+        doc_metadata = {"domain": domain}
+        in_flight: Deque[tuple] = deque()
+        pool = (
+            ProcessPoolExecutor(
+                max_workers=self.workers,
+                # spawn: fork процесса с работающими потоками стадий и моделью небезопасен
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_chunker_worker,
+                initargs=(settings.CHUNK_SIZE, settings.CHUNK_OVERLAP),
+            )
+            if self.workers > 0
+            else None
+        )
+        # Без пула (workers=0) чанкинг идет в текущем процессе
+        local_chunker = (
+            None
+            if pool
+            else MarkdownChunker(
+                chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP
+            )
+        )
+
+        try:
+            for path in file_paths:
+                document = self._read(path)
+                if document is None:
                     continue
+                if pool is None:
+                    assert local_chunker is not None
+                    future: Future = Future()
+                    try:
+                        future.set_result(
+                            local_chunker.chunk(document.content, doc_metadata)
+                        )
+                    except Exception as e:
+                        future.set_exception(e)
+                else:
+                    future = pool.submit(
+                        _chunk_in_worker, document.content, doc_metadata
+                    )
+                in_flight.append((document, future))
+                if len(in_flight) >= self.queue_size:
+                    self._collect_chunks(*in_flight.popleft())
+            while in_flight:
+                self._collect_chunks(*in_flight.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    def _read(self, path: Path) -> Optional[_SourceDocument]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error("Error reading file %s: %s", path, e)
+            if self._indexed is not None:
+                # Файл на месте, но не читается: сохраненный документ не удаляется
+                self._indexed.pop(str(path.resolve()), None)
+            self._document_failed()
+            return None
+
+        content_hash = compute_content_hash(content)
+        indexed = None
+        if self._indexed is not None:
+            indexed = self._indexed.pop(str(path.resolve()), None)
+        if indexed is not None:
+            document_id, indexed_hash = indexed
+            if indexed_hash == content_hash:
+                self._count("unchanged_docs_count")
+                return None
+            # Измененный файл: чанки сравниваются с сохраненными после чанкинга
+            self.deduplicator.add_hash(content_hash)
+            document = _SourceDocument(path, content, content_hash)
+            document.document_id = document_id
+            document.previous_chunks = load_indexed_chunks(self.db, document_id)
+            return document
 
-                document = Document(
-                    file_path=str(path.resolve()),
-                    source_url=None,
-                    title=path.stem,
-                    domain=domain,
-                    content_hash=content_hash,
-                    full_text=content,
-                    metadata={"source": "markdown_files"},
+        if self.deduplicator.is_duplicate(content_hash):
+            if not self._rename(path, content_hash):
+                self._count("skipped_docs_count")
+            return None
+        # Одинаковые файлы внутри одного прогона тоже пропускаются
+        self.deduplicator.add_hash(content_hash)
+        return _SourceDocument(path, content, content_hash)
+
+    def _rename(self, path: Path, content_hash: bytes) -> bool:
+        """
+        Режим sync: файл с уже загруженным содержимым, прежнего файла которого
+        больше нет, считается переименованным — меняется только путь документа.
+        """
+        if self._indexed is None:
+            return False
+        old_path = self._indexed_by_hash.get(content_hash)
+        if (
+            old_path is None
+            or old_path not in self._indexed
+            or os.path.exists(old_path)
+        ):
+            return False
+        document_id, _ = self._indexed.pop(old_path)
+        self.db.execute(
+            update(Document)
+            .where(Document.id == document_id)
+            .values(file_path=str(path.resolve()), title=path.stem)
+        )
+        self.db.commit()
+        self._count("renamed_docs_count")
+        return True
+
+    def _collect_chunks(self, document: _SourceDocument, future: Future):
+        try:
+            document.chunks = future.result()
+        except Exception as e:
+            logger.error("Error chunking file %s: %s", document.path, e)
+            self._document_failed()
+            return
+        if not document.chunks:
+            if document.document_id is not None:
+                # Файл опустел: документ удаляется, как и для удаленного файла
+                self._indexed[str(document.path.resolve())] = (
+                    document.document_id,
+                    document.content_hash,
                 )
-                self.db.add(document)
-                self.db.flush()
+            self._count()
+            return
+        if document.document_id is not None:
+            document.plan = plan_chunk_reuse(document.previous_chunks, document.chunks)
+            document.previous_chunks = []
+        # Текст документа нужен только для записи; до нее он ждет в очередях
+        self._put(self._embed_queue, document)
 
-                doc_metadata = {"document_id": document.id, "domain": domain}
-                chunks_data = self.chunker.chunk(content, doc_metadata)
+    def _embed_stage(self):
+        """
+        Небольшие документы дают по 2-3 чанка, и вызов модели на каждый
+        документ — это батчи из одного паддинга. Поэтому документы копятся,
+        пока их чанков не наберется на embed_pool_chunks, и считаются вместе.
+        """
+        pool: List[_SourceDocument] = []
+        pooled_chunks = 0
+        while True:
+            document = self._get(self._embed_queue)
+            if document is _DONE:
+                self._embed_documents(pool)
+                self._put(self._write_queue, _DONE)
+                return
+            pool.append(document)
+            pooled_chunks += len(document.pending_chunks())
+            if pooled_chunks >= self.embed_pool_chunks:
+                self._embed_documents(pool)
+                pool = []
+                pooled_chunks = 0
 
-                if not chunks_data:
-                    continue
+    def _embed_documents(self, documents: List[_SourceDocument]):
+        """
+        Эмбеддинги чанков всех документов одним вызовом модели. Чанки
+        сортируются по числу токенов, чтобы соседние в батче были близки
+        по длине; векторы раскладываются обратно по документам, и документ
+        уходит писателю только целиком.
+        """
+        if not documents:
+            return
+        refs = sorted(
+            (
+                (document, i)
+                for document in documents
+                for i in document.pending_chunks()
+            ),
+            key=lambda ref: ref[0].chunks[ref[1]]["token_count"],
+        )
+        try:
+            vectors = self.embedding_model.get_embeddings(
+                [document.chunks[i]["text"] for document, i in refs], cache=True
+            )
+        except Exception as e:
+            if len(documents) == 1:
+                logger.error("Error embedding file %s: %s", documents[0].path, e)
+                self._document_failed()
+                return
+            # Ошибка одного документа не должна терять остальные из пула
+            logger.warning(
+                "Embedding of %d pooled documents failed (%s), retrying one by one",
+                len(documents),
+                e,
+            )
+            for document in documents:
+                self._embed_documents([document])
+            return
 
-                chunk_texts = [c["text"] for c in chunks_data]
-                embeddings = self.embedding_model.get_embeddings(chunk_texts)
-
-                for i, chunk_data in enumerate(chunks_data):
-                    chunk = Chunk(
-                        document_id=document.id,
-                        chunk_index=chunk_data["metadata"]["chunk_index"],
-                        chunk_text=chunk_data["text"],
-                        token_count=chunk_data["token_count"],
-                        embedding=embeddings[i],
-                        metadata=chunk_data["metadata"],
+        for document in documents:
+            document.embeddings = [[] for _ in document.chunks]
+        for (document, i), vector in zip(refs, vectors, strict=True):
+            document.embeddings[i] = vector
+        for document in documents:
+            self._put(self._write_queue, document)
+
+    def _write_stage(self):
+        """
+        Писатель забирает из очереди все готовые документы (до
+        write_batch_docs) и записывает их одной пачкой.
+        """
+        db = SessionLocal()
+        loader = CopyBulkLoader(db) if self.write_mode == "copy" else None
+        try:
+            done = False
+            while not done:
+                batch, done = self._next_write_batch()
+                new_documents = []
+                for document in batch:
+                    if document.document_id is not None:
+                        self._update_document(db, document)
+                    else:
+                        new_documents.append(document)
+                if loader is not None:
+                    self._copy_documents(db, loader, new_documents)
+                else:
+                    for document in new_documents:
+                        self._insert_document(db, document)
+        finally:
+            if loader is not None and loader.rows:
+                self._write_rate = loader.rows_per_second()
+            db.close()
+
+    def _next_write_batch(self) -> Tuple[List[_SourceDocument], bool]:
+        """Ждет первый документ и добирает уже готовые; True — вход исчерпан."""
+        batch = [self._get(self._write_queue)]
+        while batch[-1] is not _DONE and len(batch) < self.write_batch_docs:
+            try:
+                batch.append(self._write_queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is _DONE:
+            return batch[:-1], True
+        return batch, False
+
+    def _copy_documents(
+        self, db: Session, loader: CopyBulkLoader, documents: List[_SourceDocument]
+    ):
+        if not documents:
+            return
+        try:
+            document_ids = loader.load([self._document_rows(d) for d in documents])
+        except Exception as e:
+            db.rollback()
+            if len(documents) == 1:
+                logger.error("Error writing file %s: %s", documents[0].path, e)
+                self._document_failed()
+                return
+            # Пачка откатывается целиком; документы повторяются по одному
+            logger.warning(
+                "Bulk write of %d documents failed (%s), retrying one by one",
+                len(documents),
+                e,
+            )
+            for document in documents:
+                self._copy_documents(db, loader, [document])
+            return
+
+        for document, document_id in zip(documents, document_ids, strict=True):
+            if document_id is None:
+                logger.warning(
+                    "Skipping %s: a document with this path or content already exists",
+                    document.path,
+                )
+                self._count("skipped_docs_count")
+            else:
+                self._count("new_docs_count", chunks=len(document.chunks))
+
+    def _insert_document(self, db: Session, document: _SourceDocument):
+        """Построчная запись через ORM (INGEST_WRITE_MODE=orm)."""
+        document_row, chunk_rows = self._document_rows(document)
+        try:
+            row = Document(**document_row)
+            db.add(row)
+            db.flush()
+            for chunk_row in chunk_rows:
+                db.add(
+                    Chunk(
+                        **chunk_row,
+                        document_id=row.id,
+                        meta_data={**chunk_row["meta_data"], "document_id": row.id},
                     )
-                    self.db.add(chunk)
+                )
+            db.commit()
+        except Exception as e:
+            logger.error("Error writing file %s: %s", document.path, e)
+            db.rollback()
+            self._document_failed()
+            return
+        self._count("new_docs_count", chunks=len(document.chunks))
 
-                self.db.commit()
-                self.deduplicator.add_hash(content_hash)
-                new_docs_count += 1
-                total_chunks_count += len(chunks_data)
+    def _update_document(self, db: Session, document: _SourceDocument):
+        """Измененный документ (режим sync) обновляется в одной транзакции."""
+        assert document.document_id is not None
+        document_row, chunk_rows = self._document_rows(document)
+        try:
+            apply_document_update(
+                db, document.document_id, document_row, chunk_rows, document.plan
+            )
+            db.commit()
+        except Exception as e:
+            logger.error("Error updating file %s: %s", document.path, e)
+            db.rollback()
+            self._document_failed()
+            return
+        embedded = len(document.pending_chunks())
+        self._count(
+            "updated_docs_count",
+            chunks=embedded,
+            reused=len(document.chunks) - embedded,
+        )
 
-            except Exception as e:
-                logger.error("Error processing file %s: %s", path, e)
-                self.db.rollback()
+    @staticmethod
+    def _document_rows(document: _SourceDocument) -> DocumentRows:
+        """Строки documents и chunks; document_id проставляется при записи."""
+        document_row = {
+            "file_path": str(document.path.resolve()),
+            "source_url": None,
+            "title": document.path.stem,
+            "domain": document.chunks[0]["metadata"].get("domain"),
+            "content_hash": document.content_hash,
+            "full_text": document.content,
+            "meta_data": {"source": "markdown_files"},
+        }
+        chunk_rows = [
+            {
+                "chunk_index": chunk["metadata"]["chunk_index"],
+                "chunk_text": chunk["text"],
+                "token_count": chunk["token_count"],
+                "embedding": embedding,
+                "meta_data": chunk["metadata"],
+            }
+            for chunk, embedding in zip(
+                document.chunks, document.embeddings, strict=True
+            )
+        ]
+        return document_row, chunk_rows
 
-        self.db.close()
-        logger.info("\n--- Ingestion Complete ---")
-        logger.info("New documents processed: %d", new_docs_count)
-        logger.info("Duplicate documents skipped: %d", skipped_docs_count)
-        logger.info("Total chunks created: %d", total_chunks_count)
+    # --- Служебное ---
+
+    def _stage(self, target):
+        """Поток стадии: сбой останавливает остальные стадии."""
+        try:
+            target()
+        except _Aborted:
+            pass
+        except BaseException:
+            logger.exception(
+                "Ingestion stage %s failed", threading.current_thread().name
+            )
+            self._failed.set()
+
+    def _put(self, target: "queue.Queue[Any]", item: Any):
+        """Ожидание места в очереди (backpressure) с проверкой сбоя других стадий."""
+        while not self._failed.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise _Aborted()
+
+    def _get(self, source: "queue.Queue[Any]") -> Any:
+        while not self._failed.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        raise _Aborted()
+
+    def _document_failed(self):
+        self._count("failed_docs_count")
+
+    def _count(self, counter: Optional[str] = None, chunks: int = 0, reused: int = 0):
+        """Учет обработанного файла (стадии работают в разных потоках)."""
+        with self._stats_lock:
+            if counter is not None:
+                setattr(self, counter, getattr(self, counter) + 1)
+            self.total_chunks_count += chunks
+            self.reused_chunks_count += reused
+            if self._progress is not None:
+                self._progress.update(1)
@@ -0,0 +1,166 @@
+"""
+Инкрементальная синхронизация каталога с БД (ingest --sync).
+
+Файлы сопоставляются с документами по пути и хэшу содержимого: неизменные
+пропускаются, новые загружаются как обычно, а измененные режутся на чанки
+заново и сравниваются со старыми по хэшу текста чанка. Чанки с тем же текстом
+сохраняют строку и эмбеддинг (меняются только номер и метаданные), новые
+считаются моделью, исчезнувшие удаляются. Документы, файлов которых больше
+нет, удаляются вместе с чанками.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from src.db.models import Chunk, Document
+
+# Удаление документов порциями, чтобы не собирать огромный IN (...)
+_DELETE_BATCH_SIZE = 1000
+
+
+class IndexedChunk(NamedTuple):
+    """Чанк, уже сохраненный в БД."""
+
+    id: int
+    chunk_index: int
+    text_hash: bytes
+    meta_data: Dict[str, Any]
+
+
+def compute_chunk_hash(text: str) -> bytes:
+    """
+    Хэш текста чанка. Эмбеддинг зависит только от текста, поэтому текст
+    не нормализуется: любое изменение требует пересчета.
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def load_indexed_documents(
+    db: Session, root: Path, recursive: bool
+) -> Dict[str, Tuple[int, bytes]]:
+    """
+    Документы, загруженные из каталога root: путь -> (ID, хэш содержимого).
+    Без recursive учитываются только файлы непосредственно в root, как при обходе.
+    """
+    root_path = str(root.resolve())
+    rows = db.execute(
+        select(Document.file_path, Document.id, Document.content_hash).where(
+            Document.file_path.startswith(root_path + os.sep, autoescape=True)
+        )
+    ).all()
+    return {
+        row.file_path: (row.id, row.content_hash)
+        for row in rows
+        if recursive or os.path.dirname(row.file_path) == root_path
+    }
+
+
+def load_indexed_chunks(db: Session, document_id: int) -> List[IndexedChunk]:
+    rows = db.execute(
+        select(Chunk.id, Chunk.chunk_index, Chunk.chunk_text, Chunk.meta_data)
+        .where(Chunk.document_id == document_id)
+        .order_by(Chunk.chunk_index)
+    ).all()
+    return [
+        IndexedChunk(r.id, r.chunk_index, compute_chunk_hash(r.chunk_text), r.meta_data)
+        for r in rows
+    ]
+
+
+def plan_chunk_reuse(
+    previous: Sequence[IndexedChunk], chunks: Sequence[Dict[str, Any]]
+) -> List[Optional[IndexedChunk]]:
+    """
+    Для каждого нового чанка — сохраненный чанк с тем же текстом, если он есть
+    (каждый старый чанк используется не больше одного раза); None — чанк новый
+    и ему нужен эмбеддинг.
+    """
+    by_hash: Dict[bytes, List[IndexedChunk]] = {}
+    for chunk in previous:
+        by_hash.setdefault(chunk.text_hash, []).append(chunk)
+    plan: List[Optional[IndexedChunk]] = []
+    for chunk in chunks:
+        candidates = by_hash.get(compute_chunk_hash(chunk["text"]))
+        plan.append(candidates.pop(0) if candidates else None)
+    return plan
+
+
+def apply_document_update(
+    db: Session,
+    document_id: int,
+    document_row: Dict[str, Any],
+    chunk_rows: Sequence[Dict[str, Any]],
+    plan: Sequence[Optional[IndexedChunk]],
+):
+    """
+    Приводит сохраненный документ к новой версии (без commit): обновляет
+    строку документа, удаляет исчезнувшие чанки, перенумеровывает
+    сохраненные и вставляет новые.
+    """
+    kept = [previous.id for previous in plan if previous is not None]
+    db.execute(
+        delete(Chunk).where(Chunk.document_id == document_id, Chunk.id.not_in(kept)),
+        execution_options={"synchronize_session": False},
+    )
+
+    # Сдвинутые чанки сначала получают временные отрицательные номера,
+    # чтобы перенумерация не нарушала UNIQUE (document_id, chunk_index)
+    moved = []
+    for row, previous in zip(chunk_rows, plan, strict=True):
+        if previous is None:
+            continue
+        meta_data = {**row["meta_data"], "document_id": document_id}
+        if (
+            previous.chunk_index != row["chunk_index"]
+            or previous.meta_data != meta_data
+        ):
+            moved.append(
+                {
+                    "id": previous.id,
+                    "chunk_index": -row["chunk_index"] - 1,
+                    "meta_data": meta_data,
+                }
+            )
+    if moved:
+        db.execute(update(Chunk), moved)
+
+    added = [
+        {
+            **row,
+            "document_id": document_id,
+            "meta_data": {**row["meta_data"], "document_id": document_id},
+        }
+        for row, previous in zip(chunk_rows, plan, strict=True)
+        if previous is None
+    ]
+    if added:
+        db.execute(insert(Chunk), added)
+
+    if moved:
+        db.execute(
+            update(Chunk)
+            .where(Chunk.document_id == document_id, Chunk.chunk_index < 0)
+            .values(chunk_index=-Chunk.chunk_index - 1),
+            execution_options={"synchronize_session": False},
+        )
+    db.execute(
+        update(Document).where(Document.id == document_id).values(**document_row),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def delete_documents(db: Session, document_ids: Sequence[int]) -> int:
+    """Удаляет документы (чанки удаляются каскадно) и фиксирует транзакцию."""
+    ids = list(document_ids)
+    for i in range(0, len(ids), _DELETE_BATCH_SIZE):
+        db.execute(
+            delete(Document).where(Document.id.in_(ids[i : i + _DELETE_BATCH_SIZE])),
+            execution_options={"synchronize_session": False},
+        )
+    db.commit()
+    return len(ids)
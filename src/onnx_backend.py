@@ -0,0 +1,143 @@
+"""
+CPU-инференс экспортированных в ONNX моделей (INFERENCE_BACKEND=onnx).
+
+Модели экспортируются заранее скриптом scripts/export_onnx.py в каталог
+ONNX_MODEL_DIR/<имя модели>. Классы ниже повторяют используемую часть
+интерфейса SentenceTransformer.encode и CrossEncoder.predict, поэтому
+EmbeddingModel и RerankerModel работают с ними без изменений остального кода.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+EXPORT_META_FILE = "export.json"
+
+
+def onnx_model_dir(model_name: str, base_dir: Optional[str] = None) -> Path:
+    """Каталог экспортированной модели: ONNX_MODEL_DIR/org__name."""
+    return Path(base_dir or settings.ONNX_MODEL_DIR) / model_name.replace("/", "__")
+
+
+def onnx_model_file(quantized: bool) -> str:
+    return "model.int8.onnx" if quantized else "model.onnx"
+
+
+def create_session(path: Path):
+    """Сессия onnxruntime на CPU-провайдере с полным набором оптимизаций графа."""
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError(
+            "INFERENCE_BACKEND=onnx requires onnxruntime. Install it with: pip install -e '.[onnx]'"
+        ) from e
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if settings.ONNX_INTRA_OP_THREADS:
+        options.intra_op_num_threads = settings.ONNX_INTRA_OP_THREADS
+    return onnxruntime.InferenceSession(
+        str(path), options, providers=["CPUExecutionProvider"]
+    )
+
+
+class _OnnxModel:
+    def __init__(
+        self,
+        model_name: str,
+        max_length: Optional[int] = None,
+        quantized: Optional[bool] = None,
+    ):
+        from transformers import AutoTokenizer
+
+        if quantized is None:
+            quantized = settings.ONNX_QUANTIZED
+        self.model_dir = onnx_model_dir(model_name)
+        path = self.model_dir / onnx_model_file(quantized)
+        if not path.exists():
+            raise FileNotFoundError(
+                f"ONNX model for '{model_name}' not found at {path}. "
+                f"Run: python scripts/export_onnx.py{' --quantize' if quantized else ''}"
+            )
+
+        logger.info("Loading ONNX model %s", path)
+        self.meta: Dict[str, Any] = json.loads(
+            (self.model_dir / EXPORT_META_FILE).read_text(encoding="utf-8")
+        )
+        self.session = create_session(path)
+        self.tokenizer = AutoTokenizer.from_pretrained(str(self.model_dir))
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.max_length = min(
+            max_length or self.meta["max_length"], self.meta["max_length"]
+        )
+
+    def _run(self, *texts: List[str]) -> np.ndarray:
+        # Паддинг до самой длинной последовательности батча, а не до max_length
+        features = self.tokenizer(
+            *texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        feeds = {name: features[name].astype(np.int64) for name in self.input_names}
+        return self.session.run(None, feeds)[0]
+
+
+class OnnxSentenceEncoder(_OnnxModel):
+    """Модель эмбеддингов (трансформер + pooling) в onnxruntime."""
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.meta["embedding_dim"])
+
+    def encode(
+        self,
+        texts: Sequence[str],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        normalize_embeddings: bool = False,
+    ) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        embeddings = np.concatenate(
+            [
+                self._run(list(texts[i : i + batch_size]))
+                for i in range(0, len(texts), batch_size)
+            ]
+        )
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.clip(norms, 1e-12, None)
+        return embeddings
+
+
+class OnnxCrossEncoder(_OnnxModel):
+    """Cross-encoder ре-ранжирования в onnxruntime."""
+
+    def predict(
+        self,
+        pairs: Sequence[Tuple[str, str]],
+        show_progress_bar: bool = False,
+        batch_size: int = 32,
+    ) -> np.ndarray:
+        if not pairs:
+            return np.zeros((0,), dtype=np.float32)
+
+        scores = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i : i + batch_size]
+            logits = self._run([q for q, _ in batch], [t for _, t in batch])
+            if logits.shape[1] == 1:
+                # Как CrossEncoder: сигмоида для модели с одной меткой
+                scores.append(1 / (1 + np.exp(-logits[:, 0])))
+            else:
+                scores.append(logits)
+        return np.concatenate(scores)
@@ -1,14 +1,27 @@
 import httpx
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
+from django.db.models import Q
 from django.shortcuts import get_object_or_404, redirect, render
 
 from src.config import settings as api_settings
+from src.db.pagination import decode_cursor, encode_cursor
 
 from .models import QueryHistory
 
 API_BASE_URL = f"http://{api_settings.API_HOST}:{api_settings.API_PORT}/api/v1"
 
+HISTORY_PAGE_SIZE = 10
+# Поля для списка истории: без response_md и sources_json
+HISTORY_LIST_FIELDS = ("id", "query_text", "created_at")
+
+
+def _parse_cursor(cursor):
+    return decode_cursor(cursor) if cursor else None
+
+
+def _item_cursor(item):
+    return encode_cursor(item.created_at, item.pk)
+
 
 @login_required
 def home_view(request):
@@ -42,13 +55,48 @@ def home_view(request):
 
 @login_required
 def history_list_view(request):
-    history_qs = QueryHistory.objects.filter(user=request.user).order_by("-created_at")
-
-    paginator = Paginator(history_qs, 10)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    """
+    Список истории с keyset-пагинацией по (created_at, id): ?before=<курсор> —
+    более старые записи, ?after=<курсор> — более новые. Без COUNT(*) и OFFSET;
+    ответ и источники загружаются только на странице записи.
+    """
+    history_qs = QueryHistory.objects.filter(user=request.user).only(
+        *HISTORY_LIST_FIELDS
+    )
+    try:
+        before = _parse_cursor(request.GET.get("before"))
+        after = _parse_cursor(request.GET.get("after"))
+    except ValueError:
+        return redirect("history_list")
 
-    return render(request, "history/history_list.html", {"page_obj": page_obj})
+    if after is not None:
+        created_at, pk = after
+        rows = list(
+            history_qs.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            ).order_by("created_at", "id")[: HISTORY_PAGE_SIZE + 1]
+        )
+        has_newer = len(rows) > HISTORY_PAGE_SIZE
+        items = rows[:HISTORY_PAGE_SIZE][::-1]
+        has_older = True
+    else:
+        if before is not None:
+            created_at, pk = before
+            history_qs = history_qs.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
+        rows = list(history_qs.order_by("-created_at", "-id")[: HISTORY_PAGE_SIZE + 1])
+        has_older = len(rows) > HISTORY_PAGE_SIZE
+        items = rows[:HISTORY_PAGE_SIZE]
+        has_newer = before is not None
+
+    context = {
+        "items": items,
+        "newer_cursor": _item_cursor(items[0]) if items and has_newer else None,
+        "older_cursor": _item_cursor(items[-1]) if items and has_older else None,
+        "is_first_page": not has_newer,
+    }
+    return render(request, "history/history_list.html", context)
 
 
 @login_required
@@ -6,11 +6,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 
 import pytest
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from src.api.main import app
 from src.db.models import Base
-from src.db.session import get_db
+from src.db.session import get_async_db, get_db
 
 # --- Настройка тестовой базы данных SQLite file-based ---
 
@@ -20,6 +21,12 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный доступ к той же базе для эндпоинтов, работающих через AsyncSession
+async_engine = create_async_engine("sqlite+aiosqlite:///./test_rag.db")
+TestingAsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 
 @pytest.fixture(scope="function")
 def test_db():
@@ -38,7 +45,7 @@ def test_db():
 @pytest.fixture(scope="function")
 def override_get_db(test_db):
     """
-    Автоматически подменяет зависимость get_db на тестовую сессию.
+    Автоматически подменяет зависимости get_db и get_async_db на тестовые сессии.
     """
 
     def _override_get_db():
@@ -47,6 +54,45 @@ def override_get_db(test_db):
         finally:
             test_db.close()
 
+    async def _override_get_async_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
+
     app.dependency_overrides[get_db] = _override_get_db
+    app.dependency_overrides[get_async_db] = _override_get_async_db
     yield
     app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_async_db, None)
+
+
+@pytest.fixture(scope="session")
+def tiny_cross_encoder(tmp_path_factory):
+    """
+    Крошечный BERT-кросс-энкодер (512 позиций) в локальном каталоге:
+    тесты реранкера и экспорта ONNX работают без скачивания моделей.
+    """
+    from transformers import (
+        BertConfig,
+        BertForSequenceClassification,
+        BertTokenizerFast,
+    )
+
+    directory = tmp_path_factory.mktemp("tiny-cross-encoder")
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += [f"w{i}" for i in range(50)]
+    (directory / "vocab.txt").write_text("\n".join(vocab), encoding="utf-8")
+    tokenizer = BertTokenizerFast(
+        vocab_file=str(directory / "vocab.txt"), model_max_length=512
+    )
+    tokenizer.save_pretrained(directory)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=512,
+        num_labels=1,
+    )
+    BertForSequenceClassification(config).save_pretrained(directory)
+    return directory
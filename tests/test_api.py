@@ -1,3 +1,6 @@
+import datetime
+import json
+
 import pytest
 import pytest_asyncio
 from httpx import ASGITransport, AsyncClient
@@ -5,9 +8,11 @@ from unittest.mock import AsyncMock, MagicMock
 
 # Важно: импортируем `app` и зависимости до того, как моки их заменят
 from src.api.dependencies import get_rag_engine
+from src.api.embedding_batcher import EmbeddingBatcher, get_embedding_batcher
 from src.api.main import app
 from src.api.rag import RAGEngine
 from src.api.services.history_service import QueryHistoryService
+from src.db.models import QueryHistory
 
 # --- Моки для ML моделей и зависимостей ---
 
@@ -51,10 +56,19 @@ def mock_rag_engine():
     return engine
 
 
+@pytest.fixture(scope="module")
+def mock_embedding_batcher():
+    """Мок батчера эмбеддингов, чтобы не загружать модель."""
+    batcher = MagicMock(spec=EmbeddingBatcher)
+    batcher.embed = AsyncMock(return_value=[0.1] * 768)
+    return batcher
+
+
 @pytest_asyncio.fixture(scope="function", autouse=True)
-def override_dependencies(mock_rag_engine):
-    """Переопределяем зависимость get_rag_engine для всех тестов в этом модуле."""
+def override_dependencies(mock_rag_engine, mock_embedding_batcher):
+    """Переопределяем зависимости RAG-движка и эмбеддингов для всех тестов в этом модуле."""
     app.dependency_overrides[get_rag_engine] = lambda: mock_rag_engine
+    app.dependency_overrides[get_embedding_batcher] = lambda: mock_embedding_batcher
     yield
     app.dependency_overrides = {}
 
@@ -152,3 +166,214 @@ async def test_rag_engine_called_with_params(mock_rag_engine, mocker):
     assert call_kwargs.get("top_k_final") == 7
     # Проверяем, что domain_filter не передается в query, так как его там нет
     assert "domain_filter" not in call_kwargs
+    # Фильтр по домену передается как domain (поиск и область семантического кэша)
+    assert call_kwargs.get("domain") == "docs.python.org"
+
+
+@pytest.mark.asyncio
+async def test_query_stream_endpoint(mock_rag_engine, mocker):
+    """
+    Проверяет порядок SSE-событий /api/v1/query/stream и сохранение истории.
+    """
+    source = {
+        "source_id": 1,
+        "chunk_id": 101,
+        "document_id": 1,
+        "title": "Тестовый документ",
+        "text": "Полный текст чанка",
+        "excerpt": "Полный текст...",
+        "rerank_score": 0.92,
+        "cited": True,
+    }
+
+    async def mock_query_stream(*args, **kwargs):
+        yield {"event": "sources", "data": [source]}
+        yield {"event": "token", "data": "Ответ "}
+        yield {"event": "token", "data": "[SOURCE 1]"}
+        yield {
+            "event": "summary",
+            "data": {
+                "response_md": "Ответ [SOURCE 1]",
+                "confidence_score": 0.9,
+                "sources": [source],
+                "timings_ms": {
+                    "embed": 1,
+                    "retrieve": 2,
+                    "rerank": 3,
+                    "llm": 4,
+                    "first_token": 1,
+                    "total": 10,
+                },
+            },
+        }
+
+    mock_rag_engine.query_stream = mock_query_stream
+    save_mock = mocker.patch.object(QueryHistoryService, "save", return_value=555)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.post(
+            "/api/v1/query/stream", json={"query": "тестовый запрос"}
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = [
+        (block.split("\n")[0][len("event: ") :], json.loads(block.split("\n")[1][6:]))
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert [name for name, _ in events] == ["sources", "token", "token", "summary"]
+    assert events[0][1][0]["title"] == "Тестовый документ"
+    assert "text" not in events[0][1][0]
+    assert events[1][1] == {"text": "Ответ "}
+
+    summary = events[-1][1]
+    assert summary["query_id"] == 555
+    assert summary["sources"][0]["chunk_id"] == 101
+    assert summary["timings_ms"]["first_token"] == 1
+    save_mock.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_history_keyset_pagination(test_db, override_get_db):
+    """Курсор ведет по страницам без пропусков; список не содержит ответов."""
+    base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    for i in range(5):
+        test_db.add(
+            QueryHistory(
+                id=i + 1,
+                user_id=7,
+                query_text=f"question {i}",
+                query_embedding=[0.0] * 768,
+                response_md=f"answer {i}",
+                sources_json=[{"chunk_id": i}],
+                llm_provider="mock",
+                llm_model="mock-model",
+                confidence_score=0.5,
+                # Две записи с одинаковым временем: порядок определяет id
+                created_at=base + datetime.timedelta(minutes=min(i, 3)),
+            )
+        )
+    test_db.commit()
+
+    seen = []
+    cursor = None
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        while True:
+            params = {"user_id": 7, "limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            page = (await client.get("/api/v1/history", params=params)).json()
+            assert page["total"] is None
+            assert all("response_md" not in item for item in page["items"])
+            seen.extend(item["id"] for item in page["items"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        assert seen == [5, 4, 3, 2, 1]
+
+        detail = await client.get("/api/v1/history/3", params={"user_id": 7})
+        assert detail.json()["sources"] == [{"chunk_id": 2}]
+        assert (await client.get("/api/v1/history/3", params={"user_id": 8})).status_code == 404
+
+        counted = await client.get(
+            "/api/v1/history", params={"user_id": 7, "include_total": "true"}
+        )
+        assert counted.json()["total"] == 5
+        bad = await client.get("/api/v1/history", params={"user_id": 7, "cursor": "xyz"})
+        assert bad.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_query_batch_endpoint_streams_ndjson(mocker, mock_rag_engine, mock_embedding_batcher):
+    """Пачка: один вызов эмбеддинга, строки NDJSON в порядке готовности с index."""
+    mock_embedding_batcher.embed_many = AsyncMock(return_value=[[0.1] * 768, [0.2] * 768])
+    result = await mock_rag_engine.query()
+
+    async def mock_query_batch(db, queries, embeddings, embed_time_ms, user_id, priority):
+        assert [q["query_text"] for q in queries] == ["первый вопрос", "второй вопрос"]
+        assert priority == "low"
+        yield 1, result
+        yield 0, RuntimeError("boom")
+
+    mock_rag_engine.query_batch = mock_query_batch
+    mocker.patch("src.api.routes.AsyncSessionLocal", MagicMock(return_value=AsyncMock()))
+    mocker.patch.object(QueryHistoryService, "save", return_value=42)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.post(
+            "/api/v1/query/batch",
+            json={"queries": [{"query": "первый вопрос"}, {"query": "второй вопрос"}]},
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0]["index"] == 1
+    assert lines[0]["query_id"] == 42
+    assert lines[1] == {
+        "index": 0,
+        "error": {
+            "detail": "An internal error occurred while processing the request.",
+            "status_code": 500,
+        },
+    }
+    mock_embedding_batcher.embed_many.assert_awaited_once_with(
+        ["первый вопрос", "второй вопрос"]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("override_get_db")
+async def test_metrics_endpoint_exposes_stage_latency(mocker):
+    """После /query в /metrics есть гистограммы этапов и исход ответа."""
+    mocker.patch.object(QueryHistoryService, "save", return_value=999)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        await client.post("/api/v1/query", json={"query": "тестовый запрос"})
+        response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    body = response.text
+    assert 'rag_stage_latency_seconds_count{endpoint="query",stage="llm"}' in body
+    assert 'rag_responses_total{endpoint="query",outcome="answer"}' in body
+    assert "rag_db_pool_checked_out" in body
+
+
+@pytest.mark.asyncio
+async def test_query_batch_reports_errors_when_retrieval_fails(
+    mocker, mock_rag_engine, mock_embedding_batcher
+):
+    """Сбой общего поиска: строка с ошибкой на каждый запрос, транзакция откатывается."""
+    mock_embedding_batcher.embed_many = AsyncMock(return_value=[[0.1] * 768] * 3)
+    engine = RAGEngine(MagicMock(), MagicMock(), MagicMock(), MagicMock())
+    mock_rag_engine.query_batch = engine.query_batch
+    mocker.patch(
+        "src.api.rag.vector_search_batch",
+        AsyncMock(side_effect=RuntimeError("connection lost")),
+    )
+    session = MagicMock(return_value=AsyncMock())
+    mocker.patch("src.api.routes.AsyncSessionLocal", session)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.post(
+            "/api/v1/query/batch",
+            json={"queries": [{"query": f"вопрос {i}"} for i in range(3)]},
+        )
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    assert all(line["error"]["status_code"] == 500 for line in lines)
+    session.return_value.__aenter__.return_value.rollback.assert_awaited_once()
@@ -0,0 +1,43 @@
+from src.api.context_packer import SOURCE_OVERHEAD_TOKENS, pack_context
+
+
+def _chunk(chunk_id, tokens):
+    return {"chunk_id": chunk_id, "text": "word " * tokens, "token_count": tokens}
+
+
+def test_chunks_within_budget_are_kept_in_order():
+    chunks = [_chunk(1, 100), _chunk(2, 100)]
+
+    packed = pack_context(chunks, token_budget=1000, min_truncated_tokens=50)
+
+    assert [c["chunk_id"] for c in packed] == [1, 2]
+    assert not any(c.get("truncated") for c in packed)
+
+
+def test_last_chunk_is_truncated_to_fill_budget():
+    chunks = [_chunk(1, 300), _chunk(2, 400), _chunk(3, 100)]
+    budget = 300 + 200 + 2 * SOURCE_OVERHEAD_TOKENS
+
+    packed = pack_context(chunks, token_budget=budget, min_truncated_tokens=50)
+
+    assert [c["chunk_id"] for c in packed] == [1, 2]
+    assert packed[1]["truncated"] is True
+    assert packed[1]["token_count"] == 200
+    assert len(packed[1]["text"]) < len(chunks[1]["text"]) * 0.6
+    # Исходный чанк не изменяется
+    assert "truncated" not in chunks[1]
+
+
+def test_small_remainder_is_not_filled():
+    chunks = [_chunk(1, 300), _chunk(2, 400)]
+    budget = 300 + 20 + 2 * SOURCE_OVERHEAD_TOKENS
+
+    packed = pack_context(chunks, token_budget=budget, min_truncated_tokens=50)
+
+    assert [c["chunk_id"] for c in packed] == [1]
+
+
+def test_zero_budget_disables_packing():
+    chunks = [_chunk(1, 5000)]
+
+    assert pack_context(chunks, token_budget=0) == chunks
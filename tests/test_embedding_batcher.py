@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from src.api.embedding_batcher import EmbeddingBatcher
+
+
+class FakeEmbeddingModel:
+    """Фейковая модель: эмбеддинг — длина текста, все вызовы записываются."""
+
+    def __init__(self, fail: bool = False):
+        self.calls = []
+        self.fail = fail
+
+    def get_embeddings(self, texts):
+        self.calls.append(list(texts))
+        if self.fail:
+            raise RuntimeError("encode failed")
+        return [[float(len(t))] for t in texts]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_batch():
+    model = FakeEmbeddingModel()
+    batcher = EmbeddingBatcher(model, max_batch_size=32, max_wait_ms=50)
+
+    texts = ["a" * i for i in range(1, 11)]
+    results = await asyncio.gather(*(batcher.embed(t) for t in texts))
+
+    # Каждый вызывающий получает свой эмбеддинг
+    assert results == [[float(len(t))] for t in texts]
+    assert len(model.calls) == 1
+    assert sorted(model.calls[0]) == sorted(texts)
+
+    stats = batcher.stats()
+    assert stats["batches"] == 1
+    assert stats["items"] == 10
+    assert stats["max_batch_size"] == 10
+    assert stats["queue_depth"] == 0
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_size_limit_is_respected():
+    model = FakeEmbeddingModel()
+    batcher = EmbeddingBatcher(model, max_batch_size=4, max_wait_ms=50)
+
+    await asyncio.gather(*(batcher.embed(f"text {i}") for i in range(10)))
+
+    assert all(len(call) <= 4 for call in model.calls)
+    assert sum(len(call) for call in model.calls) == 10
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_encode_error_is_propagated_to_callers():
+    batcher = EmbeddingBatcher(FakeEmbeddingModel(fail=True), max_wait_ms=1)
+
+    with pytest.raises(RuntimeError, match="encode failed"):
+        await batcher.embed("query")
+    await batcher.close()
@@ -0,0 +1,61 @@
+import pytest
+
+from src.ingestion.embedding_cache import EmbeddingCache, EmbeddingCacheBusyError
+
+
+def _cache(tmp_path, max_entries=3):
+    return EmbeddingCache(tmp_path, "org/model", dim=2, max_entries=max_entries)
+
+
+def test_cache_persists_vectors_across_reopen(tmp_path):
+    cache = _cache(tmp_path)
+    assert cache.get(["alpha", "beta"]) == [None, None]
+    cache.put(["alpha", "beta"], [[1.0, 0.0], [0.0, 1.0]])
+    cache.close()
+
+    cache = _cache(tmp_path)
+    # Ключ не зависит от пробелов по краям, но зависит от регистра
+    assert cache.get([" alpha\n", "beta", "Alpha"]) == [[1.0, 0.0], [0.0, 1.0], None]
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put(["a", "b", "c"], [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0]])
+    # "a" использован позже остальных и переживает вытеснение
+    cache.get(["a"])
+    cache.put(["d", "e"], [[4.0, 4.0], [5.0, 5.0]])
+
+    assert cache.get(["a", "b", "c", "d", "e"]) == [
+        [1.0, 1.0],
+        None,
+        None,
+        [4.0, 4.0],
+        [5.0, 5.0],
+    ]
+    assert cache.stats()["evictions"] == 2
+    assert cache.stats()["entries"] == 3
+
+
+def test_cache_keys_include_model_and_variant(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put(["text"], [[1.0, 2.0]])
+    other = EmbeddingCache(tmp_path, "org/other", dim=2, max_entries=3)
+    assert other.get(["text"]) == [None]
+    # Векторы квантованной ONNX-модели не подменяют векторы PyTorch
+    cache.close()
+    quantized = EmbeddingCache(
+        tmp_path, "org/model", dim=2, max_entries=3, variant="onnx-int8"
+    )
+    assert quantized.get(["text"]) == [None]
+
+
+def test_cache_allows_a_single_writer(tmp_path):
+    cache = _cache(tmp_path)
+    with pytest.raises(EmbeddingCacheBusyError):
+        _cache(tmp_path)
+    cache.close()
+    _cache(tmp_path).close()
@@ -0,0 +1,99 @@
+import asyncio
+import itertools
+
+import pytest
+from sqlalchemy import func, select
+
+from src.api.services.history_writer import HistoryWriter
+from src.config import settings
+from src.db.models import QueryHistory
+from tests.conftest import TestingAsyncSessionLocal
+
+
+class FakeSequenceWriter(HistoryWriter):
+    """Вместо последовательности Postgres (в SQLite ее нет) — счетчик в памяти."""
+
+    def __init__(self, **kwargs):
+        super().__init__(session_factory=TestingAsyncSessionLocal, **kwargs)
+        self._sequence = itertools.count(1)
+        self.allocations = 0
+
+    async def _allocate_ids(self, count):
+        self.allocations += 1
+        return [next(self._sequence) for _ in range(count)]
+
+
+def _row(i: int):
+    return {
+        "user_id": 1,
+        "query_text": f"question {i}",
+        "query_embedding": [0.0] * settings.EMBEDDING_DIM,
+        "response_md": f"answer {i}",
+        "sources_json": [{"chunk_id": i, "similarity": 0.9}],
+        "llm_provider": "test",
+        "llm_model": "test-model",
+        "confidence_score": 0.5,
+    }
+
+
+async def _count_rows() -> int:
+    async with TestingAsyncSessionLocal() as db:
+        return await db.scalar(select(func.count()).select_from(QueryHistory))
+
+
+@pytest.mark.asyncio
+async def test_ids_are_returned_before_rows_are_written(test_db):
+    writer = FakeSequenceWriter(max_batch=100, flush_interval_ms=10_000, id_block_size=4)
+
+    ids = [await writer.submit(_row(i)) for i in range(6)]
+
+    assert ids == [1, 2, 3, 4, 5, 6]
+    assert writer.allocations == 2  # блоки по 4 ID
+    assert await _count_rows() == 0
+    assert writer.stats()["buffered"] == 6
+
+    # При закрытии буфер дописывается
+    await writer.close()
+    assert await _count_rows() == 6
+    assert writer.stats()["flushes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_flush_by_size_and_interval(test_db):
+    writer = FakeSequenceWriter(max_batch=3, flush_interval_ms=50)
+
+    for i in range(3):
+        await writer.submit(_row(i))
+    # Полный батч сбрасывается, не дожидаясь интервала
+    await asyncio.sleep(0.01)
+    assert await _count_rows() == 3
+
+    await writer.submit(_row(3))
+    await asyncio.sleep(0.01)
+    assert await _count_rows() == 3
+    await asyncio.sleep(0.1)
+    assert await _count_rows() == 4
+
+    async with TestingAsyncSessionLocal() as db:
+        entry = await db.get(QueryHistory, 4)
+        assert entry.sources_json == [{"chunk_id": 3, "similarity": 0.9}]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_rejected_rows_are_dropped_without_blocking_the_batch(test_db):
+    # Запись с ID 2 уже есть: INSERT батча нарушает первичный ключ
+    test_db.add(QueryHistory(id=2, **_row(0)))
+    test_db.commit()
+    writer = FakeSequenceWriter(max_batch=4, flush_interval_ms=10_000)
+
+    for i in range(4):
+        await writer.submit(_row(i))
+    await asyncio.sleep(0.05)
+
+    # Батч делится до отдельных записей, остальные записи сохраняются
+    assert await _count_rows() == 4
+    assert writer.stats()["buffered"] == 0
+    assert writer.stats()["written"] == 3
+    assert writer.stats()["dropped"] == 1
+    await writer.close()
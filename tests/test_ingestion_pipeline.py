@@ -0,0 +1,231 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.ingestion import pipeline as pipeline_module
+from src.ingestion.dedup import compute_content_hash
+from src.ingestion.pipeline import IngestionPipeline, iter_markdown_files
+from src.ingestion.sync import IndexedChunk, compute_chunk_hash, plan_chunk_reuse
+
+
+class FakeChunker:
+    def __init__(self, chunk_size, chunk_overlap):
+        pass
+
+    def chunk(self, text, doc_metadata):
+        if "broken" in text:
+            raise ValueError("cannot chunk")
+        return [
+            {
+                "text": part,
+                "token_count": len(part),
+                "metadata": {**doc_metadata, "chunk_index": i},
+            }
+            for i, part in enumerate(text.split())
+        ]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    (tmp_path / "a.md").write_text("alpha beta", encoding="utf-8")
+    (tmp_path / "notes.txt").write_text("ignored", encoding="utf-8")
+    nested = tmp_path / "nested"
+    nested.mkdir()
+    (nested / "b.md").write_text("gamma", encoding="utf-8")
+    (nested / "copy.md").write_text("Alpha  beta", encoding="utf-8")
+    (nested / "c.md").write_text("broken", encoding="utf-8")
+    return tmp_path
+
+
+def test_iter_markdown_files(corpus):
+    assert {p.name for p in iter_markdown_files(corpus)} == {"a.md"}
+    assert {p.name for p in iter_markdown_files(corpus, recursive=True)} == {
+        "a.md",
+        "b.md",
+        "copy.md",
+        "c.md",
+    }
+
+
+def test_pipeline_runs_stages_in_process(corpus, mocker):
+    model = MagicMock()
+    model.get_embeddings.side_effect = lambda texts, cache: [
+        [float(len(t))] for t in texts
+    ]
+    model.cache_stats.return_value = None
+    mocker.patch.object(pipeline_module, "get_embedding_model", return_value=model)
+    mocker.patch.object(pipeline_module, "SessionLocal", MagicMock)
+    mocker.patch.object(pipeline_module, "MarkdownChunker", FakeChunker)
+    mocker.patch.object(pipeline_module, "flush_completion_cache_table")
+    deduplicator = mocker.patch.object(pipeline_module, "Deduplicator").return_value
+    seen = set()
+    deduplicator.is_duplicate.side_effect = lambda h: h in seen
+    deduplicator.add_hash.side_effect = seen.add
+    written = {}
+
+    def load(documents):
+        # b.md уже загружен под тем же путем: merge пропускает его
+        ids = []
+        for document, chunks in documents:
+            name = document["file_path"].rsplit("/", 1)[-1]
+            if name == "b.md":
+                ids.append(None)
+                continue
+            written[name] = [c["embedding"] for c in chunks]
+            ids.append(len(written))
+        return ids
+
+    loader = mocker.patch.object(pipeline_module, "CopyBulkLoader").return_value
+    loader.load.side_effect = load
+    loader.rows = 3
+    loader.rows_per_second.return_value = 100.0
+
+    pipeline = IngestionPipeline(workers=0, queue_size=1)
+    pipeline.run(iter_markdown_files(corpus, recursive=True), "docs")
+
+    # copy.md совпадает с a.md после нормализации, c.md не режется на чанки
+    assert pipeline.new_docs_count == 1
+    assert pipeline.skipped_docs_count == 2
+    assert pipeline.failed_docs_count == 1
+    assert pipeline.total_chunks_count == 2
+    assert written == {"a.md": [[5.0], [4.0]]}
+    # Чанки обоих документов посчитаны одним вызовом, от коротких к длинным
+    model.get_embeddings.assert_called_once_with(["beta", "alpha", "gamma"], cache=True)
+    pipeline_module.flush_completion_cache_table.assert_called_once()
+
+
+def test_plan_chunk_reuse_matches_chunks_by_text():
+    previous = [
+        IndexedChunk(1, 0, compute_chunk_hash("intro"), {}),
+        IndexedChunk(2, 1, compute_chunk_hash("body"), {}),
+        IndexedChunk(3, 2, compute_chunk_hash("body"), {}),
+    ]
+    chunks = [{"text": t} for t in ("new", "intro", "body", "body", "body")]
+
+    plan = plan_chunk_reuse(previous, chunks)
+
+    assert [p.id if p else None for p in plan] == [None, 1, 2, 3, None]
+
+
+def test_pipeline_sync_reembeds_only_changed_chunks(tmp_path, mocker):
+    (tmp_path / "same.md").write_text("alpha", encoding="utf-8")
+    (tmp_path / "edited.md").write_text("gamma delta", encoding="utf-8")
+    model = MagicMock()
+    model.get_embeddings.side_effect = lambda texts, cache: [[1.0] for _ in texts]
+    model.cache_stats.return_value = None
+    mocker.patch.object(pipeline_module, "get_embedding_model", return_value=model)
+    mocker.patch.object(pipeline_module, "SessionLocal", MagicMock)
+    mocker.patch.object(pipeline_module, "MarkdownChunker", FakeChunker)
+    mocker.patch.object(pipeline_module, "flush_completion_cache_table")
+    mocker.patch.object(pipeline_module, "Deduplicator")
+    root = str(tmp_path.resolve())
+    mocker.patch.object(
+        pipeline_module,
+        "load_indexed_documents",
+        return_value={
+            f"{root}/same.md": (1, compute_content_hash("alpha")),
+            f"{root}/edited.md": (2, compute_content_hash("gamma")),
+            f"{root}/gone.md": (3, compute_content_hash("removed")),
+        },
+    )
+    mocker.patch.object(
+        pipeline_module,
+        "load_indexed_chunks",
+        return_value=[IndexedChunk(7, 0, compute_chunk_hash("gamma"), {})],
+    )
+    update = mocker.patch.object(pipeline_module, "apply_document_update")
+    delete = mocker.patch.object(pipeline_module, "delete_documents", return_value=1)
+
+    pipeline = IngestionPipeline(workers=0)
+    pipeline.sync(tmp_path, "docs")
+
+    model.get_embeddings.assert_called_once_with(["delta"], cache=True)
+    document_id, _, chunk_rows, plan = update.call_args.args[1:]
+    assert document_id == 2
+    assert [r["chunk_text"] for r in chunk_rows] == ["gamma", "delta"]
+    assert [p.id if p else None for p in plan] == [7, None]
+    assert delete.call_args.args[1] == [3]
+    assert pipeline.unchanged_docs_count == 1
+    assert pipeline.updated_docs_count == 1
+    assert pipeline.deleted_docs_count == 1
+    assert pipeline.reused_chunks_count == 1
+
+
+def test_sync_keeps_documents_it_could_not_read(tmp_path, mocker):
+    (tmp_path / "binary.md").write_bytes(b"\xff\xfe")
+    locked = tmp_path / "locked"
+    locked.mkdir()
+    (locked / "hidden.md").write_text("alpha", encoding="utf-8")
+    scandir = pipeline_module.os.scandir
+
+    def fake_scandir(path):
+        if path == locked:
+            raise PermissionError("denied")
+        return scandir(path)
+
+    mocker.patch.object(pipeline_module.os, "scandir", side_effect=fake_scandir)
+    mocker.patch.object(pipeline_module, "get_embedding_model")
+    mocker.patch.object(pipeline_module, "SessionLocal", MagicMock)
+    mocker.patch.object(pipeline_module, "MarkdownChunker", FakeChunker)
+    mocker.patch.object(pipeline_module, "flush_completion_cache_table")
+    mocker.patch.object(pipeline_module, "Deduplicator")
+    root = str(tmp_path.resolve())
+    mocker.patch.object(
+        pipeline_module,
+        "load_indexed_documents",
+        return_value={
+            f"{root}/binary.md": (1, compute_content_hash("old")),
+            f"{root}/locked/hidden.md": (2, compute_content_hash("alpha")),
+            f"{root}/gone.md": (3, compute_content_hash("removed")),
+        },
+    )
+    delete = mocker.patch.object(pipeline_module, "delete_documents", return_value=1)
+
+    pipeline = IngestionPipeline(workers=0)
+    pipeline.sync(tmp_path, "docs", recursive=True)
+
+    # Нечитаемый файл и файлы нечитаемого каталога не считаются удаленными
+    assert delete.call_args.args[1] == [3]
+    assert pipeline.failed_docs_count == 1
+
+
+def test_sync_without_changes_keeps_completion_cache(tmp_path, mocker):
+    (tmp_path / "same.md").write_text("alpha", encoding="utf-8")
+    mocker.patch.object(pipeline_module, "get_embedding_model")
+    mocker.patch.object(pipeline_module, "SessionLocal", MagicMock)
+    mocker.patch.object(pipeline_module, "MarkdownChunker", FakeChunker)
+    flush = mocker.patch.object(pipeline_module, "flush_completion_cache_table")
+    mocker.patch.object(pipeline_module, "Deduplicator")
+    mocker.patch.object(
+        pipeline_module,
+        "load_indexed_documents",
+        return_value={
+            f"{tmp_path.resolve()}/same.md": (1, compute_content_hash("alpha"))
+        },
+    )
+
+    pipeline = IngestionPipeline(workers=0)
+    pipeline.sync(tmp_path, "docs")
+
+    assert pipeline.unchanged_docs_count == 1
+    flush.assert_not_called()
+
+
+def test_failed_run_releases_embedding_cache(corpus, mocker):
+    model = MagicMock()
+    # Модель вернула не столько векторов, сколько чанков: стадия падает
+    model.get_embeddings.return_value = [[0.0]]
+    mocker.patch.object(pipeline_module, "get_embedding_model", return_value=model)
+    session = mocker.patch.object(pipeline_module, "SessionLocal")
+    mocker.patch.object(pipeline_module, "MarkdownChunker", FakeChunker)
+    deduplicator = mocker.patch.object(pipeline_module, "Deduplicator").return_value
+    deduplicator.is_duplicate.return_value = False
+    close_cache = mocker.patch.object(pipeline_module, "close_embedding_cache")
+
+    pipeline = IngestionPipeline(workers=0)
+    with pytest.raises(RuntimeError, match="Ingestion aborted"):
+        pipeline.run(iter_markdown_files(corpus), "docs")
+
+    # Файл кэша сброшен и блокировка снята, сессия закрыта
+    close_cache.assert_called_once()
+    session.return_value.close.assert_called()
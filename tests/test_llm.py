@@ -0,0 +1,137 @@
+import httpx
+import pytest
+
+from src.api.llm import LLMClient, LLMUnavailableError
+from src.config import settings
+
+
+def _completion(text):
+    return httpx.Response(200, json={"choices": [{"message": {"content": text}}]})
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_RETRY_BACKOFF_MS", 1.0)
+    monkeypatch.setattr(settings, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(settings, "LLM_CIRCUIT_FAILURE_THRESHOLD", 2)
+
+
+@pytest.mark.asyncio
+async def test_failed_backend_is_retried_on_another():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        if request.url.host == "bad":
+            return httpx.Response(503, text="overloaded")
+        return _completion("ok")
+
+    client = LLMClient(
+        base_urls=["http://bad/v1", "http://good/v1"],
+        transport=httpx.MockTransport(handler),
+    )
+    # Первым выбираем сбойный сервер
+    client.backends[1].in_flight = 1
+    try:
+        assert await client.generate("prompt", 0.1) == "ok"
+        assert calls == ["bad", "good"]
+        assert client.stats()["retries"] == 1
+    finally:
+        client.backends[1].in_flight = 0
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_after_consecutive_failures():
+    def handler(request):
+        return httpx.Response(502, text="bad gateway")
+
+    client = LLMClient(
+        base_urls=["http://only/v1"], transport=httpx.MockTransport(handler)
+    )
+    try:
+        with pytest.raises(httpx.HTTPStatusError):
+            await client.generate("prompt", 0.1)
+        assert client.backends[0].state == "open"
+        # Пока цепь разомкнута, запросы не уходят на сервер
+        with pytest.raises(LLMUnavailableError):
+            await client.generate("prompt", 0.1)
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return httpx.Response(400, text="bad request")
+
+    client = LLMClient(
+        base_urls=["http://a/v1", "http://b/v1"], transport=httpx.MockTransport(handler)
+    )
+    try:
+        with pytest.raises(httpx.HTTPStatusError):
+            await client.generate("prompt", 0.1)
+        assert len(calls) == 1
+        assert all(b.state == "closed" for b in client.backends)
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_only_deterministic_completions_are_cached():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return _completion(f"answer {len(calls)}")
+
+    client = LLMClient(base_urls=["http://a/v1"], transport=httpx.MockTransport(handler))
+    try:
+        assert await client.generate("prompt", 0.0) == "answer 1"
+        assert await client.generate("prompt", 0.0) == "answer 1"
+        assert await client.cached_completion("prompt", 0.0) == "answer 1"
+        assert await client.generate("prompt", 0.7) == "answer 2"
+        assert await client.generate("prompt", 0.7) == "answer 3"
+
+        assert len(calls) == 3
+        stats = client.stats()["completion_cache"]
+        assert stats["memory_hits"] == 2
+        assert stats["misses"] == 1
+    finally:
+        await client.close()
+
+
+def _sse(*deltas):
+    lines = [
+        f'data: {{"choices": [{{"delta": {{"content": "{d}"}}}}]}}' for d in deltas
+    ]
+    return httpx.Response(200, text="\n\n".join([*lines, "data: [DONE]"]) + "\n\n")
+
+
+@pytest.mark.asyncio
+async def test_stream_is_retried_only_before_first_delta():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        if request.url.host == "bad":
+            return httpx.Response(503, text="overloaded")
+        return _sse("Hel", "lo")
+
+    client = LLMClient(
+        base_urls=["http://bad/v1", "http://good/v1"],
+        transport=httpx.MockTransport(handler),
+    )
+    client.backends[1].in_flight = 1
+    try:
+        deltas = [d async for d in client.generate_stream("prompt", 0.1)]
+        assert deltas == ["Hel", "lo"]
+        assert calls == ["bad", "good"]
+        assert client.backends[1].in_flight == 1
+        assert client.backends[0].in_flight == 0
+    finally:
+        client.backends[1].in_flight = 0
+        await client.close()
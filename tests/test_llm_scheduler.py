@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from src.api.llm_scheduler import LLMAdmissionScheduler, LLMOverloadedError
+
+
+async def _hold(scheduler, user_id, priority, order, release):
+    async with scheduler.admit(user_id, priority):
+        order.append(user_id)
+        await release.wait()
+
+
+@pytest.mark.asyncio
+async def test_users_are_served_round_robin_and_by_priority():
+    scheduler = LLMAdmissionScheduler(capacity=1, max_queue=10, max_per_user=10, timeout=5)
+    order = []
+    release = asyncio.Event()
+
+    blocker = asyncio.create_task(_hold(scheduler, "blocker", "normal", order, release))
+    await asyncio.sleep(0)
+    waiters = [
+        asyncio.create_task(_hold(scheduler, user, priority, order, release))
+        for user, priority in [
+            ("heavy", "normal"),
+            ("heavy", "normal"),
+            ("heavy", "normal"),
+            ("light", "normal"),
+            ("batch", "low"),
+            ("vip", "high"),
+        ]
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(blocker, *waiters)
+
+    assert order == ["blocker", "vip", "heavy", "light", "heavy", "heavy", "batch"]
+    assert scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_overload_is_rejected_with_retry_after():
+    scheduler = LLMAdmissionScheduler(capacity=1, max_queue=2, max_per_user=1, timeout=0.05)
+    release = asyncio.Event()
+    blocker = asyncio.create_task(_hold(scheduler, "a", "normal", [], release))
+    await asyncio.sleep(0)
+
+    queued = asyncio.create_task(scheduler.acquire("b"))
+    await asyncio.sleep(0)
+
+    # Второй ожидающий запрос того же пользователя — 429
+    with pytest.raises(LLMOverloadedError) as user_limit:
+        await scheduler.acquire("b")
+    assert user_limit.value.status_code == 429
+    assert user_limit.value.retry_after >= 1
+
+    # Слот не освободился за timeout — 503, очередь очищается
+    with pytest.raises(LLMOverloadedError) as deadline:
+        await queued
+    assert deadline.value.status_code == 503
+    assert scheduler.stats()["queued"] == {"high": 0, "normal": 0, "low": 0}
+
+    release.set()
+    await blocker
+    assert scheduler.active == 0
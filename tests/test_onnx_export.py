@@ -0,0 +1,47 @@
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+from src.config import settings
+from src.onnx_backend import EXPORT_META_FILE, onnx_model_dir
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+_spec = importlib.util.spec_from_file_location(
+    "export_onnx", Path(__file__).parent.parent / "scripts" / "export_onnx.py"
+)
+export_onnx = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_onnx)
+
+
+def _export(export, model_name):
+    out_dir = onnx_model_dir(model_name)
+    out_dir.mkdir(parents=True)
+    meta = export(model_name, out_dir)
+    (out_dir / EXPORT_META_FILE).write_text(json.dumps(meta), encoding="utf-8")
+    return meta
+
+
+@pytest.fixture
+def onnx_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "ONNX_MODEL_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "RERANKER_MAX_LENGTH", None)
+    return tmp_path
+
+
+def test_exported_reranker_matches_torch(tiny_cross_encoder, onnx_dir):
+    meta = _export(export_onnx.export_reranker, str(tiny_cross_encoder))
+
+    assert meta["max_length"] == 512
+    # verify сравнивает OnnxCrossEncoder.predict с CrossEncoder на тех же парах
+    assert export_onnx.verify(meta, quantized=False) < 1e-4
+
+
+def test_exported_embedding_matches_torch(tiny_cross_encoder, onnx_dir):
+    meta = _export(export_onnx.export_embedding, str(tiny_cross_encoder))
+
+    assert meta["embedding_dim"] == 16
+    assert export_onnx.verify(meta, quantized=False) < 1e-4
@@ -0,0 +1,91 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.api.llm_scheduler import LLMAdmissionScheduler
+from src.api.rag import RAGEngine
+
+
+def _candidates(query_index: int):
+    return [
+        {
+            "chunk_id": query_index * 10 + j,
+            "document_id": 1,
+            "text": f"chunk {j} for query {query_index}",
+            "token_count": 10,
+            "title": "Doc",
+            "url": None,
+            "domain": None,
+            "similarity": 0.9,
+        }
+        for j in range(2)
+    ]
+
+
+async def _fake_rerank(query, chunks, db=None):
+    assert db is None
+    for chunk in chunks:
+        chunk["rerank_score"] = 0.9
+    return chunks
+
+
+@pytest.mark.asyncio
+async def test_query_batch_shares_retrieval_and_limits_llm_concurrency(mocker):
+    # Запрос 1 не находит ничего, остальные — по два чанка
+    search = mocker.patch(
+        "src.api.rag.vector_search_batch",
+        AsyncMock(return_value=[_candidates(0), [], _candidates(2), _candidates(3)]),
+    )
+    active = 0
+    max_active = 0
+
+    async def generate(prompt, temperature, check_cache=True):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        # Первый запрос отвечается дольше остальных
+        await asyncio.sleep(0.05 if "query 0" in prompt else 0.01)
+        active -= 1
+        return "Ответ [SOURCE 1]."
+
+    llm = MagicMock()
+    llm.cached_completion = AsyncMock(return_value=None)
+    llm.generate = generate
+    rerank_scheduler = MagicMock()
+    rerank_scheduler.rerank = AsyncMock(side_effect=_fake_rerank)
+    engine = RAGEngine(
+        MagicMock(),
+        MagicMock(),
+        llm,
+        rerank_scheduler,
+        llm_scheduler=LLMAdmissionScheduler(capacity=2, max_queue=10, max_per_user=10),
+    )
+
+    queries = [
+        {
+            "query_text": f"question {i}",
+            "top_k_initial": 5,
+            "top_k_final": 2,
+            "min_confidence": 0.0,
+            "temperature": 0.0,
+            "domain": None,
+        }
+        for i in range(4)
+    ]
+    db = AsyncMock()
+    results = [
+        item
+        async for item in engine.query_batch(db, queries, [[0.0]] * 4, embed_time_ms=1.0)
+    ]
+
+    # Один SQL-запрос на всю пачку
+    search.assert_awaited_once()
+    assert search.await_args.args[2] == [5, 5, 5, 5]
+    assert sorted(i for i, _ in results) == [0, 1, 2, 3]
+    # Результаты отдаются по готовности: медленный запрос 0 — последним
+    assert results[-1][0] == 0
+    assert "fallback" in dict(results)[1]["warnings"]
+    assert dict(results)[2]["response_md"] == "Ответ [SOURCE 1]."
+    assert max_active <= 2
+    assert rerank_scheduler.rerank.await_count == 3
@@ -0,0 +1,78 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.api.rag import RAGEngine
+
+
+def _candidates():
+    return [
+        {
+            "chunk_id": i,
+            "document_id": 1,
+            "text": f"chunk {i}",
+            "token_count": 10,
+            "title": "Doc",
+            "url": None,
+            "domain": None,
+            "similarity": 0.9 - i * 0.1,
+        }
+        for i in range(3)
+    ]
+
+
+def _engine(rerank_delay: float = 0.0):
+    async def rerank(query, chunks, db=None):
+        await asyncio.sleep(rerank_delay)
+        for chunk in chunks:
+            # Ре-ранкер переворачивает порядок поиска
+            chunk["rerank_score"] = float(chunk["chunk_id"])
+        return sorted(chunks, key=lambda c: c["rerank_score"], reverse=True)
+
+    llm = MagicMock()
+    rerank_scheduler = MagicMock()
+    rerank_scheduler.rerank = AsyncMock(side_effect=rerank)
+    return RAGEngine(MagicMock(), MagicMock(), llm, rerank_scheduler), llm
+
+
+@pytest.mark.asyncio
+async def test_search_reranks_without_touching_llm(mocker):
+    mocker.patch("src.api.rag.vector_search", AsyncMock(return_value=_candidates()))
+    engine, llm = _engine()
+
+    result = await engine.search(
+        AsyncMock(), "query", [0.0], 1.0, top_k_initial=10, top_k=2,
+        retrieval_mode="vector", rerank=True,
+    )
+
+    assert result["reranked"] is True
+    assert [r["chunk_id"] for r in result["results"]] == [2, 1]
+    assert [r["source_id"] for r in result["results"]] == [1, 2]
+    assert result["warnings"] == []
+    assert not llm.mock_calls
+
+
+@pytest.mark.asyncio
+async def test_search_skips_rerank_outside_latency_budget(mocker):
+    mocker.patch("src.api.rag.vector_search", AsyncMock(return_value=_candidates()))
+    engine, _ = _engine(rerank_delay=0.5)
+
+    result = await engine.search(
+        AsyncMock(), "query", [0.0], 1.0, top_k_initial=10, top_k=3,
+        retrieval_mode="vector", rerank=True, latency_budget_ms=50,
+    )
+
+    # Порядок поиска, без частичных оценок ре-ранкера
+    assert result["reranked"] is False
+    assert [r["chunk_id"] for r in result["results"]] == [0, 1, 2]
+    assert all("rerank_score" not in r for r in result["results"])
+    assert len(result["warnings"]) == 1
+
+    # Бюджет исчерпан еще до ре-ранжирования
+    result = await engine.search(
+        AsyncMock(), "query", [0.0], 100.0, top_k_initial=10, top_k=3,
+        retrieval_mode="vector", rerank=True, latency_budget_ms=50,
+    )
+    assert result["reranked"] is False
+    assert "exhausted" in result["warnings"][0]
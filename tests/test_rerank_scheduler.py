@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from src.api.rerank_cache import RerankScoreCache
+from src.api.rerank_cascade import RerankCascade
+from src.api.rerank_scheduler import RerankScheduler
+
+
+class FakeReranker:
+    """Фейковый ре-ранкер: оценка — длина текста, батчи записываются."""
+
+    batch_size = 8
+
+    def __init__(self):
+        self.batches = []
+
+    def score_pairs(self, pairs):
+        self.batches.append(list(pairs))
+        return [float(len(text)) for _, text in pairs]
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RerankScheduler(FakeReranker(), max_wait_ms=20, bucket_window=1)
+    yield scheduler
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scores_are_split_back_per_request(scheduler):
+    chunks_a = [{"text": "a" * i} for i in range(1, 6)]
+    chunks_b = [{"text": "b" * i} for i in range(10, 13)]
+
+    reranked_a, reranked_b = await asyncio.gather(
+        scheduler.rerank("query a", chunks_a), scheduler.rerank("query b", chunks_b)
+    )
+
+    assert [c["rerank_score"] for c in reranked_a] == [5.0, 4.0, 3.0, 2.0, 1.0]
+    assert [c["rerank_score"] for c in reranked_b] == [12.0, 11.0, 10.0]
+    # Пары обоих запросов объединены в общий батч
+    assert any(
+        {q for q, _ in batch} == {"query a", "query b"}
+        for batch in scheduler.model.batches
+    )
+    assert all(len(batch) <= 8 for batch in scheduler.model.batches)
+
+
+@pytest.mark.asyncio
+async def test_small_request_is_not_starved_by_large_one(scheduler):
+    finished = []
+
+    async def run(name, count):
+        chunks = [{"text": "x" * (i + 1)} for i in range(count)]
+        await scheduler.rerank(name, chunks)
+        finished.append(name)
+
+    await asyncio.gather(run("large", 100), run("small", 10))
+
+    assert finished == ["small", "large"]
+
+
+@pytest.mark.asyncio
+async def test_chunks_without_text_get_zero_score(scheduler):
+    chunks = [{"text": ""}, {"text": "abc"}]
+
+    reranked = await scheduler.rerank("query", chunks)
+
+    assert [c["rerank_score"] for c in reranked] == [3.0, 0.0]
+
+
+@pytest.mark.asyncio
+async def test_cached_scores_skip_the_model():
+    scheduler = RerankScheduler(
+        FakeReranker(), max_wait_ms=20, cache=RerankScoreCache("fake", max_entries=100)
+    )
+    try:
+        first = [{"chunk_id": i, "text": "t" * i} for i in range(1, 4)]
+        await scheduler.rerank("same  query", first)
+        assert len(scheduler.model.batches) == 1
+
+        # Нормализация пробелов дает тот же ключ; новый чанк уходит в модель один
+        second = [{"chunk_id": i, "text": "t" * i} for i in range(1, 5)]
+        reranked = await scheduler.rerank("same query", second)
+
+        assert [c["rerank_score"] for c in reranked] == [4.0, 3.0, 2.0, 1.0]
+        assert scheduler.model.batches[-1] == [("same query", "tttt")]
+        assert scheduler.cache.stats()["memory_hits"] == 3
+    finally:
+        scheduler.close()
+
+
+class ScaledReranker(FakeReranker):
+    """Вторая ступень: оценка в 10 раз больше, чтобы отличать ступени."""
+
+    def score_pairs(self, pairs):
+        self.batches.append(list(pairs))
+        return [float(len(text)) * 10 for _, text in pairs]
+
+
+@pytest.mark.asyncio
+async def test_cascade_rescores_only_survivors():
+    stage1 = RerankScheduler(FakeReranker(), max_wait_ms=1)
+    stage2 = RerankScheduler(ScaledReranker(), max_wait_ms=1)
+    cascade = RerankCascade(stage1, stage2, top_n=3, margin=1.5)
+    try:
+        chunks = [{"text": "x" * i} for i in range(1, 11)]
+        timings = {}
+
+        reranked = await cascade.rerank("query", chunks, timings=timings)
+
+        # Запас 1.5 от лучшей оценки 10.0 оставляет двух выживших из трех
+        second_stage = [text for batch in stage2.model.batches for _, text in batch]
+        assert sorted(map(len, second_stage)) == [9, 10]
+        assert [c["rerank_score"] for c in reranked] == [100.0, 90.0]
+        assert reranked[0]["rerank_stage1_score"] == 10.0
+        assert set(timings) == {"rerank_stage1", "rerank_stage2"}
+    finally:
+        stage1.close()
+        stage2.close()
+
+
+class LogitReranker(FakeReranker):
+    """Вторая ступень в другой шкале: отрицательные логиты."""
+
+    def score_pairs(self, pairs):
+        self.batches.append(list(pairs))
+        return [float(len(text)) - 20 for _, text in pairs]
+
+
+@pytest.mark.asyncio
+async def test_cascade_does_not_mix_stage_scores():
+    stage1 = RerankScheduler(FakeReranker(), max_wait_ms=1)
+    stage2 = RerankScheduler(LogitReranker(), max_wait_ms=1)
+    cascade = RerankCascade(stage1, stage2, top_n=3)
+    try:
+        chunks = [{"text": "x" * i} for i in range(1, 11)]
+
+        reranked = await cascade.rerank("query", chunks)
+
+        # Отсеянные с оценками первой ступени (до 7.0) не обгоняют логиты -10..-12
+        assert [c["rerank_score"] for c in reranked] == [-10.0, -11.0, -12.0]
+        assert [c["rerank_stage1_score"] for c in reranked] == [10.0, 9.0, 8.0]
+    finally:
+        stage1.close()
+        stage2.close()
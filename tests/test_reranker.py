@@ -0,0 +1,47 @@
+import math
+
+from src.api.reranker import (
+    RerankerModel,
+    estimate_pair_tokens,
+    length_buckets,
+    padding_waste,
+)
+from src.config import settings
+
+
+def test_buckets_group_pairs_of_similar_length():
+    lengths = [500, 10, 480, 12, 15, 510]
+
+    buckets = length_buckets(lengths, batch_size=3)
+
+    assert buckets == [[1, 3, 4], [2, 0, 5]]
+    # Каждый индекс попадает ровно в один батч
+    assert sorted(i for b in buckets for i in b) == list(range(len(lengths)))
+
+
+def test_bucketing_reduces_padding_waste():
+    lengths = [500, 10, 480, 12, 15, 510]
+    sequential = [[0, 1, 2], [3, 4, 5]]
+
+    assert padding_waste(lengths, length_buckets(lengths, 3)) < 0.05
+    assert padding_waste(lengths, sequential) > 0.4
+
+
+def test_pair_estimate_is_capped_by_max_length():
+    assert estimate_pair_tokens("query", "x" * 10_000, max_length=512) == 512
+    assert estimate_pair_tokens("q" * 4, "x" * 40, max_length=512) == 14
+
+
+def test_max_length_is_clamped_to_model_positions(tiny_cross_encoder, monkeypatch):
+    monkeypatch.setattr(settings, "INFERENCE_BACKEND", "torch")
+    monkeypatch.setattr(settings, "RERANKER_ONNX", False)
+    monkeypatch.setattr(settings, "RERANKER_MAX_LENGTH", None)
+    monkeypatch.setattr(settings, "RERANKER_DEVICE", "cpu")
+    monkeypatch.setattr(settings, "CHUNK_SIZE", 700)
+
+    model = RerankerModel(model_name=str(tiny_cross_encoder))
+
+    assert model.max_length == 512
+    # Пара длиннее 512 токенов обрезается, а не падает на позиционных эмбеддингах
+    scores = model.score_pairs([("w1 " * 10, "w2 " * 800)])
+    assert len(scores) == 1 and math.isfinite(scores[0])
@@ -0,0 +1,155 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from src.api.retrieval import (
+    _hybrid_statement,
+    hybrid_search,
+    vector_search,
+    vector_search_batch,
+    vector_statement,
+)
+from src.config import settings
+
+
+def _session(rows):
+    result = MagicMock()
+    result.all.return_value = rows
+    db = MagicMock()
+    db.execute = AsyncMock(return_value=result)
+    return db
+
+
+def _row(chunk_id, distance, **extra):
+    return SimpleNamespace(
+        chunk_id=chunk_id,
+        document_id=1,
+        text=f"chunk {chunk_id}",
+        token_count=10,
+        title="Doc",
+        url=None,
+        domain="docs",
+        distance=distance,
+        **extra,
+    )
+
+
+def test_vector_statement_selects_only_pipeline_fields():
+    stmt = vector_statement(False)
+
+    assert list(stmt.selected_columns.keys()) == [
+        "chunk_id",
+        "document_id",
+        "text",
+        "token_count",
+        "title",
+        "url",
+        "domain",
+        "distance",
+    ]
+    # Запрос собирается один раз на вариант
+    assert vector_statement(False) is stmt
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert "documents.domain =" not in sql
+    assert "documents.domain =" in str(
+        vector_statement(True).compile(dialect=postgresql.dialect())
+    )
+
+
+@pytest.mark.asyncio
+async def test_vector_search_binds_domain_only_when_given():
+    db = _session([_row(7, 0.25)])
+
+    found = await vector_search(db, [0.0], top_k=5)
+    await vector_search(db, [0.0], top_k=5, domain="docs")
+
+    assert found[0]["chunk_id"] == 7
+    assert found[0]["similarity"] == 0.75
+    first, second = db.execute.await_args_list
+    assert first.args == (vector_statement(False), {"embedding": [0.0], "top_k": 5})
+    assert second.args[1]["domain"] == "docs"
+
+
+@pytest.mark.asyncio
+async def test_vector_search_batch_groups_rows_by_query():
+    db = _session(
+        [
+            _row(1, 0.1, query_index=0),
+            _row(2, 0.2, query_index=2),
+            _row(3, 0.3, query_index=0),
+        ]
+    )
+
+    candidates = await vector_search_batch(
+        db, [[0.5, 1.0], [0.0, 0.0], [1.0, 0.0]], [2, 2, 1], ["docs", "", None]
+    )
+
+    assert [[c["chunk_id"] for c in found] for found in candidates] == [[1, 3], [], [2]]
+    params = db.execute.await_args.args[1]
+    assert params["embeddings"] == ["[0.5,1.0]", "[0.0,0.0]", "[1.0,0.0]"]
+    assert params["domains"] == ["docs", None, None]
+    assert params["top_ks"] == [2, 2, 1]
+
+
+def test_hybrid_statement_rejects_unknown_fusion():
+    with pytest.raises(ValueError, match="Unknown HYBRID_FUSION"):
+        _hybrid_statement("max", False)
+
+
+@pytest.mark.parametrize(
+    "fusion, with_domain", [("rrf", False), ("rrf", True), ("weighted", False)]
+)
+def test_hybrid_statement_binds_optional_params(fusion, with_domain):
+    stmt = _hybrid_statement(fusion, with_domain)
+
+    assert ("rrf_k" in stmt._bindparams) == (fusion == "rrf")
+    assert ("domain" in stmt._bindparams) == with_domain
+    assert ("dd.domain = :domain" in stmt.text) == with_domain
+    # rrf сливает ранги веток, weighted — сходство и нормированный ts_rank_cd
+    assert (":fts_weight / (:rrf_k + f.rnk)" in stmt.text) == (fusion == "rrf")
+    assert (":vector_weight * (1 - v.distance)" in stmt.text) == (fusion == "weighted")
+    # Векторная ветка завершается до старта полнотекстовой
+    assert "(SELECT done FROM vec_mark) IS NOT NULL" in stmt.text
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_maps_rows_and_branch_timings(monkeypatch):
+    monkeypatch.setattr(settings, "HYBRID_FUSION", "weighted")
+    hybrid = dict(vector_hits=2, fts_hits=1, vector_ms=3.5, fts_ms=1.25)
+    db = _session(
+        [
+            _row(1, 0.2, fusion_score=0.9, **hybrid),
+            _row(2, 0.6, fusion_score=0.4, **hybrid),
+        ]
+    )
+
+    candidates, timings = await hybrid_search(
+        db, "query", [0.0], top_k=2, domain="docs"
+    )
+
+    stmt, params = db.execute.await_args.args
+    assert stmt is _hybrid_statement("weighted", True)
+    assert "rrf_k" not in params
+    assert params["domain"] == "docs"
+    assert [(c["chunk_id"], c["fusion_score"]) for c in candidates] == [
+        (1, 0.9),
+        (2, 0.4),
+    ]
+    assert candidates[0]["similarity"] == 0.8
+    assert timings == {"retrieve_vector": 3.5, "retrieve_fts": 1.25}
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_without_matches(monkeypatch):
+    monkeypatch.setattr(settings, "HYBRID_FUSION", "rrf")
+    db = _session([])
+
+    candidates, timings = await hybrid_search(db, "query", [0.0], top_k=2)
+
+    params = db.execute.await_args.args[1]
+    assert params["rrf_k"] == settings.HYBRID_RRF_K
+    assert "domain" not in params
+    assert candidates == []
+    assert timings == {"retrieve_vector": 0.0, "retrieve_fts": 0.0}
@@ -0,0 +1,118 @@
+import datetime
+import json
+import math
+
+import pytest
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Float, event, func, literal
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.api.semantic_cache import SemanticCache
+from src.api.services.history_service import QueryHistoryService
+from src.config import settings
+from src.db.models import Chunk, Document, QueryHistory
+from tests.conftest import SQLALCHEMY_DATABASE_URL
+
+
+def _cosine_distance(a, b):
+    a, b = json.loads(a), json.loads(b)
+    dot = sum(x * y for x, y in zip(a, b, strict=True))
+    return 1 - dot / (math.hypot(*a) * math.hypot(*b))
+
+
+@pytest.fixture
+def sqlite_cosine(monkeypatch):
+    """
+    Асинхронная сессия SQLite, в которой оператор pgvector <=> заменен
+    функцией на Python.
+    """
+    monkeypatch.setattr(
+        Vector.Comparator,
+        "cosine_distance",
+        lambda self, other: func.cosine_distance(
+            self.expr, literal(other, self.type), type_=Float
+        ),
+    )
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://")
+    )
+    event.listen(
+        engine.sync_engine,
+        "connect",
+        lambda conn, _: conn.create_function("cosine_distance", 2, _cosine_distance),
+    )
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    engine.sync_engine.dispose()
+
+
+def _vector(x: float):
+    return [x, 1.0] + [0.0] * (settings.EMBEDDING_DIM - 2)
+
+
+def _entry(history_id, embedding, response_md, is_fallback):
+    source = {"chunk_id": 1, "document_id": 1, "cited": True}
+    return QueryHistory(
+        id=history_id,
+        user_id=1,
+        query_text="question",
+        query_embedding=embedding,
+        response_md=response_md,
+        sources_json=[source],
+        llm_provider="test",
+        llm_model="test-model",
+        confidence_score=0.95,
+        is_fallback=is_fallback,
+    )
+
+
+@pytest.mark.asyncio
+async def test_fallback_entries_are_never_served(test_db, sqlite_cosine):
+    hour_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        hours=1
+    )
+    test_db.add(Document(id=1, file_path="/a.md", content_hash=b"a", full_text="text"))
+    test_db.add(
+        Chunk(
+            id=1,
+            document_id=1,
+            chunk_index=0,
+            chunk_text="text",
+            token_count=1,
+            embedding=_vector(0.0),
+            created_at=hour_ago,
+        )
+    )
+    # Заглушка ближе к запросу, чем настоящий ответ
+    test_db.add(_entry(1, _vector(0.0), "К сожалению...", is_fallback=True))
+    test_db.add(_entry(2, _vector(0.1), "answer", is_fallback=False))
+    test_db.commit()
+    cache = SemanticCache()
+    cache.max_distance = 0.05
+
+    async with sqlite_cosine() as db:
+        hit = await cache.lookup(db, _vector(0.0), None, min_confidence=0.0)
+    assert hit is not None and hit["response_md"] == "answer"
+
+    test_db.query(QueryHistory).filter(QueryHistory.is_fallback.is_(False)).delete()
+    test_db.commit()
+    async with sqlite_cosine() as db:
+        assert await cache.lookup(db, _vector(0.0), None, min_confidence=0.0) is None
+
+
+@pytest.mark.asyncio
+async def test_save_marks_fallback_responses(mocker):
+    writer = mocker.patch(
+        "src.api.services.history_service.get_history_writer"
+    ).return_value
+    writer.submit = mocker.AsyncMock(return_value=1)
+    llm_client = mocker.Mock(provider="test", model="test-model")
+    result = {
+        "response_md": "К сожалению...",
+        "confidence_score": 0.0,
+        "sources": [],
+        "warnings": ["low_confidence", "fallback"],
+    }
+
+    await QueryHistoryService.save(None, 1, "question", [0.0], result, llm_client)
+
+    assert writer.submit.call_args.args[0]["is_fallback"] is True